@@ -21,6 +21,7 @@ class _ImportExportBase(command.Command):
             run.cwd,
             run.description,
             start_time,
+            sampled=run.sampled,
         )
         self.log.debug('Copying trace data')
         for t in input_db.get_trace(run_id):
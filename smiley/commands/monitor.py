@@ -36,6 +36,7 @@ class Monitor(listen_cmd.ListeningCommand):
                 os.getcwd(),
                 msg_payload['command_line'],
                 msg_payload['timestamp'],
+                sampled=msg_payload.get('sampled', False),
             )
 
         elif msg_type == 'end_run':
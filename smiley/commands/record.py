@@ -21,6 +21,32 @@ class Record(listen_cmd.ListeningCommand):
             default='smiley.db',
             help='filename for the database (%(default)s)',
         )
+        parser.add_argument(
+            '--commit-every',
+            default=1000,
+            type=int,
+            help='trace events to write between commits (%(default)s)',
+        )
+        parser.add_argument(
+            '--commit-interval',
+            default=1.0,
+            type=float,
+            help='maximum seconds between commits (%(default)s)',
+        )
+        parser.add_argument(
+            '--max-queue-size',
+            default=0,
+            type=int,
+            help='events waiting to be written, 0 for no limit '
+            '(%(default)s)',
+        )
+        parser.add_argument(
+            '--overflow-policy',
+            default='block',
+            choices=local.LocalPublisher.OVERFLOW_POLICIES,
+            help='what to do with new events when the queue is full '
+            '(%(default)s)',
+        )
         return parser
 
     def _process_message(self, msg):
@@ -38,6 +64,7 @@ class Record(listen_cmd.ListeningCommand):
                 cwd=self._cwd,
                 description=msg_payload.get('command_line', []),
                 start_time=msg_payload.get('timestamp'),
+                sampled=msg_payload.get('sampled', False),
             )
 
         elif msg_type == 'end_run':
@@ -47,11 +74,13 @@ class Record(listen_cmd.ListeningCommand):
                 end_time=msg_payload.get('timestamp'),
                 message=msg_payload.get('message'),
                 traceback=msg_payload.get('traceback'),
+                stats=msg_payload.get('stats'),
             )
 
         else:
             self.publisher.trace(
                 run_id=msg_payload['run_id'],
+                thread_id=msg_payload.get('thread_id'),
                 call_id=msg_payload['call_id'],
                 event=msg_type,
                 func_name=msg_payload.get('func_name'),
@@ -63,5 +92,11 @@ class Record(listen_cmd.ListeningCommand):
             )
 
     def take_action(self, parsed_args):
-        self.publisher = local.LocalPublisher(parsed_args.database)
+        self.publisher = local.LocalPublisher(
+            parsed_args.database,
+            commit_every=parsed_args.commit_every,
+            commit_interval=parsed_args.commit_interval,
+            max_queue_size=parsed_args.max_queue_size,
+            overflow_policy=parsed_args.overflow_policy,
+        )
         return super(Record, self).take_action(parsed_args)
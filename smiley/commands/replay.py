@@ -40,6 +40,7 @@ class Replay(command.Command):
             cwd=run_details.cwd,
             description=run_details.description,
             start_time=run_details.start_time,
+            sampled=run_details.sampled,
         )
         for t in self.db.get_trace(parsed_args.run_id):
             self.out.trace(
@@ -1,4 +1,5 @@
 import logging
+import multiprocessing
 
 from cliff import command
 
@@ -38,6 +39,13 @@ class Report(command.Command):
             default='',
             help='title for the report',
         )
+        parser.add_argument(
+            '-j', '--jobs',
+            default=1,
+            type=int,
+            help=('number of processes used to render pages, '
+                  '0 for one per CPU (%(default)s)'),
+        )
         parser.add_argument(
             'run_id',
             help='identifier for the run',
@@ -47,11 +55,15 @@ class Report(command.Command):
     def take_action(self, parsed_args):
         database = db.DB(parsed_args.database)
         output_dir = parsed_args.output_directory or parsed_args.run_id
+        jobs = parsed_args.jobs
+        if jobs <= 0:
+            jobs = multiprocessing.cpu_count()
         report = html.HTMLReport(
             run_id=parsed_args.run_id,
             output_dir=output_dir,
             database=database,
             title=parsed_args.title or parsed_args.run_id,
             per_page=parsed_args.items_per_page,
+            jobs=jobs,
         )
         report.run()
@@ -7,6 +7,7 @@ from cliff import command
 from smiley import local
 from smiley import publisher
 from smiley import tracer
+from smiley import wire
 
 
 class Run(command.Command):
@@ -67,16 +68,178 @@ class Run(command.Command):
             default=[],
             help='trace into a specific package',
         )
+        include_group.add_argument(
+            '--include-function',
+            action='append',
+            dest='include_functions',
+            default=[],
+            metavar='PATTERN',
+            help='only trace functions whose module or qualified name, '
+            'such as "app.views.Handler.get", matches a shell-style '
+            'pattern',
+        )
+        include_group.add_argument(
+            '--exclude-function',
+            action='append',
+            dest='exclude_functions',
+            default=[],
+            metavar='PATTERN',
+            help='do not trace functions whose module or qualified name '
+            'matches a shell-style pattern',
+        )
+        include_group.add_argument(
+            '--trigger',
+            action='append',
+            dest='triggers',
+            default=[],
+            metavar='PATTERN',
+            help='only trace while a function whose module or qualified '
+            'name matches a shell-style pattern is running, using the '
+            'settrace backend',
+        )
+        parser.add_argument(
+            '--backend',
+            default='auto',
+            choices=tracer.BACKENDS,
+            help='how to hook into the interpreter, "auto" uses '
+            'sys.monitoring when it is available and sys.settrace '
+            'otherwise (%(default)s)',
+        )
+        parser.add_argument(
+            '--full-locals',
+            action='store_false',
+            dest='incremental_locals',
+            default=True,
+            help='send all local variables with every event, instead of '
+            'only the ones that changed',
+        )
+        parser.add_argument(
+            '--no-value-refs',
+            action='store_false',
+            dest='value_refs',
+            default=True,
+            help='send objects in full every time, instead of as a '
+            'reference to the earlier copy when they have not changed',
+        )
+        sample_group = parser.add_argument_group(
+            'sampling',
+            'Record only part of the program, to watch busy programs '
+            'with less overhead. The two kinds of sampling may be '
+            'combined. Sampled runs do not include profiling stats.',
+        )
+        sample_group.add_argument(
+            '--sample-calls',
+            default=0,
+            type=int,
+            metavar='N',
+            help='trace one out of every N top-level calls, which are '
+            'not made from other code that could be traced, with '
+            'everything they call, using the settrace backend',
+        )
+        sample_group.add_argument(
+            '--sample-interval',
+            default=0,
+            type=float,
+            metavar='SECONDS',
+            help='record the stack of every thread at this interval, '
+            'without the values of local variables',
+        )
+        limit_group = parser.add_argument_group(
+            'size limits',
+            'Truncate large values of local variables and arguments, '
+            'marking them as "<truncated: ...>". The limits are off (0) '
+            'unless set.',
+        )
+        limit_group.add_argument(
+            '--max-depth',
+            default=0,
+            type=int,
+            help='levels of nested containers and objects to send '
+            '(%(default)s)',
+        )
+        limit_group.add_argument(
+            '--max-items',
+            default=0,
+            type=int,
+            help='items to send from each container (%(default)s)',
+        )
+        limit_group.add_argument(
+            '--max-string-length',
+            default=0,
+            type=int,
+            help='characters to send from each string (%(default)s)',
+        )
+        limit_group.add_argument(
+            '--max-event-bytes',
+            default=0,
+            type=int,
+            help='approximate size of the values sent with each event '
+            '(%(default)s)',
+        )
         parser.add_argument(
             '--database',
             default='smiley.db',
             help='filename for the database (%(default)s)',
         )
+        parser.add_argument(
+            '--commit-every',
+            default=1000,
+            type=int,
+            help='trace events to write between commits with --local '
+            '(%(default)s)',
+        )
+        parser.add_argument(
+            '--commit-interval',
+            default=1.0,
+            type=float,
+            help='maximum seconds between commits with --local (%(default)s)',
+        )
+        parser.add_argument(
+            '--max-queue-size',
+            default=0,
+            type=int,
+            help='events waiting to be written with --local, 0 for no '
+            'limit (%(default)s)',
+        )
+        parser.add_argument(
+            '--overflow-policy',
+            default='block',
+            choices=local.LocalPublisher.OVERFLOW_POLICIES,
+            help='what to do with new events when the queue is full '
+            '(%(default)s)',
+        )
         parser.add_argument(
             '--socket',
             default='tcp://127.0.0.1:5556',
             help='URL for the socket where the listener will be (%(default)s)',
         )
+        parser.add_argument(
+            '--codec',
+            default='json',
+            choices=sorted(wire.CODECS),
+            help='message format for the socket, listeners learn it from '
+            'the start of each run (%(default)s)',
+        )
+        parser.add_argument(
+            '--batch-size',
+            default=0,
+            type=int,
+            help='trace events to send to the listener together, '
+            '0 to send each one separately (%(default)s)',
+        )
+        parser.add_argument(
+            '--batch-bytes',
+            default=1024 * 1024,
+            type=int,
+            help='maximum encoded size of a batch (%(default)s)',
+        )
+        parser.add_argument(
+            '--batch-interval',
+            default=0.5,
+            type=float,
+            help='maximum seconds to hold an event in a batch '
+            '(%(default)s)',
+        )
         parser.add_argument(
             'command',
             nargs='+',
@@ -95,14 +258,38 @@ class Run(command.Command):
 
         # Run the app
         if parsed_args.mode == 'remote':
-            p = publisher.Publisher(parsed_args.socket)
+            p = publisher.Publisher(
+                parsed_args.socket,
+                codec=parsed_args.codec,
+                batch_size=parsed_args.batch_size,
+                batch_bytes=parsed_args.batch_bytes,
+                batch_interval=parsed_args.batch_interval,
+            )
         else:
-            p = local.LocalPublisher(parsed_args.database)
+            p = local.LocalPublisher(
+                parsed_args.database,
+                commit_every=parsed_args.commit_every,
+                commit_interval=parsed_args.commit_interval,
+                max_queue_size=parsed_args.max_queue_size,
+                overflow_policy=parsed_args.overflow_policy,
+            )
         t = tracer.Tracer(
             p,
             include_stdlib=parsed_args.include_stdlib,
             include_site_packages=parsed_args.include_site_packages,
             include_packages=parsed_args.include_packages,
+            include_functions=parsed_args.include_functions,
+            exclude_functions=parsed_args.exclude_functions,
+            triggers=parsed_args.triggers,
+            backend=parsed_args.backend,
+            incremental_locals=parsed_args.incremental_locals,
+            value_refs=parsed_args.value_refs,
+            max_depth=parsed_args.max_depth or None,
+            max_items=parsed_args.max_items or None,
+            max_string_length=parsed_args.max_string_length or None,
+            max_event_bytes=parsed_args.max_event_bytes or None,
+            sample_calls=parsed_args.sample_calls,
+            sample_interval=parsed_args.sample_interval or None,
         )
         t.run(parsed_args.command)
         return
@@ -36,6 +36,13 @@ class Server(command.Command):
             type=int,
             help='port on which to listen (%(default)s)',
         )
+        parser.add_argument(
+            '--cache-size',
+            default=64,
+            type=int,
+            help='megabytes of memory to use for caching values computed '
+            'for the pages (%(default)s)',
+        )
         return parser
 
     def take_action(self, parsed_args):
@@ -43,6 +50,7 @@ class Server(command.Command):
             database_name=parsed_args.database,
             host=parsed_args.host,
             port=parsed_args.port,
+            cache_size=parsed_args.cache_size * 1024 * 1024,
         )
         app = load_app(config_data)
 
@@ -39,6 +39,8 @@ class Show(command.Command):
             'end_time': run.end_time.isoformat(),
             'error_message': run.error_message,
             'traceback': run.traceback,
+            'dropped_events': run.dropped_events,
+            'sampled': run.sampled,
         }
         output.dump_dictionary(details, self.log.info, 0)
         threads = list(self.db.get_thread_details(parsed_args.run_id))
@@ -1,17 +1,22 @@
 import collections
 import contextlib
 import datetime
+import functools
 import hashlib
+import itertools
 import json
 import logging
 import pkgutil
 import sqlite3
+import time
 
 import six
 
 from smiley import jsonutil
+from smiley import localsdiff
 from smiley import processor
 from smiley import stats as stats_utils
+from smiley import valuecache
 
 LOG = logging.getLogger(__name__)
 
@@ -26,7 +31,9 @@ class NoSuchRun(Exception):
 
 Run = collections.namedtuple(
     'Run',
-    'id cwd description start_time end_time error_message stats traceback',
+    ' '.join(['id', 'cwd', 'description', 'start_time', 'end_time',
+              'error_message', 'stats', 'traceback', 'dropped_events',
+              'sampled']),
 )
 
 
@@ -45,6 +52,8 @@ def _make_run(row):
         row['error_message'],
         stats,
         row['traceback'],
+        row['dropped_events'] or 0,
+        bool(row['sampled']),
     )
 
 
@@ -62,28 +71,171 @@ def _make_file(row):
     )
 
 
-Trace = collections.namedtuple(
-    'Trace',
-    ' '.join(['id', 'run_id', 'thread_id', 'call_id', 'event',
-              'filename', 'line_no', 'func_name',
-              'trace_arg', 'local_vars',
-              'timestamp'])
-)
+# Marks a Trace attribute that has not been decoded from the
+# database yet.
+_NOT_DECODED = object()
+
+
+class Trace(object):
+    """One event from the trace of a run.
+
+    Behaves like a namedtuple. Events read from the database keep
+    trace_arg, local_vars, and timestamp in their stored form until
+    they are used, so callers that only look at the location of each
+    event do not pay to decode them.
+    """
+
+    _fields = ('id', 'run_id', 'thread_id', 'call_id', 'event',
+               'filename', 'line_no', 'func_name',
+               'trace_arg', 'local_vars',
+               'timestamp')
+
+    _decoders = {
+        'trace_arg': json.loads,
+        'local_vars': json.loads,
+        'timestamp': datetime.datetime.fromtimestamp,
+    }
+
+    __slots__ = ('id', 'run_id', 'thread_id', 'call_id', 'event',
+                 'filename', 'line_no', 'func_name',
+                 '_trace_arg', '_local_vars', '_timestamp',
+                 '_stored', '_values')
+
+    def __init__(self, id, run_id, thread_id, call_id, event,
+                 filename, line_no, func_name,
+                 trace_arg, local_vars,
+                 timestamp):
+        self.id = id
+        self.run_id = run_id
+        self.thread_id = thread_id
+        self.call_id = call_id
+        self.event = event
+        self.filename = filename
+        self.line_no = line_no
+        self.func_name = func_name
+        self._trace_arg = trace_arg
+        self._local_vars = local_vars
+        self._timestamp = timestamp
+        self._stored = None
+        # Looks up the values referred to by local_vars.
+        self._values = None
+
+    def _decode(self, name):
+        value = getattr(self, '_' + name)
+        if value is _NOT_DECODED:
+            stored = self._stored[name]
+            if stored is not None:
+                value = self._decoders[name](stored)
+                if (name == 'local_vars' and self._values is not None and
+                        valuecache.VALUE_KEY in stored):
+                    value = valuecache.resolve(value, self._values)
+            else:
+                value = None
+            setattr(self, '_' + name, value)
+        return value
+
+    @property
+    def trace_arg(self):
+        return self._decode('trace_arg')
+
+    @property
+    def local_vars(self):
+        return self._decode('local_vars')
+
+    @property
+    def timestamp(self):
+        return self._decode('timestamp')
+
+    def _has_delta(self):
+        "Return whether local_vars only holds changes."
+        if self._local_vars is _NOT_DECODED:
+            return localsdiff.is_encoded_delta(self._stored['local_vars'])
+        return localsdiff.is_delta(self._local_vars)
+
+    def _replace(self, **kwds):
+        new = object.__new__(Trace)
+        for name in self.__slots__:
+            setattr(new, name, getattr(self, name))
+        for name, value in kwds.items():
+            if name in self._decoders:
+                name = '_' + name
+            setattr(new, name, value)
+        return new
+
+    def _asdict(self):
+        return collections.OrderedDict(zip(self._fields, self))
+
+    def __iter__(self):
+        return (getattr(self, name) for name in self._fields)
+
+    def __eq__(self, other):
+        if not isinstance(other, Trace):
+            return NotImplemented
+        return tuple(self) == tuple(other)
 
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        if result is NotImplemented:
+            return result
+        return not result
 
-def _make_trace(row):
-    return Trace(
+    __hash__ = None
+
+    def __repr__(self):
+        return 'Trace(%s)' % ', '.join(
+            '%s=%r' % item for item in self._asdict().items()
+        )
+
+
+def _make_trace(row, symbols=None, values=None):
+    keys = row.keys()
+
+    def get(name):
+        return row[name] if name in keys else None
+
+    thread_id = get('thread_id')
+    filename = get('filename')
+    func_name = get('func_name')
+    if symbols is not None:
+        thread_id = symbols.get(thread_id, thread_id)
+        filename = symbols.get(filename, filename)
+        func_name = symbols.get(func_name, func_name)
+    t = Trace(
         id=row['id'],
-        run_id=row['run_id'],
-        thread_id=row['thread_id'],
-        call_id=row['call_id'],
-        event=row['event'],
-        filename=row['filename'],
-        line_no=row['line_no'],
-        func_name=row['func_name'],
-        trace_arg=json.loads(row['trace_arg']),
-        local_vars=json.loads(row['local_vars']),
-        timestamp=datetime.datetime.fromtimestamp(row['timestamp']),
+        run_id=get('run_id'),
+        thread_id=thread_id,
+        call_id=get('call_id'),
+        event=get('event'),
+        filename=filename,
+        line_no=get('line_no'),
+        func_name=func_name,
+        trace_arg=_NOT_DECODED,
+        local_vars=_NOT_DECODED,
+        timestamp=_NOT_DECODED,
+    )
+    t._stored = {
+        'trace_arg': get('trace_arg'),
+        'local_vars': get('local_vars'),
+        'timestamp': get('timestamp'),
+    }
+    t._values = values
+    return t
+
+
+def _rebuild_locals(rebuilder, trace):
+    """Replace the changes recorded by an incremental trace with the
+    full set of local variables.
+
+    Complete sets of variables are passed to the rebuilder without
+    being decoded.
+    """
+    if not trace._has_delta():
+        rebuilder.remember(trace.call_id, trace.event, trace)
+        return trace
+    return trace._replace(
+        local_vars=rebuilder.rebuild(
+            trace.call_id, trace.event, trace.local_vars,
+        ),
     )
 
 
@@ -93,9 +245,12 @@ Thread = collections.namedtuple(
 )
 
 
-def _make_thread(row):
+def _make_thread(row, symbols=None):
+    thread_id = row['thread_id']
+    if symbols is not None:
+        thread_id = symbols.get(thread_id, thread_id)
     return Thread(
-        id=row['thread_id'],
+        id=thread_id,
         start_time=datetime.datetime.fromtimestamp(row['start_time']),
         end_time=datetime.datetime.fromtimestamp(row['end_time']),
         num_events=row['num_events'],
@@ -103,6 +258,27 @@ def _make_thread(row):
     )
 
 
+# Number of rows to read at a time from query results.
+FETCH_SIZE = 1000
+
+
+def _stream(c, make):
+    """Convert the rows from a query as they are read.
+
+    The rows are read FETCH_SIZE at a time, so results of any size
+    can be used without loading them all into memory.
+    """
+    try:
+        while True:
+            rows = c.fetchmany(FETCH_SIZE)
+            if not rows:
+                break
+            for row in rows:
+                yield make(row)
+    finally:
+        c.close()
+
+
 @contextlib.contextmanager
 def transaction(conn):
     c = conn.cursor()
@@ -115,15 +291,290 @@ def transaction(conn):
         conn.commit()
 
 
+@contextlib.contextmanager
+def savepoint(conn, name):
+    """Undo the changes made in the block if it fails.
+
+    Unlike transaction(), the changes are not committed, and a failure
+    only undoes the statements run inside the block, leaving the rest
+    of the open transaction alone.
+    """
+    # Releasing a savepoint made outside of a transaction commits it,
+    # so start one first.
+    if not getattr(conn, 'in_transaction', True):
+        conn.execute(u'BEGIN')
+    conn.execute(u'SAVEPOINT %s' % name)
+    try:
+        yield
+    except Exception:
+        conn.execute(u'ROLLBACK TO %s' % name)
+        conn.execute(u'RELEASE %s' % name)
+        raise
+    else:
+        conn.execute(u'RELEASE %s' % name)
+
+
+def _get_schema_version(conn):
+    return conn.execute(u'PRAGMA user_version').fetchone()[0]
+
+
+def _set_schema_version(conn, version):
+    # PRAGMA does not accept parameters.
+    conn.execute(u'PRAGMA user_version = %d' % version)
+    conn.commit()
+
+
+def _column_names(c, table):
+    c.execute(u'PRAGMA table_info(%s)' % table)
+    return set(r['name'] for r in c.fetchall())
+
+
+def _add_dropped_events(c):
+    """Add run.dropped_events.
+    """
+    if 'dropped_events' not in _column_names(c, 'run'):
+        c.execute(u'ALTER TABLE run ADD COLUMN dropped_events int DEFAULT 0')
+
+
+def _add_symbols(c):
+    """Add the symbol table and run.interned.
+    """
+    if 'interned' not in _column_names(c, 'run'):
+        c.execute(u'ALTER TABLE run ADD COLUMN interned int DEFAULT 0')
+    c.execute(
+        u"""
+        CREATE TABLE IF NOT EXISTS symbol (
+            run_id text not null references run(id),
+            id integer not null,
+            value text not null
+        )
+        """
+    )
+    c.execute(
+        u"""
+        CREATE UNIQUE INDEX IF NOT EXISTS symbol_run_id_id_idx
+        ON symbol(run_id, id)
+        """
+    )
+
+
+def _add_trace_indexes(c):
+    """Add indexes for trace queries by thread and by location.
+    """
+    c.execute(
+        u"""
+        CREATE INDEX IF NOT EXISTS trace_run_id_thread_id_idx
+        ON trace(run_id, thread_id, id)
+        """
+    )
+    c.execute(
+        u"""
+        CREATE INDEX IF NOT EXISTS trace_run_id_location_idx
+        ON trace(run_id, filename, line_no)
+        """
+    )
+
+
+def _add_thread_summary(c):
+    """Replace the location_counts view with the thread_summary table.
+    """
+    c.execute(u'DROP VIEW IF EXISTS location_counts')
+    c.execute(
+        u"""
+        CREATE TABLE IF NOT EXISTS thread_summary (
+            run_id text not null references run(id),
+            thread_id text,
+            start_time int,
+            end_time int,
+            num_events int,
+            num_locations int
+        )
+        """
+    )
+    c.execute(
+        u"""
+        CREATE UNIQUE INDEX IF NOT EXISTS thread_summary_run_id_thread_id_idx
+        ON thread_summary(run_id, thread_id)
+        """
+    )
+
+
+def _add_call_index(c):
+    """Add an index to find the events of a call.
+    """
+    c.execute(
+        u"""
+        CREATE INDEX IF NOT EXISTS trace_call_id_idx
+        ON trace(call_id, id)
+        """
+    )
+
+
+def _add_collapsed_trace(c):
+    """Add the collapsed_trace table.
+    """
+    c.execute(
+        u"""
+        CREATE TABLE IF NOT EXISTS collapsed_trace (
+            run_id text not null references run(id),
+            thread_id text not null,
+            position int not null,
+            first_id int not null
+        )
+        """
+    )
+    c.execute(
+        u"""
+        CREATE UNIQUE INDEX IF NOT EXISTS
+        collapsed_trace_run_id_thread_id_position_idx
+        ON collapsed_trace(run_id, thread_id, position)
+        """
+    )
+
+
+def _add_styled_file(c):
+    """Add the styled_file table.
+    """
+    c.execute(
+        u"""
+        CREATE TABLE IF NOT EXISTS styled_file (
+            signature text not null references file(signature),
+            style text not null,
+            body text
+        )
+        """
+    )
+    c.execute(
+        u"""
+        CREATE UNIQUE INDEX IF NOT EXISTS styled_file_signature_style_idx
+        ON styled_file(signature, style)
+        """
+    )
+
+
+def _add_value(c):
+    """Add the value table.
+    """
+    c.execute(
+        u"""
+        CREATE TABLE IF NOT EXISTS value (
+            run_id text not null references run(id),
+            id integer not null,
+            body text
+        )
+        """
+    )
+    c.execute(
+        u"""
+        CREATE UNIQUE INDEX IF NOT EXISTS value_run_id_id_idx
+        ON value(run_id, id)
+        """
+    )
+
+
+def _add_sampled(c):
+    """Add run.sampled.
+    """
+    if 'sampled' not in _column_names(c, 'run'):
+        c.execute(u'ALTER TABLE run ADD COLUMN sampled int DEFAULT 0')
+
+
+# Changes to make to databases created by earlier versions, in
+# order. The number of migrations applied is saved as the user_version
+# of the database. New databases are created from schema.sql, which
+# must already include the effect of every migration in this list.
+# Migrations may run against databases that were partly upgraded
+# before this list existed, so they check before changing anything.
+_MIGRATIONS = [
+    _add_dropped_events,
+    _add_symbols,
+    _add_trace_indexes,
+    _add_thread_summary,
+    _add_call_index,
+    _add_collapsed_trace,
+    _add_styled_file,
+    _add_value,
+    _add_sampled,
+]
+
+
+# Compute the thread summary for a run by grouping on each location
+# first, so the trace table is only read once.
+_SUMMARIZE_THREADS = u"""
+SELECT thread_id,
+       MIN(start_time) AS start_time,
+       MAX(end_time) AS end_time,
+       SUM(num_events) AS num_events,
+       COUNT(*) AS num_locations
+FROM (SELECT thread_id,
+             MIN(timestamp) AS start_time,
+             MAX(timestamp) AS end_time,
+             COUNT(*) AS num_events
+      FROM trace
+      WHERE run_id = :run_id
+      GROUP BY thread_id, filename, line_no)
+GROUP BY thread_id
+"""
+
+_INSERT_TRACE = u"""
+INSERT INTO trace
+(run_id, thread_id, call_id, event,
+ func_name, line_no, filename,
+ trace_arg, local_vars,
+ timestamp)
+VALUES
+(:run_id, :thread_id, :call_id, :event,
+ :func_name, :line_no, :filename,
+ :trace_arg, :local_vars,
+ :timestamp)
+"""
+
+
+_INSERT_VALUE = u"""
+INSERT OR REPLACE INTO value
+(run_id, id, body)
+VALUES
+(:run_id, :id, :body)
+"""
+
+# Number of decoded values to keep for each run being read.
+VALUE_CACHE_SIZE = 10000
+
+
 class DB(processor.EventProcessor):
     """Database connection and API.
+
+    Trace events are written inside a transaction that is left open
+    until commit_every events have been written or commit_interval
+    seconds have passed since the last commit, whichever comes
+    first. The defaults commit every event.
+
+    The thread name, filename, and function name of each trace event
+    are stored as ids from a per-run symbol table, and turned back
+    into strings by the query methods. Objects sent by the tracer as
+    references to earlier values are stored the same way, in the
+    value table.
     """
 
-    def __init__(self, name):
+    def __init__(self, name, commit_every=1, commit_interval=None):
         self._name = name
         self.conn = self._open_db(name)
+        self._commit_every = max(commit_every, 1)
+        self._commit_interval = commit_interval
+        self._uncommitted = 0
+        self._last_commit = time.time()
+        # run_id -> {string: symbol id}, or None for runs recorded
+        # before symbols were added.
+        self._symbols = {}
+        # run_id -> {value id: decoded body}, for runs being read.
+        self._values = {}
         return
 
+    @property
+    def name(self):
+        "The filename of the database."
+        return self._name
+
     @staticmethod
     def _open_db(filename):
         """Open a database using the given filename.
@@ -140,30 +591,53 @@ class DB(processor.EventProcessor):
             LOG.debug('initializing database')
             schema = pkgutil.get_data('smiley', 'schema.sql').decode('utf-8')
             cursor.executescript(schema)
+            _set_schema_version(conn, len(_MIGRATIONS))
+        else:
+            DB._upgrade_schema(conn)
         return conn
 
-    def start_run(self, run_id, cwd, description, start_time):
+    @staticmethod
+    def _upgrade_schema(conn):
+        """Apply the migrations the database has not seen yet.
+        """
+        version = _get_schema_version(conn)
+        for number, migration in enumerate(_MIGRATIONS[version:], version):
+            LOG.debug('upgrading schema to version %d: %s',
+                      number + 1, migration.__doc__.strip())
+            with transaction(conn) as c:
+                migration(c)
+            _set_schema_version(conn, number + 1)
+
+    def start_run(self, run_id, cwd, description, start_time,
+                  sampled=False):
         "Record the beginning of a run."
         # LOG.debug('start_run(%s)', run_id)
+        self.flush()
         with transaction(self.conn) as c:
             try:
                 c.execute(
                     u"""
-                    INSERT INTO run (id, cwd, description, start_time)
-                    VALUES (:id, :cwd, :description, :start_time)
+                    INSERT INTO run
+                    (id, cwd, description, start_time, interned, sampled)
+                    VALUES (:id, :cwd, :description, :start_time, 1,
+                            :sampled)
                     """,
                     {'id': run_id,
                      'cwd': cwd,
                      'description': jsonutil.dumps(description),
-                     'start_time': start_time}
+                     'start_time': start_time,
+                     'sampled': 1 if sampled else 0}
                 )
             except sqlite3.IntegrityError:
                 raise ValueError('There is already a run with id %s in %s' % (
                     run_id, self._name))
+        self._symbols[run_id] = {}
 
-    def end_run(self, run_id, end_time, message, traceback, stats):
+    def end_run(self, run_id, end_time, message, traceback, stats,
+                dropped_events=0):
         "Record the end of a run."
         # LOG.debug('end_run(%s)', run_id)
+        self.flush()
         with transaction(self.conn) as c:
             c.execute(
                 u"""
@@ -172,15 +646,18 @@ class DB(processor.EventProcessor):
                     end_time = :end_time,
                     error_message = :message,
                     traceback = :traceback,
-                    stats = :stats
+                    stats = :stats,
+                    dropped_events = :dropped_events
                 WHERE id = :id
                 """,
                 {'id': run_id,
                  'end_time': end_time,
                  'message': message,
                  'traceback': jsonutil.dumps(traceback),
-                 'stats': stats or None}
+                 'stats': stats or None,
+                 'dropped_events': dropped_events}
             )
+            self._summarize_threads(c, run_id)
 
     def get_runs(self, only_errors=False, sort_order='ASC'):
         "Return the run data."
@@ -188,9 +665,9 @@ class DB(processor.EventProcessor):
         if only_errors:
             query.append(u"WHERE error_message is not null")
         query.append(u"ORDER BY start_time %s" % sort_order)
-        with transaction(self.conn) as c:
-            c.execute(u' '.join(query))
-            return (_make_run(r) for r in c.fetchall())
+        c = self.conn.cursor()
+        c.execute(u' '.join(query))
+        return _stream(c, _make_run)
 
     def get_run(self, run_id):
         "Return the run data."
@@ -206,24 +683,57 @@ class DB(processor.EventProcessor):
 
     def get_thread_details(self, run_id):
         "Return the names of the threads used in the run."
+        c = self.conn.cursor()
+        symbols = self._read_symbols(c, run_id)
+        make = functools.partial(_make_thread, symbols=symbols)
+        c.execute(
+            u"""
+            SELECT *
+            FROM thread_summary
+            WHERE run_id = :run_id
+            """,
+            {'run_id': run_id},
+        )
+        first = c.fetchone()
+        if first is not None:
+            return itertools.chain([make(first)], _stream(c, make))
+        c.close()
+        # The run is still going, or ended before summaries were
+        # saved.
         with transaction(self.conn) as c:
+            rows = self._summarize_threads(c, run_id)
+        return (make(r) for r in rows)
+
+    @staticmethod
+    def _summarize_threads(c, run_id):
+        """Compute the thread summary for a run.
+
+        The results are saved if the run has ended.
+        """
+        c.execute(_SUMMARIZE_THREADS, {'run_id': run_id})
+        rows = c.fetchall()
+        c.execute(
+            u"SELECT end_time FROM run WHERE id = :run_id",
+            {'run_id': run_id},
+        )
+        run = c.fetchone()
+        if run is not None and run['end_time'] is not None:
             c.execute(
+                u"DELETE FROM thread_summary WHERE run_id = :run_id",
+                {'run_id': run_id},
+            )
+            c.executemany(
                 u"""
-                SELECT trace.run_id, trace.thread_id,
-                       MIN(timestamp) AS start_time,
-                       MAX(timestamp) AS end_time,
-                       COUNT(trace.id) AS num_events,
-                       location_counts.num_locations AS num_locations
-                FROM trace
-                    JOIN location_counts
-                    ON trace.run_id = location_counts.run_id
-                        AND trace.thread_id = location_counts.thread_id
-                WHERE trace.run_id = :run_id
-                GROUP BY trace.thread_id
+                INSERT INTO thread_summary
+                (run_id, thread_id, start_time, end_time,
+                 num_events, num_locations)
+                VALUES
+                (:run_id, :thread_id, :start_time, :end_time,
+                 :num_events, :num_locations)
                 """,
-                {'run_id': run_id},
+                [dict(zip(r.keys(), r), run_id=run_id) for r in rows],
             )
-            return (_make_thread(r) for r in c.fetchall())
+        return rows
 
     def trace(self, run_id, thread_id, call_id, event,
               func_name, line_no, filename,
@@ -231,70 +741,434 @@ class DB(processor.EventProcessor):
               timestamp):
         "Record an event during a run."
         # LOG.debug('trace(filename=%s)', filename)
-        with transaction(self.conn) as c:
-            c.execute(
-                u"""
-                INSERT INTO trace
-                (run_id, thread_id, call_id, event,
-                 func_name, line_no, filename,
-                 trace_arg, local_vars,
-                 timestamp)
-                VALUES
-                (:run_id, :thread_id, :call_id, :event,
-                 :func_name, :line_no, :filename,
-                 :trace_arg, :local_vars,
-                 :timestamp)
-                """,
+        self.trace_many([(run_id, thread_id, call_id, event,
+                          func_name, line_no, filename,
+                          trace_arg, local_vars,
+                          timestamp)])
+
+    def trace_many(self, events):
+        """Record several events during a run.
+
+        Each item in events is a tuple with the arguments to trace(),
+        in the same order.
+        """
+        # Only this batch is undone if it fails, so the events waiting
+        # in the commit window are kept.
+        try:
+            with savepoint(self.conn, u'trace_many'):
+                count = self._insert_trace(events)
+        except Exception:
+            # Symbols added by this batch were rolled back, too.
+            self._symbols.clear()
+            raise
+        self._uncommitted += count
+        if self._commit_window_is_full():
+            self.flush()
+
+    def _insert_trace(self, events):
+        "Write the rows for events, returning how many were written."
+        c = self.conn.cursor()
+        intern = self._interner(c)
+        rows = []
+        value_rows = []
+        new_values = []
+
+        def save_value(value_id, body):
+            new_values.append((value_id, body))
+
+        for (run_id, thread_id, call_id, event,
+             func_name, line_no, filename,
+             trace_arg, local_vars,
+             timestamp) in events:
+            # Values sent in full are saved once, and the event refers
+            # to them by id.
+            local_vars = valuecache.extract(local_vars, save_value)
+            if new_values:
+                value_rows.extend(
+                    {'run_id': run_id,
+                     'id': value_id,
+                     'body': jsonutil.dumps(body),
+                     }
+                    for value_id, body in new_values
+                )
+                del new_values[:]
+            rows.append(
                 {'run_id': run_id,
-                 'thread_id': thread_id,
+                 'thread_id': intern(run_id, thread_id),
                  'call_id': call_id,
                  'event': event,
-                 'func_name': func_name,
+                 'func_name': intern(run_id, func_name),
                  'line_no': line_no,
-                 'filename': filename,
+                 'filename': intern(run_id, filename),
                  'trace_arg': jsonutil.dumps(trace_arg),
                  'local_vars': jsonutil.dumps(local_vars),
                  'timestamp': timestamp,
                  }
             )
+        if value_rows:
+            c.executemany(_INSERT_VALUE, value_rows)
+        if rows:
+            c.executemany(_INSERT_TRACE, rows)
+        return len(rows)
 
-    def get_trace(self, run_id, thread_id=None):
-        "Return the run data."
-        with transaction(self.conn) as c:
-            if thread_id:
+    def _interner(self, c):
+        """Return a function to map a string to its symbol id.
+
+        New symbols are written using the cursor c, as part of the
+        same commit window as the trace events that use them.
+        """
+        def intern(run_id, value):
+            if value is None:
+                return None
+            try:
+                symbols = self._symbols[run_id]
+            except KeyError:
+                symbols = self._symbols[run_id] = self._load_symbols(
+                    c, run_id)
+            if symbols is None:
+                return value
+            try:
+                return symbols[value]
+            except KeyError:
+                symbol_id = symbols[value] = len(symbols) + 1
                 c.execute(
                     u"""
-                    SELECT *
-                    FROM trace
-                    WHERE run_id = :run_id
-                    AND thread_id = :thread_id
-                    ORDER BY id
+                    INSERT INTO symbol (run_id, id, value)
+                    VALUES (:run_id, :id, :value)
                     """,
-                    {'run_id': run_id, 'thread_id': thread_id},
+                    {'run_id': run_id, 'id': symbol_id, 'value': value},
                 )
-            else:
+                return symbol_id
+        return intern
+
+    @staticmethod
+    def _query_symbols(c, run_id):
+        """Return the (id, value) rows of the symbol table for a run.
+
+        Returns None if the run does not use symbols.
+        """
+        c.execute(
+            u"SELECT interned FROM run WHERE id = :run_id",
+            {'run_id': run_id},
+        )
+        row = c.fetchone()
+        if row is None or not row['interned']:
+            return None
+        c.execute(
+            u"SELECT id, value FROM symbol WHERE run_id = :run_id",
+            {'run_id': run_id},
+        )
+        return c.fetchall()
+
+    @classmethod
+    def _load_symbols(cls, c, run_id):
+        "Return the symbols for a run being written, by string."
+        rows = cls._query_symbols(c, run_id)
+        if rows is None:
+            return None
+        return {r['value']: r['id'] for r in rows}
+
+    @classmethod
+    def _read_symbols(cls, c, run_id):
+        """Return the symbols for a run being read, by stored id.
+
+        The trace columns holding symbol ids have text affinity, so
+        the ids come back as strings.
+        """
+        rows = cls._query_symbols(c, run_id)
+        if rows is None:
+            return None
+        return {six.text_type(r['id']): r['value'] for r in rows}
+
+    def _value_lookup(self, run_id):
+        """Return a function to find the body of a value saved for a run.
+        """
+        bodies = self._values.setdefault(run_id, {})
+
+        def lookup(value_id):
+            try:
+                return bodies[value_id]
+            except KeyError:
+                pass
+            c = self.conn.cursor()
+            try:
                 c.execute(
-                    u"SELECT * FROM trace WHERE run_id = :run_id ORDER BY id",
-                    {'run_id': run_id},
+                    u"""
+                    SELECT body FROM value
+                    WHERE run_id = :run_id AND id = :id
+                    """,
+                    {'run_id': run_id, 'id': value_id},
                 )
-            return (_make_trace(t)
-                    for t in c.fetchall())
+                row = c.fetchone()
+            finally:
+                c.close()
+            if row is None:
+                # Not written yet, or lost with a dropped event.
+                return valuecache.missing(value_id)
+            if len(bodies) >= VALUE_CACHE_SIZE:
+                bodies.clear()
+            body = bodies[value_id] = json.loads(row['body'])
+            return body
+
+        return lookup
+
+    def _reset_commit_window(self):
+        self._uncommitted = 0
+        self._last_commit = time.time()
+
+    def _commit_window_is_full(self):
+        if self._uncommitted >= self._commit_every:
+            return True
+        if self._commit_interval is not None:
+            elapsed = time.time() - self._last_commit
+            return elapsed >= self._commit_interval
+        return False
+
+    def flush(self):
+        "Commit any trace events still waiting in the commit window."
+        if self._uncommitted:
+            self.conn.commit()
+        self._reset_commit_window()
+
+    def get_trace(self, run_id, thread_id=None, after_id=None, limit=None,
+                  columns=None, before_id=None):
+        """Return the trace events of the run, in order.
+
+        Use after_id and limit to read the events a page at a time:
+        only events with an id greater than after_id are returned, and
+        at most limit of them. If before_id is given, only events with
+        a smaller id are returned.
+
+        Use columns to name the Trace fields to read. The other fields
+        are set to None. The id is always read.
+        """
+        if columns is None:
+            columns = Trace._fields
+        unknown = set(columns) - set(Trace._fields)
+        if unknown:
+            raise ValueError('Unknown trace columns: %s' %
+                             ', '.join(sorted(unknown)))
+        with_locals = 'local_vars' in columns
+        selected = set(columns) | set(['id'])
+        if with_locals:
+            # Needed to rebuild incremental local variables.
+            selected |= set(['call_id', 'event'])
+        c = self.conn.cursor()
+        symbols = self._read_symbols(c, run_id)
+        query = [u"SELECT %s FROM trace WHERE run_id = :run_id" %
+                 u', '.join(sorted(selected))]
+        params = {'run_id': run_id,
+                  'thread_id': thread_id,
+                  'after_id': after_id,
+                  'before_id': before_id,
+                  'limit': limit}
+        if thread_id:
+            if symbols is not None:
+                params['thread_id'] = next(
+                    (k for k, v in symbols.items() if v == thread_id),
+                    # Not a thread from this run. Symbol ids start at
+                    # 1, so this matches nothing.
+                    u'0',
+                )
+            query.append(u"AND thread_id = :thread_id")
+        if after_id is not None:
+            query.append(u"AND id > :after_id")
+        if before_id is not None:
+            query.append(u"AND id < :before_id")
+        query.append(u"ORDER BY id")
+        if limit is not None:
+            query.append(u"LIMIT :limit")
+        c.execute(u' '.join(query), params)
+        rebuilder = localsdiff.Rebuilder()
+        values = self._value_lookup(run_id)
+
+        def make(row):
+            t = _make_trace(row, symbols, values)
+            if not with_locals:
+                return t
+            if (after_id is not None
+                    and t._has_delta()
+                    and not rebuilder.has_call(t.call_id)):
+                # The call started before the first event returned.
+                self._replay_call(rebuilder, run_id, t.call_id, t.id,
+                                  values)
+            return _rebuild_locals(rebuilder, t)
+
+        return _stream(c, make)
+
+    def _replay_call(self, rebuilder, run_id, call_id, before_id, values):
+        """Give rebuilder the local variables of a call's earlier events.
+
+        Only the events since the latest full set of variables before
+        before_id are read.
+        """
+        c = self.conn.cursor()
+        try:
+            params = {'call_id': call_id,
+                      'run_id': run_id,
+                      'before_id': before_id,
+                      'prefix': localsdiff.ENCODED_DELTA_PREFIX,
+                      'prefix_len': len(localsdiff.ENCODED_DELTA_PREFIX),
+                      }
+            c.execute(
+                u"""
+                SELECT id
+                FROM trace
+                WHERE call_id = :call_id
+                AND run_id = :run_id
+                AND id < :before_id
+                AND (local_vars IS NULL
+                     OR substr(local_vars, 1, :prefix_len) != :prefix)
+                ORDER BY id DESC
+                LIMIT 1
+                """,
+                params,
+            )
+            row = c.fetchone()
+            # Without a full set, start from the beginning of the call.
+            params['start_id'] = row['id'] if row is not None else 0
+            c.execute(
+                u"""
+                SELECT event, local_vars
+                FROM trace
+                WHERE call_id = :call_id
+                AND run_id = :run_id
+                AND id < :before_id
+                AND id >= :start_id
+                ORDER BY id
+                """,
+                params,
+            )
+            for row in c:
+                local_vars = json.loads(row['local_vars'])
+                if valuecache.VALUE_KEY in row['local_vars']:
+                    local_vars = valuecache.resolve(local_vars, values)
+                rebuilder.rebuild(call_id, row['event'], local_vars)
+        finally:
+            c.close()
 
     def delete_run(self, run_id):
         """Remove a run and all of its trace events from the database"""
         # Ensure that the run exists. This will raise NoSuchRun if it doesn't.
         self.get_run(run_id)
+        self.flush()
         with transaction(self.conn) as c:
             c.execute(
                 u""" DELETE FROM trace WHERE run_id = :run_id""",
                 {"run_id": run_id}
             )
+            c.execute(
+                u"""DELETE FROM symbol WHERE run_id = :run_id""",
+                {"run_id": run_id}
+            )
+            c.execute(
+                u"""DELETE FROM thread_summary WHERE run_id = :run_id""",
+                {"run_id": run_id}
+            )
+            c.execute(
+                u"""DELETE FROM collapsed_trace WHERE run_id = :run_id""",
+                {"run_id": run_id}
+            )
+            c.execute(
+                u"""DELETE FROM value WHERE run_id = :run_id""",
+                {"run_id": run_id}
+            )
             c.execute(
                 u"""DELETE FROM run WHERE id = :run_id""",
                 {"run_id": run_id}
             )
+        self._symbols.pop(run_id, None)
+        self._values.pop(run_id, None)
+
+    def get_collapsed_trace_size(self, run_id, thread_id=None):
+        """Return the number of items saved by save_collapsed_trace().
+        """
+        with transaction(self.conn) as c:
+            c.execute(
+                u"""
+                SELECT COUNT(*) AS num_items
+                FROM collapsed_trace
+                WHERE run_id = :run_id
+                AND thread_id = :thread_id
+                """,
+                {'run_id': run_id, 'thread_id': thread_id or u''},
+            )
+            return c.fetchone()['num_items']
+
+    def save_collapsed_trace(self, run_id, thread_id, first_ids):
+        """Save the id of the first trace event of each collapsed item.
+
+        Use thread_id None for the collapsed trace of all threads.
+        """
+        thread_id = thread_id or u''
+        with transaction(self.conn) as c:
+            c.execute(
+                u"""
+                DELETE FROM collapsed_trace
+                WHERE run_id = :run_id
+                AND thread_id = :thread_id
+                """,
+                {'run_id': run_id, 'thread_id': thread_id},
+            )
+            c.executemany(
+                u"""
+                INSERT INTO collapsed_trace
+                (run_id, thread_id, position, first_id)
+                VALUES (:run_id, :thread_id, :position, :first_id)
+                """,
+                ({'run_id': run_id,
+                  'thread_id': thread_id,
+                  'position': position,
+                  'first_id': first_id}
+                 for position, first_id in enumerate(first_ids)),
+            )
+
+    def get_collapsed_trace_bounds(self, run_id, thread_id, start, end):
+        """Return the trace ids bounding collapsed items start to end.
+
+        Returns the id of the first event in item start, and the id of
+        the first event after item end - 1, or None if there are no
+        more items.
+        """
+        with transaction(self.conn) as c:
+            c.execute(
+                u"""
+                SELECT position, first_id
+                FROM collapsed_trace
+                WHERE run_id = :run_id
+                AND thread_id = :thread_id
+                AND position IN (:start, :end)
+                """,
+                {'run_id': run_id,
+                 'thread_id': thread_id or u'',
+                 'start': start,
+                 'end': end},
+            )
+            ids = {r['position']: r['first_id'] for r in c.fetchall()}
+        return ids.get(start), ids.get(end)
 
     def cache_file_for_run(self, run_id, filename, body):
+        return self.cache_files_for_run([(run_id, filename, body)])[0]
+
+    def cache_files_for_run(self, files):
+        """Record the contents of several files in one transaction.
+
+        Each item in files is a tuple with the arguments to
+        cache_file_for_run(), in the same order. Returns the list of
+        file signatures.
+        """
+        c = self.conn.cursor()
+        # A failure only undoes these files, and not the trace events
+        # waiting in the commit window.
+        with savepoint(self.conn, u'cache_files'):
+            signatures = [self._cache_file(c, run_id, filename, body)
+                          for run_id, filename, body in files]
+        self.conn.commit()
+        self._reset_commit_window()
+        return signatures
+
+    @staticmethod
+    def _cache_file(c, run_id, filename, body):
         signature_maker = hashlib.sha1()
         if isinstance(filename, six.text_type):
             signature_maker.update(filename.encode('utf-8'))
@@ -305,33 +1179,32 @@ class DB(processor.EventProcessor):
         else:
             signature_maker.update(body)
         signature = signature_maker.hexdigest()
-        with transaction(self.conn) as c:
-            try:
-                c.execute(
-                    u"""
-                    INSERT INTO file (signature, name, body)
-                    VALUES (:signature, :filename, :body)
-                    """,
-                    {'signature': signature,
-                     'filename': filename,
-                     'body': body,
-                     },
-                )
-            except sqlite3.IntegrityError:
-                pass
-            try:
-                c.execute(
-                    u"""
-                    INSERT INTO run_file
-                    (run_id, signature)
-                    VALUES (:run_id, :signature)
-                    """,
-                    {'run_id': run_id,
-                     'signature': signature,
-                     },
-                )
-            except sqlite3.IntegrityError:
-                pass
+        try:
+            c.execute(
+                u"""
+                INSERT INTO file (signature, name, body)
+                VALUES (:signature, :filename, :body)
+                """,
+                {'signature': signature,
+                 'filename': filename,
+                 'body': body,
+                 },
+            )
+        except sqlite3.IntegrityError:
+            pass
+        try:
+            c.execute(
+                u"""
+                INSERT INTO run_file
+                (run_id, signature)
+                VALUES (:run_id, :signature)
+                """,
+                {'run_id': run_id,
+                 'signature': signature,
+                 },
+            )
+        except sqlite3.IntegrityError:
+            pass
         return signature
 
     def get_file_signature(self, run_id, filename):
@@ -357,37 +1230,73 @@ class DB(processor.EventProcessor):
             return row['signature'] if row else ''
 
     def get_files_for_run(self, run_id):
+        c = self.conn.cursor()
+        c.execute(
+            u"""
+            SELECT name, signature, run_id
+            FROM file JOIN run_file USING (signature)
+            WHERE
+              run_id = :run_id
+            ORDER BY name ASC
+            """,
+            {'run_id': run_id,
+             },
+        )
+        return _stream(c, _make_file)
+
+    def get_cached_file(self, run_id, filename):
         with transaction(self.conn) as c:
             c.execute(
                 u"""
-                SELECT name, signature, run_id
+                SELECT body
                 FROM file JOIN run_file USING (signature)
                 WHERE
+                  name = :filename
+                  AND
                   run_id = :run_id
-                ORDER BY name ASC
                 """,
-                {'run_id': run_id,
+                {'filename': filename,
+                 'run_id': run_id,
                  },
             )
-            return (_make_file(row) for row in c.fetchall())
+            row = c.fetchone()
+            return row['body'] if row else ''
 
-    def get_cached_file(self, run_id, filename):
+    def get_styled_file(self, signature, style):
+        """Return the highlighted body saved for a file, or None.
+        """
         with transaction(self.conn) as c:
             c.execute(
                 u"""
                 SELECT body
-                FROM file JOIN run_file USING (signature)
+                FROM styled_file
                 WHERE
-                  name = :filename
+                  signature = :signature
                   AND
-                  run_id = :run_id
+                  style = :style
                 """,
-                {'filename': filename,
-                 'run_id': run_id,
+                {'signature': signature,
+                 'style': style,
                  },
             )
             row = c.fetchone()
-            return row['body'] if row else ''
+            return row['body'] if row else None
+
+    def save_styled_file(self, signature, style, body):
+        """Save the highlighted body of a file.
+        """
+        with transaction(self.conn) as c:
+            c.execute(
+                u"""
+                INSERT OR REPLACE INTO styled_file
+                (signature, style, body)
+                VALUES (:signature, :style, :body)
+                """,
+                {'signature': signature,
+                 'style': style,
+                 'body': body,
+                 },
+            )
 
     def get_cached_file_by_id(self, run_id, file_id):
         with transaction(self.conn) as c:
@@ -1,4 +1,5 @@
 import argparse
+import itertools
 import json
 import logging
 import traceback
@@ -6,6 +7,7 @@ import types
 import xml.dom.minidom
 
 from cliff import commandmanager
+import six
 
 LOG = logging.getLogger(__name__)
 
@@ -18,12 +20,16 @@ _CIRCULAR_TYPES = (
 )
 
 
-def _json_special_types(obj):
-    if isinstance(obj, types.TracebackType):
-        return traceback.extract_tb(obj)
-    if isinstance(obj, type):
-        # We don't want to return classes
-        return repr(obj)
+def _safe_repr(value):
+    try:
+        return repr(value)
+    except Exception:
+        return '<unrepresentable %s>' % type(value).__name__
+
+
+def _object_data(obj):
+    """Return a dict of the attributes of obj, or its repr.
+    """
     try:
         data = dict(vars(obj))
         data['__class__'] = obj.__class__.__name__
@@ -34,60 +40,376 @@ def _json_special_types(obj):
             except AttributeError:
                 pass
     except Exception:
-        data = repr(obj)
+        data = _safe_repr(obj)
     return data
 
 
-def _scrub_item(v):
-    """Look for a few types that cause circular references.
+def _json_special_types(obj):
+    if isinstance(obj, types.TracebackType):
+        return traceback.extract_tb(obj)
+    if isinstance(obj, type):
+        # We don't want to return classes
+        return repr(obj)
+    return _object_data(obj)
+
+
+# Types json and msgpack encode directly, which are kept as they are
+# by the encoder.
+_PLAIN_TYPES = frozenset(
+    (type(None), bool, float) + six.string_types + six.integer_types
+)
+_STRING_TYPES = frozenset(six.string_types)
+_NUMBER_TYPES = frozenset((type(None), bool, float) + six.integer_types)
+
+# The start of the text that replaces data left out by the encoder.
+TRUNCATED_PREFIX = '<truncated: '
+
+# The key added to a dict with items left out by the encoder.
+TRUNCATED_KEY = '<truncated>'
+
+# The type of the entries returned by traceback.extract_tb() under
+# python 3.
+_FrameSummary = getattr(traceback, 'FrameSummary', None)
+
+
+def _is_pkg_resources_type(cls):
+    # Lots of things from pkg_resources seem to have circular
+    # references, so just ignore all of them.
+    return getattr(cls, '__module__', None) == 'pkg_resources'
+
+
+_NO_LIMIT = float('inf')
+
+
+def _limit(value):
+    return _NO_LIMIT if value is None else value
+
+
+def _describe(value):
+    name = type(value).__name__
+    try:
+        size = len(value)
+    except Exception:
+        return '%s object' % name
+    if isinstance(value, six.string_types + (six.binary_type,)):
+        return '%s of %d characters' % (name, size)
+    return '%s of %d items' % (name, size)
+
+
+def truncated(description):
+    """Return the marker put in place of data left out by the encoder.
+    """
+    return '%s%s>' % (TRUNCATED_PREFIX, description)
+
+
+class Wrapper(object):
+    """A value to convert and then wrap in something else.
+
+    The encoder replaces a Wrapper with wrap(converted, complete),
+    converting value at the depth of the Wrapper itself, so the
+    wrapping does not count against the limits. complete is false if
+    the size limit may have cut the converted value short.
+    """
+
+    __slots__ = ('value', 'wrap')
+
+    def __init__(self, value, wrap):
+        self.value = value
+        self.wrap = wrap
+
+
+class _Walk(object):
+    """State for one conversion by Encoder.simplify().
     """
-    if getattr(v, '__module__', None) == 'pkg_resources':
-        # Lots of things from pkg_resources seem to have circular
-        # references, so just ignore all of them.
-        # LOG.debug('replacing pkg_resources type %r', v)
-        v = repr(v)
-    elif isinstance(v, _CIRCULAR_TYPES):
-        # Look for some more specific types from other modules.
-        # LOG.debug('replacing %r', v)
-        v = repr(v).encode('utf-8')
-    elif isinstance(v, dict):
-        # Recurse.
-        v = _scrub_dict(v)
-    elif isinstance(v, list):
-        # Recurse.
-        v = _scrub_list(v)
-    # else:
-    #     LOG.debug('keeping object %r of type %s',
-    #               v, type(v))
-    return v
-
-
-def _scrub_dict(data):
-    return {k: _scrub_item(v) for k, v in data.items()}
-
-
-def _scrub_list(data):
-    return [_scrub_item(v) for v in data]
-
-
-def _scrub(data):
-    if isinstance(data, dict):
-        data = _scrub_dict(data)
-    elif isinstance(data, list):
-        data = _scrub_list(data)
-    return _scrub_item(data)
+
+    # type -> function(walk, value, depth) converting values of the
+    # type, filled in as types are seen.
+    _handlers = {}
+
+    def __init__(self, max_depth, max_items, max_string_length, max_bytes):
+        self.max_depth = _limit(max_depth)
+        self.max_items = _limit(max_items)
+        self.max_string_length = _limit(max_string_length)
+        self.budget = max_bytes
+        # Plain values can be used as they are when there is nothing
+        # to measure them against.
+        self.strings_unlimited = (max_string_length is None and
+                                  max_bytes is None)
+        # ids of the containers being converted, to find cycles.
+        self.active = set()
+
+    def simplify(self, value, depth):
+        cls = type(value)
+        if cls is Wrapper:
+            return self.convert_wrapper(value, depth)
+        if self.budget is not None and self.budget <= 0:
+            return truncated('%s over the size limit' % _describe(value))
+        try:
+            handler = self._handlers[cls]
+        except KeyError:
+            handler = self.handler_for(cls)
+        return handler(self, value, depth)
+
+    @classmethod
+    def handler_for(cls, value_type):
+        try:
+            return cls._handlers[value_type]
+        except KeyError:
+            handler = cls._handlers[value_type] = cls._find_handler(
+                value_type,
+            )
+            return handler
+
+    @classmethod
+    def _find_handler(cls, value_type):
+        if _is_pkg_resources_type(value_type):
+            return cls.convert_repr
+        if issubclass(value_type, _CIRCULAR_TYPES):
+            # Look for some more specific types from other modules.
+            return cls.convert_repr
+        if issubclass(value_type, six.string_types):
+            return cls.keep_string
+        if issubclass(value_type, types.TracebackType):
+            return cls.convert_traceback
+        if _FrameSummary is not None and issubclass(value_type, _FrameSummary):
+            return cls.convert_frame
+        if issubclass(value_type, type):
+            # We don't want to return classes
+            return cls.convert_repr
+        if (value_type is type(None) or
+                issubclass(value_type, (bool, float) + six.integer_types)):
+            return cls.keep_scalar
+        if issubclass(value_type, six.binary_type):
+            # Only reached under python 3.
+            return cls.convert_repr
+        if issubclass(value_type, dict):
+            return cls.convert_dict
+        if issubclass(value_type, (list, tuple)):
+            return cls.convert_list
+        return cls.convert_object
+
+    def charge(self, size):
+        if self.budget is not None:
+            self.budget -= size
+
+    def _all_plain(self, values, count):
+        """Return whether values can all be used as they are.
+        """
+        if self.strings_unlimited:
+            return _PLAIN_TYPES.issuperset(map(type, values))
+        if _NUMBER_TYPES.issuperset(map(type, values)):
+            self.charge(8 * count)
+            return True
+        return False
+
+    def _plain_keys(self, keys, count):
+        if not _STRING_TYPES.issuperset(map(type, keys)):
+            return False
+        if self.budget is not None:
+            self.charge(sum(map(len, keys)) + 4 * count)
+        return True
+
+    def keep_string(self, value, depth):
+        keep = self.max_string_length
+        if self.budget is not None:
+            # Leave room for the quotes.
+            keep = min(keep, max(self.budget - 2, 0))
+        extra = len(value) - keep
+        if extra > 0:
+            value = value[:keep] + truncated(
+                '%d more characters' % extra
+            )
+        self.charge(len(value) + 2)
+        return value
+
+    def keep_scalar(self, value, depth):
+        self.charge(8)
+        return value
+
+    def convert_repr(self, value, depth):
+        return self.keep_string(_safe_repr(value), depth)
+
+    def _convert_key(self, key):
+        if isinstance(key, six.string_types):
+            result = key
+        elif key is None or isinstance(key, (bool, float) +
+                                       six.integer_types):
+            # json turns these into strings itself.
+            return key
+        else:
+            result = _safe_repr(key)
+        self.charge(len(result) + 4)
+        return result
+
+    def _enter(self, value, depth):
+        """Return whether the contents of value should be converted.
+        """
+        if depth >= self.max_depth:
+            return False
+        key = id(value)
+        if key in self.active:
+            return False
+        self.active.add(key)
+        return True
+
+    def _stop(self, value, depth):
+        if id(value) in self.active:
+            return '<circular reference to %s>' % type(value).__name__
+        return truncated('%s nested too deeply' % _describe(value))
+
+    def _convert_items(self, items, size, depth):
+        if size > self.max_items:
+            items = itertools.islice(items, self.max_items)
+        result = {}
+        simplify = self.simplify
+        plain = _PLAIN_TYPES if self.strings_unlimited else _NUMBER_TYPES
+        depth += 1
+        for k, v in items:
+            if type(v) in plain:
+                self.charge(8)
+            else:
+                v = simplify(v, depth)
+            if type(k) is not str or self.budget is not None:
+                k = self._convert_key(k)
+            result[k] = v
+        if len(result) < size:
+            result[TRUNCATED_KEY] = truncated(
+                '%d more items' % (size - len(result))
+            )
+        return result
+
+    def _can_keep_dict(self, value, depth):
+        return (len(value) <= self.max_items and
+                depth < self.max_depth and
+                self._plain_keys(value, len(value)) and
+                self._all_plain(value.values(), len(value)))
+
+    def convert_dict(self, value, depth):
+        if self._can_keep_dict(value, depth):
+            return value
+        if not self._enter(value, depth):
+            return self._stop(value, depth)
+        try:
+            return self._convert_items(iter(value.items()), len(value), depth)
+        finally:
+            self.active.discard(id(value))
+
+    def convert_list(self, value, depth):
+        if (len(value) <= self.max_items and
+                depth < self.max_depth and
+                self._all_plain(value, len(value))):
+            return value
+        if not self._enter(value, depth):
+            return self._stop(value, depth)
+        try:
+            items = value
+            if len(value) > self.max_items:
+                items = value[:self.max_items]
+            simplify = self.simplify
+            result = [simplify(v, depth + 1) for v in items]
+            if len(result) < len(value):
+                result.append(truncated(
+                    '%d more items' % (len(value) - len(result))
+                ))
+            return result
+        finally:
+            self.active.discard(id(value))
+
+    def convert_wrapper(self, value, depth):
+        converted = self.simplify(value.value, depth)
+        return value.wrap(converted, self.budget is None or self.budget > 0)
+
+    def convert_frame(self, value, depth):
+        # The same values traceback.extract_tb() returns under python 2.
+        return self.simplify(
+            [value.filename, value.lineno, value.name, value.line],
+            depth,
+        )
+
+    def convert_traceback(self, value, depth):
+        return self.simplify(traceback.extract_tb(value), depth)
+
+    def convert_object(self, value, depth):
+        if not self._enter(value, depth):
+            return self._stop(value, depth)
+        try:
+            data = _object_data(value)
+            if isinstance(data, dict):
+                if self._can_keep_dict(data, depth):
+                    return data
+                return self._convert_items(iter(data.items()), len(data),
+                                           depth)
+            return self.keep_string(data, depth)
+        finally:
+            self.active.discard(id(value))
+
+
+class Encoder(object):
+    """Convert values to JSON in one pass over the data.
+
+    Values are first reduced to dicts, lists, strings, numbers, None
+    and booleans by simplify(), which looks up how to convert each
+    type only once. Cycles are replaced by a marker as they are found.
+
+    The optional limits keep large values from making huge messages:
+    max_depth limits the nesting of containers and objects,
+    max_items the number of items kept from each container,
+    max_string_length the characters kept from each string, and
+    max_bytes is an approximate limit on the encoded size. Data left
+    out is replaced by a marker starting with TRUNCATED_PREFIX that
+    describes what was removed. Use None for no limit.
+    """
+
+    def __init__(self, max_depth=None, max_items=None,
+                 max_string_length=None, max_bytes=None):
+        self.max_depth = max_depth
+        self.max_items = max_items
+        self.max_string_length = max_string_length
+        self.max_bytes = max_bytes
+
+    @property
+    def has_limits(self):
+        return any(limit is not None for limit in (
+            self.max_depth, self.max_items,
+            self.max_string_length, self.max_bytes,
+        ))
+
+    def _walk(self):
+        return _Walk(self.max_depth, self.max_items,
+                     self.max_string_length, self.max_bytes)
+
+    def simplify(self, data):
+        return self._walk().simplify(data, 0)
+
+    def simplify_all(self, values):
+        """Simplify several values, sharing one max_bytes limit.
+        """
+        walk = self._walk()
+        return [walk.simplify(v, 0) for v in values]
+
+    def dumps(self, data):
+        # simplify() removes cycles, so json does not need to look
+        # for them.
+        return json.dumps(self.simplify(data), check_circular=False)
+
+
+_ENCODER = Encoder()
+
+
+def is_object(value):
+    """Return whether value is encoded from its attributes.
+
+    This is true for instances of classes other than the containers,
+    strings, numbers, and other types with special handling.
+    """
+    return _Walk.handler_for(type(value)) is _Walk.convert_object
+
+
+def simplify(data):
+    """Return data reduced to values json and msgpack can encode.
+    """
+    return _ENCODER.simplify(data)
 
 
 def dumps(data):
-    data = _scrub(data)
-    try:
-        return json.dumps(data, default=_json_special_types)
-    except ValueError:
-        # Circular reference
-        # LOG.exception('Could not dump type(%s) %r' % (type(data), data))
-        if isinstance(data, list):
-            return json.dumps([repr(v) for v in data])
-        elif isinstance(data, dict):
-            # LOG.debug('trying with repr')
-            return json.dumps({k: repr(v) for k, v in data.items()})
-        raise
+    return _ENCODER.dumps(data)
@@ -1,9 +1,10 @@
-import json
 import logging
 
 import six
 import zmq
 
+from smiley import wire
+
 LOG = logging.getLogger(__name__)
 
 
@@ -16,17 +17,46 @@ class Listener(object):
         self.sub_socket.identity = six.b('subscriber')
         self.poller = zmq.Poller()
         self.poller.register(self.sub_socket, zmq.POLLIN)
+        # Publishers that do not announce a codec send JSON.
+        self.codec = wire.JSON
+        self._interned = False
+        self._symbols = {}
+
+    def _decode(self, msg_type, msg_data):
+        if msg_type == 'start_run':
+            data = wire.JSON.decode(msg_data)
+            self.codec = wire.get_codec(data.get('codec', wire.JSON.name))
+            LOG.debug('using %s codec', self.codec.name)
+            self._interned = data.get('interned', False)
+            self._symbols = {}
+            return data
+        data = self.codec.decode(msg_data)
+        if self._interned and isinstance(data, dict):
+            self._resolve_symbols(data)
+        return data
+
+    def _resolve_symbols(self, data):
+        "Replace the symbol ids in a trace message with their strings."
+        for symbol_id, value in data.pop('symbols', None) or []:
+            self._symbols[symbol_id] = value
+        for field in wire.SYMBOL_FIELDS:
+            value = data.get(field)
+            if isinstance(value, six.integer_types):
+                data[field] = self._symbols.get(value, value)
 
     def poll_once(self, timeout=1000):
         for sock, reason in self.poller.poll(timeout):
             if reason != zmq.POLLIN:
                 return
             # Receiving data on the subscriber socket
-            msg_type, msg_data = self.sub_socket.recv_multipart()
-            yield [
-                msg_type.decode('utf-8'),
-                json.loads(msg_data.decode('utf-8')),
-            ]
+            frames = self.sub_socket.recv_multipart()
+            msg_type = frames[0].decode('utf-8')
+            if msg_type == wire.BATCH:
+                for i in range(1, len(frames) - 1, 2):
+                    msg_type = frames[i].decode('utf-8')
+                    yield [msg_type, self._decode(msg_type, frames[i + 1])]
+            else:
+                yield [msg_type, self._decode(msg_type, frames[1])]
 
     def poll_forever(self, callback, timeout=1000):
         LOG.debug('Waiting for incoming data')
@@ -1,5 +1,8 @@
 import codecs
+import collections
+import itertools
 import logging
+import operator
 import os
 import six
 from six.moves import queue
@@ -11,6 +14,21 @@ from smiley import processor
 LOG = logging.getLogger(__name__)
 
 
+def _histogram_bucket(n):
+    "Return the smallest power of 2 that is not less than n."
+    bucket = 1
+    while bucket < n:
+        bucket <<= 1
+    return bucket
+
+
+def _format_histogram(counts):
+    return ', '.join(
+        '<=%d: %d' % (bucket, counts[bucket])
+        for bucket in sorted(counts)
+    )
+
+
 class LocalPublisher(processor.EventProcessor):
     """Publish trace data to a database locally.
 
@@ -20,14 +38,49 @@ class LocalPublisher(processor.EventProcessor):
     performance of multi-threaded apps, but I expect it to be less
     than having each thread open and close a database handle on
     demand.
+
+    Trace events are committed in batches of up to commit_every
+    events, or every commit_interval seconds, and whenever the queue
+    runs dry so a slow program does not leave data uncommitted.
+
+    The background thread drains everything waiting in the queue at
+    once and passes runs of the same type of operation to the
+    database together, so a busy program is recorded with a few large
+    inserts instead of one statement per event.
+
+    If max_queue_size is set, the overflow_policy controls what
+    happens to a trace event when the queue is full. 'block' makes the
+    traced thread wait for room. 'drop-lines' discards 'line' events,
+    but still waits to add other events so calls, returns, and
+    exceptions are never lost. 'sample' is like 'drop-lines', except
+    that it keeps one out of every overflow_sample_rate 'line' events
+    that do not fit. The number of discarded events is saved with the
+    run.
     """
 
-    def __init__(self, database):
+    # The most items to take from the queue before writing them.
+    MAX_BATCH_SIZE = 5000
+
+    OVERFLOW_POLICIES = ('block', 'drop-lines', 'sample')
+
+    def __init__(self, database, commit_every=1000, commit_interval=1.0,
+                 max_queue_size=0, overflow_policy='block',
+                 overflow_sample_rate=10):
+        if overflow_policy not in self.OVERFLOW_POLICIES:
+            raise ValueError('unknown overflow policy %r' % overflow_policy)
         self._reset_cache()
-        self._q = queue.Queue()
+        self._overflow_policy = overflow_policy
+        self._overflow_sample_rate = max(overflow_sample_rate, 1)
+        self._overflow_lock = threading.Lock()
+        self._reset_overflow_counters()
+        self._q = queue.Queue(max_queue_size)
+        self._db_args = (database, self._q, commit_every, commit_interval)
+        self._start_thread()
+
+    def _start_thread(self):
         self._db_thread = threading.Thread(
             target=self._process_data,
-            args=(database, self._q,)
+            args=self._db_args,
         )
         # We want to kill the thread cleanly, but if something goes
         # wrong trying to start the program we are tracing we don't
@@ -36,19 +89,74 @@ class LocalPublisher(processor.EventProcessor):
         self._db_thread.setDaemon(True)
         self._db_thread.start()
 
-    def _process_data(self, database, q):
-        the_db = db.DB(database)
-        while True:
-            next_data = q.get()
-            if next_data is None:
+    def _process_data(self, database, q, commit_every, commit_interval):
+        the_db = db.DB(
+            database,
+            commit_every=commit_every,
+            commit_interval=commit_interval,
+        )
+        self.queue_depths = collections.Counter()
+        self.batch_sizes = collections.Counter()
+        done = False
+        while not done:
+            batch = self._get_batch(q)
+            if batch[-1] is None:
+                done = True
+                batch.pop()
+            for op, items in itertools.groupby(batch,
+                                               operator.itemgetter(0)):
+                self._dispatch_many(the_db, op, list(items))
+            if q.empty() or done:
+                the_db.flush()
+            for i in range(len(batch)):
                 q.task_done()
+        # Acknowledge the sentinel last, so _stop() does not return
+        # until everything has been written.
+        q.task_done()
+        LOG.debug('queue depth histogram: %s',
+                  _format_histogram(self.queue_depths))
+        LOG.debug('batch size histogram: %s',
+                  _format_histogram(self.batch_sizes))
+        return
+
+    def _get_batch(self, q):
+        """Wait for data, then take everything else already queued.
+
+        The batch ends early at the sentinel value used to stop the
+        thread, so the sentinel is always the last item.
+        """
+        batch = [q.get()]
+        self.queue_depths[_histogram_bucket(q.qsize() + 1)] += 1
+        while batch[-1] is not None and len(batch) < self.MAX_BATCH_SIZE:
+            try:
+                batch.append(q.get_nowait())
+            except queue.Empty:
                 break
+        self.batch_sizes[_histogram_bucket(len(batch))] += 1
+        return batch
+
+    def _dispatch_many(self, the_db, op, items):
+        if op == 'trace':
+            bulk = the_db.trace_many
+        elif op == 'file':
+            bulk = the_db.cache_files_for_run
+        else:
+            bulk = None
+        if bulk is not None:
+            try:
+                bulk([data for op, data in items])
+                return
+            except Exception:
+                # Only this batch was rolled back, so retrying its
+                # items one at a time loses just the bad ones.
+                LOG.exception('error processing %d %r items in bulk, '
+                              'retrying one at a time',
+                              len(items), op)
+        for next_data in items:
             try:
                 self._dispatch_one(the_db, next_data)
-            except:
+            except Exception:
                 LOG.exception('error processing %r', next_data)
-            q.task_done()
-        return
 
     def _dispatch_one(self, the_db, next_data):
         op, data = next_data
@@ -66,24 +174,61 @@ class LocalPublisher(processor.EventProcessor):
     def _reset_cache(self):
         self._cached_files = set()
 
+    def _reset_overflow_counters(self):
+        self._overflow_events = 0
+        self._dropped_events = 0
+
+    def _put_trace(self, event, item):
+        "Queue a trace event, returning False if it was dropped."
+        if self._overflow_policy == 'block' or event != 'line':
+            self._q.put(item)
+            return True
+        try:
+            self._q.put_nowait(item)
+            return True
+        except queue.Full:
+            pass
+        with self._overflow_lock:
+            keep = (
+                self._overflow_policy == 'sample' and
+                self._overflow_events % self._overflow_sample_rate == 0
+            )
+            self._overflow_events += 1
+            if not keep:
+                self._dropped_events += 1
+        if keep:
+            self._q.put(item)
+        return keep
+
     def _stop(self):
         self._q.put(None)
         self._q.join()
         self._db_thread.join()
 
-    def start_run(self, run_id, cwd, description, start_time):
+    def start_run(self, run_id, cwd, description, start_time,
+                  sampled=False):
         """Called when a 'start_run' event is seen.
         """
+        # end_run() stops the thread writing to the database, so
+        # start a new one if this publisher is reused for another run.
+        if not self._db_thread.is_alive():
+            self._start_thread()
         self._reset_cache()
+        self._reset_overflow_counters()
         self._cwd = cwd
         if self._cwd:
             self._cwd = self._cwd.rstrip(os.sep) + os.sep
-        self._q.put(('start', (run_id, cwd, description, start_time)))
+        self._q.put(('start', (run_id, cwd, description, start_time,
+                               sampled)))
 
     def end_run(self, run_id, end_time, message, traceback, stats):
         """Called when an 'end_run' event is seen.
         """
-        self._q.put(('end', (run_id, end_time, message, traceback, stats)))
+        if self._dropped_events:
+            LOG.warning('dropped %d trace events because the queue was full',
+                        self._dropped_events)
+        self._q.put(('end', (run_id, end_time, message, traceback, stats,
+                             self._dropped_events)))
         self._stop()
 
     def _get_file_contents(self, filename):
@@ -101,8 +246,12 @@ class LocalPublisher(processor.EventProcessor):
               trace_arg, local_vars,
               timestamp):
         """Called when any other event type is seen.
+
+        Returns False if the event was dropped because the queue was
+        full.
         """
-        self._q.put(
+        queued = self._put_trace(
+            event,
             ('trace',
              (run_id, thread_id, call_id, event, func_name, line_no,
               filename, trace_arg, local_vars, timestamp)))
@@ -112,3 +261,4 @@ class LocalPublisher(processor.EventProcessor):
             # Track the files we have cached so we do not need to
             # re-cache them for the same run.
             self._cached_files.add(filename)
+        return queued
@@ -0,0 +1,160 @@
+"""Send local variables as changes from the previous event in a call.
+
+The tracer sends the full set of local variables with the first event
+of each call. Later events in the same call only include the
+variables that were added or changed, and the names of variables that
+were removed. Those partial values are wrapped in a dictionary with
+the single key DELTA_KEY, which cannot collide with a real variable
+name because the tracer skips names starting and ending with '__'.
+
+Every FULL_EVERY events the full set is sent again, so a reader
+starting in the middle of a long call only has to go back to the
+latest full set instead of the start of the call.
+
+Readers use a Rebuilder to turn the deltas back into full sets of
+variables.
+"""
+
+import six
+
+DELTA_KEY = '__smiley_delta__'
+
+# The start of the JSON text of every delta.
+ENCODED_DELTA_PREFIX = '{"%s"' % DELTA_KEY
+
+# Number of events in a call between full sets of variables.
+FULL_EVERY = 100
+
+# Values of these types cannot change without being replaced, so they
+# can be compared directly instead of by their serialized form.
+_IMMUTABLE_TYPES = (
+    type(None), bool, float, complex,
+    six.binary_type, six.text_type,
+) + six.integer_types
+
+
+def make_delta(changed, removed):
+    return {DELTA_KEY: {'changed': changed, 'removed': removed}}
+
+
+def is_delta(local_vars):
+    return isinstance(local_vars, dict) and DELTA_KEY in local_vars
+
+
+def is_encoded_delta(text):
+    """Return whether the JSON text is an encoded delta.
+
+    A delta is a dictionary with only one key, so the key is always
+    first.
+    """
+    return text is not None and text.startswith(ENCODED_DELTA_PREFIX)
+
+
+def apply_delta(base, local_vars):
+    """Return the full variables after applying local_vars to base.
+
+    If local_vars is not a delta it is returned unchanged.
+    """
+    if not is_delta(local_vars):
+        return local_vars
+    delta = local_vars[DELTA_KEY]
+    result = dict(base or {})
+    for name in delta['removed']:
+        result.pop(name, None)
+    result.update(delta['changed'])
+    return result
+
+
+class Differ(object):
+    """Remember the variables sent for each active call.
+
+    The signature function is used to detect changes inside mutable
+    values, which compare equal to themselves even after they are
+    modified. It returns a value that only compares equal for equal
+    contents, or None if the value cannot be compared cheaply, and is
+    called for every variable of every event, so it must be fast.
+    """
+
+    def __init__(self, signature, full_every=FULL_EVERY):
+        self._make_signature = signature
+        self._full_every = full_every
+        # call_id -> (signatures, events sent since the last full set)
+        self._snapshots = {}
+
+    def _signature(self, value):
+        if isinstance(value, _IMMUTABLE_TYPES):
+            return (type(value), value)
+        try:
+            signature = self._make_signature(value)
+        except Exception:
+            signature = None
+        if signature is None:
+            # Something we can't compare, so always send it.
+            return object()
+        return signature
+
+    def diff(self, call_id, local_vars):
+        """Return the variables to send for an event in the call.
+        """
+        signatures = {
+            name: self._signature(value)
+            for name, value in local_vars.items()
+        }
+        previous, count = self._snapshots.get(call_id, (None, 0))
+        if previous is None or count + 1 >= self._full_every:
+            self._snapshots[call_id] = (signatures, 0)
+            return local_vars
+        self._snapshots[call_id] = (signatures, count + 1)
+        changed = {
+            name: local_vars[name]
+            for name, sig in signatures.items()
+            if name not in previous or previous[name] != sig
+        }
+        removed = [name for name in previous if name not in signatures]
+        return make_delta(changed, removed)
+
+    def forget(self, call_id):
+        "Stop tracking a call that has returned."
+        self._snapshots.pop(call_id, None)
+
+
+class Rebuilder(object):
+    """Rebuild full local variables from a sequence of events.
+    """
+
+    def __init__(self):
+        # call_id -> full variables, or an object with a local_vars
+        # attribute holding them.
+        self._current = {}
+
+    def _base(self, call_id):
+        base = self._current.get(call_id)
+        if base is not None and not isinstance(base, dict):
+            base = self._current[call_id] = base.local_vars
+        return base
+
+    def remember(self, call_id, event, source):
+        """Record an event with a full set of variables.
+
+        The variables are only read from source.local_vars if a later
+        event in the call needs them.
+        """
+        if event == 'return':
+            self._current.pop(call_id, None)
+        else:
+            self._current[call_id] = source
+
+    def has_call(self, call_id):
+        "Return whether the variables of a call are known."
+        return call_id in self._current
+
+    def rebuild(self, call_id, event, local_vars):
+        if not is_delta(local_vars):
+            self.remember(call_id, event, local_vars)
+            return local_vars
+        full = apply_delta(self._base(call_id), local_vars)
+        if event == 'return':
+            self._current.pop(call_id, None)
+        else:
+            self._current[call_id] = full
+        return full
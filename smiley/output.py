@@ -8,7 +8,9 @@ import pprint
 import prettytable
 import six
 
+from smiley import localsdiff
 from smiley import processor
+from smiley import valuecache
 
 
 def format_dictionary(d):
@@ -49,6 +51,8 @@ class OutputFormatter(processor.EventProcessor):
 
     def __init__(self, line_source):
         self._line_source = line_source
+        self._rebuilder = localsdiff.Rebuilder()
+        self._values = valuecache.ValueTable()
 
     def _get_display_filename(self, filename):
         "Truncate the filename for display."
@@ -56,14 +60,19 @@ class OutputFormatter(processor.EventProcessor):
             return filename[len(self._cwd):]
         return filename
 
-    def start_run(self, run_id, cwd, description, start_time):
+    def start_run(self, run_id, cwd, description, start_time,
+                  sampled=False):
         self.log.info(
             'Starting new run: %s',
             ' '.join(description)
         )
+        if sampled:
+            self.log.info('Only some calls or stacks were recorded')
         self._cwd = cwd
         if self._cwd:
             self._cwd = self._cwd.rstrip(os.sep) + os.sep
+        self._rebuilder = localsdiff.Rebuilder()
+        self._values = valuecache.ValueTable()
 
     def end_run(self, run_id, end_time, message, traceback, stats):
         self.log.info('Finished run')
@@ -74,6 +83,8 @@ class OutputFormatter(processor.EventProcessor):
               func_name, line_no, filename,
               trace_arg, local_vars,
               timestamp):
+        local_vars = self._values.resolve(local_vars)
+        local_vars = self._rebuilder.rebuild(call_id, event, local_vars)
         line = self._line_source(
             filename,
             line_no,
@@ -3,6 +3,7 @@ for copies of files stored in the db, with pygments styles applied.
 """
 import logging
 
+import pygments
 from pygments import highlight
 from pygments.formatters import HtmlFormatter
 from pygments.lexers import guess_lexer_for_filename
@@ -20,6 +21,29 @@ def apply_style(filename, body, linenos=True, theme='default'):
     return highlight(body, lexer, formatter)
 
 
+def _style_name(linenos):
+    # Include the version, since the output may change when pygments
+    # is upgraded.
+    return 'pygments-%s linenos=%s' % (pygments.__version__, linenos)
+
+
+def get_styled_file(db, signature, filename, body, linenos=True):
+    """Return apply_style() output for a file cached in the database.
+
+    The result is saved with the file, and reused by later calls for
+    any run including the same file.
+    """
+    if not signature:
+        return apply_style(filename, body, linenos=linenos)
+    style = _style_name(linenos)
+    styled_body = db.get_styled_file(signature, style)
+    if styled_body is None:
+        LOG.debug('styling %s', filename)
+        styled_body = apply_style(filename, body, linenos=linenos)
+        db.save_styled_file(signature, style, styled_body)
+    return styled_body
+
+
 def syntax(body):
     """Filter for applying syntax highlighting to blocks from templates."""
     return apply_style('unknown.py', body, linenos=False)
@@ -38,8 +62,19 @@ class StyledLineCache(object):
 
     def _init_file(self, filename):
         if filename not in self._files:
-            body = self._db.get_cached_file(self._run_id, filename)
-            styled_body = apply_style(filename, body, linenos=False)
+            # Look for saved output before reading the body, so it
+            # is only read when it needs to be styled.
+            style = _style_name(False)
+            signature = self._db.get_file_signature(self._run_id, filename)
+            styled_body = None
+            if signature:
+                styled_body = self._db.get_styled_file(signature, style)
+            if styled_body is None:
+                LOG.debug('styling %s', filename)
+                body = self._db.get_cached_file(self._run_id, filename)
+                styled_body = apply_style(filename, body, linenos=False)
+                if signature:
+                    self._db.save_styled_file(signature, style, styled_body)
             start = len(self.EXPECTED_PREFIX)
             end = -1 * (len(self.EXPECTED_SUFFIX) + 1)
             middle_body = styled_body[start:end].rstrip('\n')
@@ -1,10 +1,13 @@
 import logging
 
-from smiley import db
 from smiley import util
 
 LOG = logging.getLogger(__name__)
 
+# The trace fields collapse_trace() looks at, for passes over the
+# trace that only need to find where the items start.
+_COLLAPSE_COLUMNS = ('thread_id', 'event', 'line_no', 'local_vars')
+
 
 def collapse_trace(trace_iter):
     """Combine closely related trace items.
@@ -36,37 +39,82 @@ def collapse_trace(trace_iter):
             accumulate = None
 
         if not accumulate:
-            accumulate = db.Trace(
-                id=t.id,
-                run_id=t.run_id,
-                thread_id=t.thread_id,
-                call_id=t.call_id,
-                event=t.event,
-                filename=t.filename,
-                line_no=(t.line_no, t.line_no),
-                func_name=t.func_name,
-                trace_arg=t.trace_arg,
-                local_vars=t.local_vars,
-                timestamp=t.timestamp,
-            )
+            # Use _replace() to leave the other values encoded until
+            # they are needed.
+            accumulate = t._replace(line_no=(t.line_no, t.line_no))
 
         else:
             # Combine consecutive line events by updating the line_no
             # range
-            accumulate = db.Trace(
-                id=accumulate.id,
-                run_id=accumulate.run_id,
+            accumulate = accumulate._replace(
                 thread_id=t.thread_id,
-                call_id=accumulate.call_id,
-                event=accumulate.event,
-                filename=accumulate.filename,
                 line_no=(accumulate.line_no[0], t.line_no),
-                func_name=accumulate.func_name,
-                trace_arg=accumulate.trace_arg,
                 # replace in case variables were added
                 local_vars=t.local_vars,
-                timestamp=accumulate.timestamp,
             )
 
     if accumulate:
         yield accumulate
+
+
+def collapsed_trace_size(db, run_id, thread_id=None):
+    """Return the number of items collapse_trace() makes for a run.
+
+    For a run that has ended, the first time this is called the
+    start of each item is saved, so collapsed_trace_range() can read
+    any of them without collapsing the whole trace again. Returns None
+    for a run that is still going.
+    """
+    num_items = db.get_collapsed_trace_size(run_id, thread_id)
+    if num_items:
+        return num_items
+    if db.get_run(run_id).end_time is None:
+        return None
+    LOG.debug('indexing collapsed trace for %s %s', run_id, thread_id)
+    first_ids = [
+        t.id
+        for t in collapse_trace(
+            db.get_trace(run_id, thread_id, columns=_COLLAPSE_COLUMNS)
+        )
+    ]
+    db.save_collapsed_trace(run_id, thread_id, first_ids)
+    return len(first_ids)
+
+
+def collapsed_trace_range(db, run_id, thread_id, start, end):
+    """Return the collapsed items from start to end of a run.
+
+    collapsed_trace_size() must have been called first to save the
+    index for the run.
+    """
+    first_id, stop_id = db.get_collapsed_trace_bounds(
+        run_id, thread_id, start, end,
+    )
+    if first_id is None:
+        return []
+    return list(collapse_trace(db.get_trace(
+        run_id, thread_id,
+        after_id=first_id - 1,
+        before_id=stop_id,
+    )))
+
+
+def count_collapsed_trace(db, run_id, thread_id=None):
+    """Count the collapse_trace() items of a run without keeping them.
+
+    Returns the number of items and the id to pass as before_id to
+    get_trace() to read the same events again, even if the run is
+    still adding to the trace.
+    """
+    last_id = [None]
+
+    def remember_ids(events):
+        for t in events:
+            last_id[0] = t.id
+            yield t
+
+    events = db.get_trace(run_id, thread_id, columns=_COLLAPSE_COLUMNS)
+    num_items = sum(1 for t in collapse_trace(remember_ids(events)))
+    if last_id[0] is None:
+        return num_items, None
+    return num_items, last_id[0] + 1
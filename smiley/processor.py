@@ -10,8 +10,12 @@ class EventProcessor(object):
     __metaclass__ = abc.ABCMeta
 
     @abc.abstractmethod
-    def start_run(self, run_id, cwd, description, start_time):
+    def start_run(self, run_id, cwd, description, start_time,
+                  sampled=False):
         """Called when a 'start_run' event is seen.
+
+        sampled is true if the tracer only records some of the calls
+        or stacks of the program.
         """
 
     @abc.abstractmethod
@@ -25,4 +29,7 @@ class EventProcessor(object):
               trace_arg, local_vars,
               timestamp):
         """Called when any other event type is seen.
+
+        Returns False if the event was discarded instead of being
+        recorded.
         """
@@ -1,59 +1,200 @@
 import logging
 import sys
+import threading
+import time
 
 import six
 import zmq
 
-from smiley import jsonutil
 from smiley import processor
+from smiley import wire
 
 LOG = logging.getLogger(__name__)
 
 
+class _Batch(object):
+    """Trace messages waiting to be sent for one thread.
+
+    Batches are only added to by their own thread, but may be sent
+    by any thread flushing all of them.
+    """
+
+    def __init__(self):
+        self.frames = []
+        self.size = 0
+        self.started = None
+        self._lock = threading.Lock()
+
+    def add(self, msg_type, payload):
+        with self._lock:
+            if not self.frames:
+                self.started = time.time()
+            self.frames.append(msg_type.encode('utf-8'))
+            self.frames.append(payload)
+            self.size += len(payload)
+
+    def __len__(self):
+        return len(self.frames) // 2
+
+    def take(self):
+        "Return the frames of the waiting messages and empty the batch."
+        with self._lock:
+            frames = self.frames
+            self.frames = []
+            self.size = 0
+        return frames
+
+
 class Publisher(processor.EventProcessor):
+    """Send events to a Listener over a ZeroMQ socket.
+
+    By default each trace event is sent as its own message. If
+    batch_size is more than 0, each thread collects trace events and
+    sends them together as one 'batch' message when it has batch_size
+    events, batch_bytes bytes of encoded data, or holds an event
+    older than batch_interval seconds. During a run a background
+    thread sends the batches that have waited too long, so threads
+    that stop producing events do not hold them until 'end_run',
+    and all batches are sent before 'end_run'.
+    """
 
-    def __init__(self, endpoint, high_water_mark=10000):
+    def __init__(self, endpoint, high_water_mark=10000, codec='json',
+                 batch_size=0, batch_bytes=1024 * 1024, batch_interval=0.5):
+        self.codec = wire.get_codec(codec)
         self.context = zmq.Context()
         self.pub_socket = self.context.socket(zmq.PUSH)
         self.pub_socket.bind(endpoint)
         self.pub_socket.identity = six.b('publisher')
         self.pub_socket.hwm = high_water_mark
+        self.batch_size = batch_size
+        self.batch_bytes = batch_bytes
+        self.batch_interval = batch_interval
+        # The socket is shared by all threads. Symbols are assigned
+        # and sent under the same lock, so no thread can send an id
+        # before the message defining it.
+        self._lock = threading.RLock()
+        self._symbols = {}
+        self._local = threading.local()
+        self._batches = []
+        self._flusher = None
+        self._stopping = threading.Event()
+
+    def _send(self, msg_type, data, codec=None):
+        self._send_frames([
+            msg_type.encode('utf-8'),
+            (codec or self.codec).encode(data),
+        ])
 
-    def _send(self, msg_type, data):
+    def _send_frames(self, msg):
         # FIXME: Need to replace the thread trace func, too?
         # FIXME: Need to disable the profiler?
         old_trace = None
+        with self._lock:
+            try:
+                old_trace = sys.gettrace()
+                sys.settrace(None)
+                LOG.debug('SENDING: %r', msg)
+                self.pub_socket.send_multipart(msg)
+            finally:
+                if old_trace is not None:
+                    sys.settrace(old_trace)
+
+    def _get_batch(self):
         try:
-            old_trace = sys.gettrace()
-            sys.settrace(None)
-            msg = [
-                m.encode('utf-8')
-                for m in [
-                    msg_type,
-                    jsonutil.dumps(data),
-                ]
-            ]
-            LOG.debug('SENDING: %r', msg)
-            self.pub_socket.send_multipart(msg)
-        finally:
-            if old_trace is not None:
-                sys.settrace(old_trace)
-
-    def start_run(self, run_id, cwd, description, start_time):
+            return self._local.batch
+        except AttributeError:
+            batch = self._local.batch = _Batch()
+            with self._lock:
+                self._batches.append(batch)
+            return batch
+
+    def _add_to_batch(self, msg_type, data, send=False):
+        batch = self._get_batch()
+        batch.add(msg_type, self.codec.encode(data))
+        if (send
+                or len(batch) >= self.batch_size
+                or batch.size >= self.batch_bytes
+                or time.time() - batch.started >= self.batch_interval):
+            self._send_batch(batch)
+
+    def _send_batch(self, batch):
+        # Hold the lock from take() to the send, so two parts of the
+        # same batch cannot be sent out of order.
+        with self._lock:
+            frames = batch.take()
+            if frames:
+                self._send_frames([wire.BATCH.encode('utf-8')] + frames)
+
+    def flush(self, max_age=None):
+        """Send the trace events waiting in every thread's batch.
+
+        If max_age is set, only send the batches holding events at
+        least that many seconds old.
+        """
+        with self._lock:
+            now = time.time()
+            for batch in self._batches:
+                if (max_age is not None and
+                        (not batch.frames or now - batch.started < max_age)):
+                    continue
+                self._send_batch(batch)
+
+    def _flush_old_batches(self):
+        # The flusher's own calls are never interesting.
+        sys.settrace(None)
+        while not self._stopping.wait(self.batch_interval):
+            try:
+                self.flush(max_age=self.batch_interval)
+            except Exception:
+                LOG.exception('failed to send batches')
+
+    def _start_flusher(self):
+        if (not self.batch_size or not self.batch_interval or
+                self._flusher is not None):
+            return
+        self._stopping.clear()
+        self._flusher = threading.Thread(
+            target=self._flush_old_batches,
+            name='smiley-flusher',
+        )
+        # Do not keep a program from exiting if the run is not ended.
+        self._flusher.daemon = True
+        self._flusher.start()
+
+    def _stop_flusher(self):
+        if self._flusher is None:
+            return
+        self._stopping.set()
+        self._flusher.join()
+        self._flusher = None
+
+    def start_run(self, run_id, cwd, description, start_time,
+                  sampled=False):
         """Called when a 'start_run' event is seen.
         """
+        self.flush()
+        self._symbols = {}
+        self._start_flusher()
+        # Always use JSON here, so any listener can read the name of
+        # the codec used for the rest of the run.
         self._send(
             'start_run',
             {'run_id': run_id,
              'cwd': cwd,
              'command_line': description,
              'timestamp': start_time,
+             'codec': self.codec.name,
+             'interned': self.codec.interns_symbols,
+             'sampled': sampled,
              },
+            codec=wire.JSON,
         )
 
     def end_run(self, run_id, end_time, message, traceback, stats):
         """Called when an 'end_run' event is seen.
         """
+        self._stop_flusher()
+        self.flush()
         self._send(
             'end_run',
             {'run_id': run_id,
@@ -70,15 +211,49 @@ class Publisher(processor.EventProcessor):
               timestamp):
         """Called when any other event type is seen.
         """
-        self._send(
-            event,
-            {'func_name': func_name,
-             'line_no': line_no,
-             'filename': filename,
-             'arg': trace_arg,
-             'local_vars': local_vars,
-             'timestamp': timestamp,
-             'run_id': run_id,
-             'call_id': call_id,
-             'thread_id': thread_id,
-             })
+        data = {'func_name': func_name,
+                'line_no': line_no,
+                'filename': filename,
+                'arg': trace_arg,
+                'local_vars': local_vars,
+                'timestamp': timestamp,
+                'run_id': run_id,
+                'call_id': call_id,
+                'thread_id': thread_id,
+                }
+        if self.codec.interns_symbols:
+            with self._lock:
+                if self._intern_symbols(data):
+                    # Other threads may use the new ids as soon as the
+                    # lock is released, so send the definitions now.
+                    if self.batch_size:
+                        self._add_to_batch(event, data, send=True)
+                    else:
+                        self._send(event, data)
+                    return
+        if self.batch_size:
+            self._add_to_batch(event, data)
+        else:
+            self._send(event, data)
+
+    def _intern_symbols(self, data):
+        """Replace the strings in data with symbol ids.
+
+        Returns True if any of the strings had no id yet, and their
+        definitions were added to data.
+        """
+        new_symbols = []
+        for field in wire.SYMBOL_FIELDS:
+            value = data[field]
+            if value is None:
+                continue
+            try:
+                data[field] = self._symbols[value]
+            except KeyError:
+                symbol_id = self._symbols[value] = len(self._symbols) + 1
+                new_symbols.append([symbol_id, value])
+                data[field] = symbol_id
+        if new_symbols:
+            data['symbols'] = new_symbols
+            return True
+        return False
@@ -1,10 +1,18 @@
 import functools
+import hashlib
+import io
+import itertools
+import json
 import logging
+import multiprocessing
 import os
 import shutil
 
 from mako.lookup import TemplateLookup
+import pygments
+import six
 
+from smiley import db
 from smiley import db_linecache
 from smiley.presentation import pagination
 from smiley.presentation import stats
@@ -14,6 +22,22 @@ from smiley.presentation import syntax
 
 LOG = logging.getLogger(__name__)
 
+# The file in the output directory listing the pages written and a
+# hash of the inputs used to make each one.
+MANIFEST_NAME = 'smiley-manifest.json'
+
+# Change this when the way pages are built changes without a change
+# to the templates, so existing reports are rebuilt.
+MANIFEST_VERSION = 1
+
+
+def _hash_file(filename):
+    h = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        for block in iter(functools.partial(f.read, 65536), b''):
+            h.update(block)
+    return h.hexdigest()
+
 
 class Page(object):
     TEMPLATE = None
@@ -67,14 +91,16 @@ class FilesPage(Page):
 class FilePage(Page):
     TEMPLATE = 'file.html'
 
-    def __init__(self, report, file_info):
+    def __init__(self, report, signature):
         super(FilePage, self).__init__(report)
         self.context['active_section'] = 'files'
         filename, body = report.db.get_cached_file_by_id(
             report.run_id,
-            file_info.signature,
+            signature,
+        )
+        self.context['styled_body'] = syntax.get_styled_file(
+            report.db, signature, filename, body,
         )
-        self.context['styled_body'] = syntax.apply_style(filename, body)
 
 
 class StatsPage(Page):
@@ -98,20 +124,44 @@ class CallGraphPage(Page):
         self.image_filename = os.path.join(report.output_dir, 'call_graph.png')
 
     def render(self):
-        image_data = stats.generate_call_graph(self.stats_data)
-        with open(self.image_filename, 'w') as f:
-            f.write(image_data)
+        # Sampled runs are not profiled.
+        if self.stats_data is not None:
+            image_data = stats.generate_call_graph(self.stats_data)
+            with open(self.image_filename, 'wb') as f:
+                f.write(image_data)
         return super(CallGraphPage, self).render()
 
 
+# The report used to render pages in a worker process, set by
+# _init_worker().
+_worker_report = None
+
+
+def _init_worker(run_id, output_dir, db_name, title, per_page):
+    global _worker_report
+    _worker_report = HTMLReport(
+        run_id=run_id,
+        output_dir=output_dir,
+        database=db.DB(db_name),
+        title=title,
+        per_page=per_page,
+    )
+
+
+def _render_task(task):
+    return _worker_report.render_task(task)
+
+
 class HTMLReport(object):
 
-    def __init__(self, run_id, output_dir, database, title, per_page):
+    def __init__(self, run_id, output_dir, database, title, per_page,
+                 jobs=1):
         self.run_id = run_id
         self.output_dir = output_dir
         self.db = database
         self.title = title
         self.per_page = per_page
+        self.jobs = jobs
 
         self.run_details = self.db.get_run(self.run_id)
         self.line_cache = db_linecache.DBLineCache(self.db, self.run_id)
@@ -119,95 +169,274 @@ class HTMLReport(object):
         self.template_dir = os.path.join(self.report_dir, 'templates')
         self.template_lookup = TemplateLookup(directories=[self.template_dir])
         self.syntax_line_cache = syntax.StyledLineCache(self.db, self.run_id)
+        # Runs that have not ended have no index to read pages from,
+        # so their trace pages are rendered in order from one pass
+        # over the collapsed trace, read up to _trace_stop_id.
+        self._stream_trace = False
+        self._trace_stop_id = None
+        self._trace_items = None
+        self._trace_position = 0
 
     def _render_page(self, page, output_name):
         fullname = os.path.join(self.output_dir, output_name)
         outdir = os.path.dirname(fullname)
         if not os.path.exists(outdir):
             os.makedirs(outdir)
-        with open(fullname, 'w') as f:
-            LOG.info('writing %s', output_name)
-            f.write(page.render().encode('utf-8', 'replace'))
+        LOG.info('writing %s', output_name)
+        # Render before opening the file, so a failure does not leave
+        # a partial page behind.
+        body = page.render()
+        with io.open(fullname, 'w', encoding='utf-8', errors='replace') as f:
+            f.write(body)
 
     def _get_file_lines(self, filename, nums):
         start, end = nums
+        # Calls into a module are recorded on line 0 by newer versions
+        # of python.
+        start = max(start, 1)
+        end = max(end, start)
         return self.syntax_line_cache.getlines(
             filename, start, end,
             include_comments=True,
         )
 
-    def _copy_static_files(self):
-        static_dir = os.path.join(self.report_dir, 'static')
-        for in_dir in os.listdir(static_dir):
-            src = os.path.join(static_dir, in_dir)
-            dst = os.path.join(self.output_dir, in_dir)
-            if os.path.exists(dst):
-                LOG.debug('cleaning up %s', dst)
-                shutil.rmtree(dst)
-            LOG.info('copying static files: %s', in_dir)
-            shutil.copytree(src, dst)
-
-    def run(self):
-        LOG.info('writing output to %s', self.output_dir)
+    def _get_trace_page(self, start, end):
+        if self._stream_trace:
+            return self._read_trace_stream(start, end)
+        return trace.collapsed_trace_range(
+            self.db, self.run_id, None, start, end,
+        )
 
+    def _read_trace_stream(self, start, end):
+        if self._trace_items is None or start < self._trace_position:
+            self._trace_items = trace.collapse_trace(self.db.get_trace(
+                self.run_id, before_id=self._trace_stop_id,
+            ))
+            self._trace_position = 0
+        page = list(itertools.islice(
+            self._trace_items,
+            start - self._trace_position,
+            end - self._trace_position,
+        ))
+        self._trace_position = end
+        return page
+
+    def _copy_static_files(self, copied):
+        """Copy the static files that are missing or have changed.
+
+        copied maps the names of the files copied by an earlier run to
+        their hashes. Returns the same mapping for the current files.
+        """
+        static_dir = os.path.join(self.report_dir, 'static')
+        result = {}
+        for dirpath, dirnames, filenames in os.walk(static_dir):
+            for filename in sorted(filenames):
+                src = os.path.join(dirpath, filename)
+                name = os.path.relpath(src, static_dir)
+                dst = os.path.join(self.output_dir, name)
+                result[name] = _hash_file(src)
+                if copied.get(name) == result[name] and os.path.exists(dst):
+                    continue
+                LOG.info('copying static file %s', name)
+                dst_dir = os.path.dirname(dst)
+                if not os.path.exists(dst_dir):
+                    os.makedirs(dst_dir)
+                shutil.copyfile(src, dst)
+        return result
+
+    def _load_manifest(self):
+        filename = os.path.join(self.output_dir, MANIFEST_NAME)
+        try:
+            with io.open(filename, 'r', encoding='utf-8') as f:
+                manifest = json.load(f)
+        except (IOError, OSError, ValueError):
+            return {}
+        if manifest.get('version') != MANIFEST_VERSION:
+            return {}
+        return manifest
+
+    def _save_manifest(self, manifest):
+        manifest['version'] = MANIFEST_VERSION
+        filename = os.path.join(self.output_dir, MANIFEST_NAME)
+        with io.open(filename, 'w', encoding='utf-8') as f:
+            f.write(six.text_type(
+                json.dumps(manifest, sort_keys=True, indent=2)
+            ))
+
+    def _get_templates_hash(self):
+        h = hashlib.sha1()
+        h.update(pygments.__version__.encode('utf-8'))
+        for name in sorted(os.listdir(self.template_dir)):
+            h.update(name.encode('utf-8'))
+            h.update(_hash_file(os.path.join(self.template_dir, name))
+                     .encode('utf-8'))
+        return h.hexdigest()
+
+    def _get_page_hash(self, task, templates_hash):
+        """Return a hash of the inputs used to render a page.
+
+        Returns None for runs that have not ended, since their pages
+        may change each time they are rendered.
+        """
+        if self.run_details.end_time is None:
+            return None
+        inputs = [templates_hash, self.run_id,
+                  six.text_type(self.run_details.end_time),
+                  self.title, list(task)]
+        return hashlib.sha1(
+            json.dumps(inputs, sort_keys=True).encode('utf-8')
+        ).hexdigest()
+
+    def _get_tasks(self):
+        """Return descriptions of the pages to render.
+
+        Each task is a tuple of the output name, the kind of page, and
+        the values needed to build it, and can be rendered by
+        render_task() in any process.
+        """
         # Do some initial calculations to figure out how many pages we
         # have.
-        trace_data = list(
-            trace.collapse_trace(self.db.get_trace(self.run_id))
-        )
+        num_items = trace.collapsed_trace_size(self.db, self.run_id)
+        if num_items is None:
+            self._stream_trace = True
+            num_items, self._trace_stop_id = trace.count_collapsed_trace(
+                self.db, self.run_id,
+            )
         page_vals = pagination.get_pagination_values(
-            1, self.per_page, len(trace_data),
+            1, self.per_page, num_items,
         )
         last_page = page_vals['num_pages'] + 1
 
-        # Start producing output pages
-        self._render_page(
-            IndexPage(
-                report=self,
-            ),
-            'index.html',
-        )
+        tasks = [('index.html', 'index', None)]
 
         # The trace output is paginated, so we have multiple pages to
         # produce.
         for i in range(1, last_page):
             page_vals = pagination.get_pagination_values(
-                i, self.per_page, len(trace_data),
-            )
-            page_name = 'trace-%d.html' % i
-            start = page_vals['start']
-            end = page_vals['end']
-            self._render_page(
-                TracePage(
-                    report=self,
-                    trace=trace_data[start:end],
-                    pagination=page_vals,
-                    getlines=self._get_file_lines,
-                ),
-                page_name,
+                i, self.per_page, num_items,
             )
+            tasks.append(('trace-%d.html' % i, 'trace', page_vals))
 
         # The source code from the run
-        run_files = list(self.db.get_files_for_run(self.run_id))
-        self._render_page(
-            FilesPage(self, run_files),
-            'files.html',
-        )
-        for run_file in run_files:
-            self._render_page(
-                FilePage(self, run_file),
-                'file-%s.html' % run_file.signature,
+        tasks.append(('files.html', 'files', None))
+        for run_file in self.db.get_files_for_run(self.run_id):
+            tasks.append(
+                ('file-%s.html' % run_file.signature, 'file',
+                 run_file.signature),
             )
 
-        self._render_page(
-            StatsPage(self),
-            'stats.html',
-        )
-        self._render_page(
-            CallGraphPage(self),
-            'call_graph.html',
+        tasks.append(('stats.html', 'stats', None))
+        tasks.append(('call_graph.html', 'call_graph', None))
+        return tasks
+
+    def render_task(self, task):
+        """Render and write one page returned by _get_tasks().
+        """
+        output_name, kind, arg = task
+        if kind == 'index':
+            page = IndexPage(report=self)
+        elif kind == 'trace':
+            page = TracePage(
+                report=self,
+                trace=self._get_trace_page(arg['start'], arg['end']),
+                pagination=arg,
+                getlines=self._get_file_lines,
+            )
+        elif kind == 'files':
+            page = FilesPage(self, list(self.db.get_files_for_run(
+                self.run_id,
+            )))
+        elif kind == 'file':
+            page = FilePage(self, arg)
+        elif kind == 'stats':
+            page = StatsPage(self)
+        elif kind == 'call_graph':
+            page = CallGraphPage(self)
+        else:
+            raise ValueError('Unknown page type %r' % kind)
+        self._render_page(page, output_name)
+        return output_name
+
+    def _render_serial(self, tasks):
+        for task in tasks:
+            yield self.render_task(task)
+
+    def _render_parallel(self, tasks):
+        LOG.info('rendering pages with %d processes', self.jobs)
+        pool = multiprocessing.Pool(
+            self.jobs,
+            initializer=_init_worker,
+            initargs=(self.run_id, self.output_dir, self.db.name,
+                      self.title, self.per_page),
         )
+        try:
+            # The workers write each page as soon as it is rendered,
+            # and return its name.
+            for output_name in pool.imap_unordered(_render_task, tasks):
+                yield output_name
+        finally:
+            # Even if a page failed, let the other workers finish
+            # writing the pages they have started instead of killing
+            # them part way through a file.
+            pool.close()
+            pool.join()
+
+    def run(self):
+        LOG.info('writing output to %s', self.output_dir)
+        if not os.path.exists(self.output_dir):
+            os.makedirs(self.output_dir)
+
+        manifest = self._load_manifest()
+        old_pages = manifest.get('pages', {})
+        templates_hash = self._get_templates_hash()
+
+        tasks = self._get_tasks()
+        hashes = {}
+        pages = {}
+        todo = []
+        for task in tasks:
+            output_name = task[0]
+            page_hash = hashes[output_name] = self._get_page_hash(
+                task, templates_hash,
+            )
+            fullname = os.path.join(self.output_dir, output_name)
+            if (page_hash is not None and
+                    old_pages.get(output_name) == page_hash and
+                    os.path.exists(fullname)):
+                pages[output_name] = page_hash
+            else:
+                todo.append(task)
+        LOG.info('%d of %d pages unchanged', len(pages), len(tasks))
+
+        # Remove pages left by an earlier report that would not be
+        # replaced, such as trace pages past the new last page.
+        for output_name in sorted(set(old_pages) - set(hashes)):
+            fullname = os.path.join(self.output_dir, output_name)
+            if os.path.exists(fullname):
+                LOG.info('removing %s', output_name)
+                os.unlink(fullname)
+
+        parallel = self.jobs > 1 and self.db.name != ':memory:'
+        if parallel and self._stream_trace:
+            LOG.info('run has not ended, rendering pages in one process')
+            parallel = False
+        if parallel and todo:
+            rendered = self._render_parallel(todo)
+        else:
+            rendered = self._render_serial(todo)
+        try:
+            for output_name in rendered:
+                if hashes[output_name] is not None:
+                    pages[output_name] = hashes[output_name]
+        finally:
+            # Save the pages that were written, even if one failed, so
+            # they are not rendered again next time.
+            manifest['pages'] = pages
+            self._save_manifest(manifest)
 
         # Make sure we have all of the CSS and JavaScript files needed
         # by the templates.
-        self._copy_static_files()
+        manifest['static'] = self._copy_static_files(
+            manifest.get('static', {}),
+        )
+        self._save_manifest(manifest)
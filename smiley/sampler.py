@@ -0,0 +1,169 @@
+"""Record the stacks of running threads at regular intervals.
+
+A StackSampler thread looks at the frames of every other thread with
+sys._current_frames() and turns the changes since the previous sample
+into the same events the tracer sends. Frames that have appeared are
+sent as 'call' events, frames that have gone away as 'return' events,
+and the line each thread is running as a 'line' event, so the number
+of line events recorded at a location is proportional to the time
+spent there.
+
+Only frames from files and functions the tracer would trace are
+included, but triggers are not used. The values of local variables
+are not sent, because reading them from another thread is not safe.
+
+Frames are matched between samples by their id() and code object. A
+call that returns and is replaced by a new call to the same function
+between two samples looks like a single call.
+"""
+
+import logging
+import sys
+import threading
+import time
+import uuid
+
+import six
+
+LOG = logging.getLogger(__name__)
+
+
+class _Frame(object):
+    "A frame seen in the previous sample."
+
+    __slots__ = ('key', 'call_id', 'func_name', 'filename', 'line_no')
+
+    def __init__(self, key, call_id, func_name, filename, line_no):
+        self.key = key
+        self.call_id = call_id
+        self.func_name = func_name
+        self.filename = filename
+        self.line_no = line_no
+
+
+class StackSampler(threading.Thread):
+    """Send samples of the stacks of a traced program.
+
+    tracer is the Tracer deciding which files are interesting, and
+    publishing the events. interval is the number of seconds between
+    samples.
+    """
+
+    def __init__(self, tracer, interval):
+        super(StackSampler, self).__init__(name='smiley-sampler')
+        # Do not keep a program from exiting if it is not stopped.
+        self.daemon = True
+        self.tracer = tracer
+        self.interval = interval
+        self._stopping = threading.Event()
+        # thread ident -> the frames seen in the previous sample,
+        # outermost first.
+        self._stacks = {}
+
+    def stop(self):
+        "Stop sampling and send 'return' events for the frames seen."
+        self._stopping.set()
+        self.join()
+
+    def run(self):
+        # The sampler's own calls are never interesting.
+        sys.settrace(None)
+        while not self._stopping.wait(self.interval):
+            try:
+                self.sample()
+            except Exception:
+                LOG.exception('failed to sample stacks')
+        names = self._names()
+        for ident in list(self._stacks):
+            self._end_thread(ident, names.get(ident, ident), time.time())
+
+    def _names(self):
+        return {t.ident: t.name for t in threading.enumerate()}
+
+    def _interesting_frames(self, frame):
+        "Return the traced frames of a stack, outermost first."
+        lookup_file = self.tracer._lookup_file
+        match_functions = self.tracer._match_functions
+        frames = []
+        while frame is not None:
+            filename, ignore = lookup_file(frame.f_code.co_filename)
+            if not ignore and match_functions:
+                ignore = self.tracer._classify_code(frame.f_code,
+                                                    frame.f_globals)[0]
+            if not ignore:
+                frames.append((frame, filename))
+            frame = frame.f_back
+        frames.reverse()
+        return frames
+
+    def _send(self, thread_id, frame, event, timestamp):
+        self.tracer.publisher.trace(
+            run_id=self.tracer.run_id,
+            thread_id=thread_id,
+            call_id=frame.call_id,
+            event=event,
+            func_name=frame.func_name,
+            line_no=frame.line_no,
+            filename=frame.filename,
+            trace_arg=None,
+            local_vars={},
+            timestamp=timestamp,
+        )
+
+    def _end_thread(self, ident, thread_id, timestamp):
+        thread_id = six.text_type(thread_id)
+        for old in reversed(self._stacks.pop(ident)):
+            self._send(thread_id, old, 'return', timestamp)
+
+    def sample(self):
+        "Send the changes in the stacks since the last sample."
+        timestamp = time.time()
+        current = sys._current_frames()
+        names = self._names()
+        me = threading.current_thread().ident
+        for ident, frame in current.items():
+            if ident == me:
+                continue
+            self._sample_thread(ident, names.get(ident, ident),
+                                frame, timestamp)
+        for ident in list(self._stacks):
+            if ident not in current:
+                self._end_thread(ident, names.get(ident, ident), timestamp)
+
+    def _sample_thread(self, ident, thread_id, frame, timestamp):
+        thread_id = six.text_type(thread_id)
+        frames = self._interesting_frames(frame)
+        old_stack = self._stacks.get(ident, [])
+        # Find the frames still running since the last sample.
+        common = 0
+        for old, (frame, filename) in zip(old_stack, frames):
+            if old.key != (id(frame), frame.f_code):
+                break
+            common += 1
+        for old in reversed(old_stack[common:]):
+            self._send(thread_id, old, 'return', timestamp)
+        stack = old_stack[:common]
+        innermost = len(frames) - 1
+        for i, (frame, filename) in enumerate(frames):
+            if i < common:
+                entry = stack[i]
+            else:
+                entry = _Frame(
+                    (id(frame), frame.f_code),
+                    six.text_type(uuid.uuid4()),
+                    frame.f_code.co_name,
+                    filename,
+                    frame.f_code.co_firstlineno,
+                )
+                self._send(thread_id, entry, 'call', timestamp)
+                stack.append(entry)
+            # Report where each frame has moved to, and always report
+            # the innermost one, since it is the one using the time.
+            line_no = frame.f_lineno
+            if line_no != entry.line_no or i == innermost:
+                entry.line_no = line_no
+                self._send(thread_id, entry, 'line', timestamp)
+        if stack:
+            self._stacks[ident] = stack
+        else:
+            self._stacks.pop(ident, None)
@@ -10,7 +10,18 @@ create table run (
     traceback text,
 
     -- performance data
-    stats text
+    stats text,
+
+    -- trace events discarded because the tracer could not keep up
+    dropped_events int default 0,
+
+    -- 1 if the trace thread_id, filename, and func_name columns hold
+    -- ids from the symbol table instead of the strings themselves
+    interned int default 0,
+
+    -- 1 if only some of the calls or stacks of the program were
+    -- recorded
+    sampled int default 0
 );
 
 create index if not exists run_id_idx on run (id);
@@ -33,18 +44,70 @@ create table trace (
     timestamp int
 );
 
--- a view to help produce the counts of the unique locations executed by a thread
-CREATE VIEW IF NOT EXISTS location_counts AS
-SELECT run_id, thread_id, COUNT(*) as num_locations
-FROM (SELECT DISTINCT run_id, thread_id, filename,
-      line_no AS location
-      FROM trace)
-GROUP BY run_id, thread_id
-;
+-- strings repeated in trace events, stored once per run
+create table symbol (
+    run_id text not null references run(id),
+    id integer not null,
+    value text not null
+);
 
+create unique index
+    if not exists symbol_run_id_id_idx
+    on symbol(run_id, id);
 
 create index if not exists trace_run_id_idx on trace (run_id);
 
+create index
+    if not exists trace_run_id_thread_id_idx
+    on trace(run_id, thread_id, id);
+
+create index
+    if not exists trace_run_id_location_idx
+    on trace(run_id, filename, line_no);
+
+create index
+    if not exists trace_call_id_idx
+    on trace(call_id, id);
+
+-- values of local variables sent once and then referred to by id
+-- in trace.local_vars
+create table value (
+    run_id text not null references run(id),
+    id integer not null,
+    body text  -- json-encoded
+);
+
+create unique index
+    if not exists value_run_id_id_idx
+    on value(run_id, id);
+
+-- per-thread totals, computed when the run ends
+create table thread_summary (
+    run_id text not null references run(id),
+    thread_id text,  -- a symbol id, like trace.thread_id
+    start_time int,
+    end_time int,
+    num_events int,
+    num_locations int  -- unique filename and line_no pairs
+);
+
+create unique index
+    if not exists thread_summary_run_id_thread_id_idx
+    on thread_summary(run_id, thread_id);
+
+-- where each item produced by collapsing the trace of a run starts,
+-- saved the first time the collapsed trace is shown
+create table collapsed_trace (
+    run_id text not null references run(id),
+    thread_id text not null,  -- the thread name, or '' for all threads
+    position int not null,  -- the index of the item, from 0
+    first_id int not null  -- the id of the first trace event in the item
+);
+
+create unique index
+    if not exists collapsed_trace_run_id_thread_id_position_idx
+    on collapsed_trace(run_id, thread_id, position);
+
 create table file (
     signature text primary key not null,
     name text,
@@ -55,6 +118,17 @@ create unique index
     if not exists file_signature_name_idx
     on file(signature, name);
 
+-- file bodies with syntax highlighting applied
+create table styled_file (
+    signature text not null references file(signature),
+    style text not null,  -- identifies the highlighting options used
+    body text
+);
+
+create unique index
+    if not exists styled_file_signature_style_idx
+    on styled_file(signature, style);
+
 create table run_file (
     run_id text not null references run(id),
     signature text not null references file(signature)
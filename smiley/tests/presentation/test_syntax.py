@@ -0,0 +1,53 @@
+import fixtures
+import mock
+import testtools
+
+from smiley import db
+from smiley.presentation import syntax
+
+BODY = u'''# comment
+def f(a):
+    return a
+'''
+
+
+class StyledFileTest(testtools.TestCase):
+
+    def setUp(self):
+        super(StyledFileTest, self).setUp()
+        self.useFixture(fixtures.FakeLogger())
+        self.db = db.DB(':memory:')
+        self.db.start_run('12345', '/no/such/dir', ['command'], 1370436103.65)
+        self.signature = self.db.cache_file_for_run(
+            '12345', 'test.py', BODY,
+        )
+
+    def test_get_styled_file_saved(self):
+        styled = syntax.get_styled_file(
+            self.db, self.signature, 'test.py', BODY,
+        )
+        self.assertEqual(syntax.apply_style('test.py', BODY), styled)
+        with mock.patch.object(syntax, 'apply_style') as apply_style:
+            again = syntax.get_styled_file(
+                self.db, self.signature, 'test.py', BODY,
+            )
+        self.assertFalse(apply_style.called)
+        self.assertEqual(styled, again)
+
+    def test_get_styled_file_linenos_separate(self):
+        with_numbers = syntax.get_styled_file(
+            self.db, self.signature, 'test.py', BODY,
+        )
+        without_numbers = syntax.get_styled_file(
+            self.db, self.signature, 'test.py', BODY, linenos=False,
+        )
+        self.assertNotEqual(with_numbers, without_numbers)
+
+    def test_line_cache_reuses_styles(self):
+        first = syntax.StyledLineCache(self.db, '12345')
+        line = first.getline('test.py', 2)
+        self.assertIn('f', line)
+        second = syntax.StyledLineCache(self.db, '12345')
+        with mock.patch.object(syntax, 'apply_style') as apply_style:
+            self.assertEqual(line, second.getline('test.py', 2))
+        self.assertFalse(apply_style.called)
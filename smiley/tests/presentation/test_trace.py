@@ -1,3 +1,4 @@
+import fixtures
 import testtools
 
 from smiley import db
@@ -335,3 +336,103 @@ class CollapseTraceTest(testtools.TestCase):
                          {'v1': 1, 'v2': 2, 'v3': 4})
         self.assertEqual(collapsed[3].local_vars,
                          {'V1': 1, 'V2': 2})
+
+
+class CollapsedTraceIndexTest(testtools.TestCase):
+
+    def setUp(self):
+        super(CollapsedTraceIndexTest, self).setUp()
+        self.useFixture(fixtures.FakeLogger())
+        self.db = db.DB(':memory:')
+        self.db.start_run(
+            '12345',
+            '/no/such/dir',
+            ['command', 'line', 'would', 'go', 'here'],
+            1370436103.65,
+        )
+        # Each call collapses to the call item, one item for all of
+        # the lines, and the return item.
+        for call in range(5):
+            call_id = 'call%d' % call
+            thread_id = 't%d' % (call % 2)
+            events = ['call', 'line', 'line', 'line', 'return']
+            for line_no, event in enumerate(events):
+                self.db.trace(
+                    run_id='12345',
+                    thread_id=thread_id,
+                    call_id=call_id,
+                    event=event,
+                    func_name='func',
+                    line_no=line_no,
+                    filename='filename.py',
+                    trace_arg=None,
+                    local_vars={'call': call},
+                    timestamp=1370436104.65,
+                )
+
+    def _end_run(self):
+        self.db.end_run('12345', 1370436105.65, None, None, None)
+
+    def _collapse_all(self, thread_id=None):
+        return list(trace.collapse_trace(
+            self.db.get_trace('12345', thread_id)
+        ))
+
+    def test_size_running(self):
+        self.assertIsNone(trace.collapsed_trace_size(self.db, '12345'))
+        self.assertEqual(0, self.db.get_collapsed_trace_size('12345'))
+
+    def test_size(self):
+        self._end_run()
+        self.assertEqual(15, trace.collapsed_trace_size(self.db, '12345'))
+        self.assertEqual(15, self.db.get_collapsed_trace_size('12345'))
+
+    def test_size_thread(self):
+        self._end_run()
+        self.assertEqual(
+            6,
+            trace.collapsed_trace_size(self.db, '12345', 't1'),
+        )
+
+    def test_range(self):
+        self._end_run()
+        trace.collapsed_trace_size(self.db, '12345')
+        expected = self._collapse_all()
+        for start, end in [(0, 4), (4, 8), (13, 17), (15, 20)]:
+            self.assertEqual(
+                expected[start:end],
+                trace.collapsed_trace_range(self.db, '12345', None,
+                                            start, end),
+            )
+
+    def test_range_thread(self):
+        self._end_run()
+        trace.collapsed_trace_size(self.db, '12345', 't1')
+        expected = self._collapse_all('t1')
+        self.assertEqual(
+            expected[2:5],
+            trace.collapsed_trace_range(self.db, '12345', 't1', 2, 5),
+        )
+
+    def test_deleted_with_run(self):
+        self._end_run()
+        trace.collapsed_trace_size(self.db, '12345')
+        self.db.delete_run('12345')
+        self.assertEqual(0, self.db.get_collapsed_trace_size('12345'))
+
+    def test_count_running(self):
+        self.assertEqual((15, 26),
+                         trace.count_collapsed_trace(self.db, '12345'))
+        # Nothing is saved for a run that has not ended.
+        self.assertEqual(0, self.db.get_collapsed_trace_size('12345'))
+
+    def test_count_thread(self):
+        num_items, stop_id = trace.count_collapsed_trace(
+            self.db, '12345', 't1',
+        )
+        self.assertEqual(len(self._collapse_all('t1')), num_items)
+        self.assertEqual(21, stop_id)
+
+    def test_count_empty(self):
+        self.assertEqual((0, None),
+                         trace.count_collapsed_trace(self.db, '12345', 'x'))
@@ -0,0 +1,306 @@
+import os
+
+import fixtures
+import mock
+import testtools
+
+from smiley import db
+from smiley.presentation import trace
+from smiley.report import html
+
+BODY = u''.join(u'x%d = %d\n' % (i, i) for i in range(10))
+
+
+class HTMLReportTest(testtools.TestCase):
+
+    def setUp(self):
+        super(HTMLReportTest, self).setUp()
+        self.useFixture(fixtures.FakeLogger())
+        self.output_dir = self.useFixture(fixtures.TempDir()).path
+        self.db = db.DB(':memory:')
+        self.db.start_run(
+            '12345',
+            '/no/such/dir',
+            ['command', 'line', 'would', 'go', 'here'],
+            1370436103.65,
+        )
+        self.signature = self.db.cache_file_for_run(
+            '12345', 'filename.py', BODY,
+        )
+        # Each call collapses to 3 items.
+        for call in range(5):
+            for line_no, event in enumerate(['call', 'line', 'line',
+                                             'line', 'return']):
+                self.db.trace(
+                    run_id='12345',
+                    thread_id='t',
+                    call_id='call%d' % call,
+                    event=event,
+                    func_name='func',
+                    line_no=line_no,
+                    filename='filename.py',
+                    trace_arg=None,
+                    local_vars={'call': call},
+                    timestamp=1370436104.65,
+                )
+
+    def _make_report(self, jobs=1):
+        return html.HTMLReport(
+            run_id='12345',
+            output_dir=self.output_dir,
+            database=self.db,
+            title='title',
+            per_page=5,
+            jobs=jobs,
+        )
+
+    def test_tasks(self):
+        self.db.end_run('12345', 1370436105.65, None, None, None)
+        report = self._make_report()
+        tasks = report._get_tasks()
+        names = [t[0] for t in tasks]
+        self.assertEqual(
+            ['index.html', 'trace-1.html', 'trace-2.html', 'trace-3.html',
+             'files.html', 'file-%s.html' % self.signature,
+             'stats.html', 'call_graph.html'],
+            names,
+        )
+        self.assertEqual(10, tasks[3][2]['start'])
+        # The collapsed trace is read a page at a time from the index.
+        self.assertFalse(report._stream_trace)
+
+    def test_tasks_running(self):
+        report = self._make_report()
+        tasks = report._get_tasks()
+        self.assertEqual(3, len([t for t in tasks if t[1] == 'trace']))
+        self.assertTrue(report._stream_trace)
+        self.assertEqual(26, report._trace_stop_id)
+
+    def test_trace_pages_running(self):
+        expected = list(trace.collapse_trace(self.db.get_trace('12345')))
+        report = self._make_report()
+        tasks = report._get_tasks()
+        # Events added after the pages are counted are not shown.
+        self.db.trace(
+            run_id='12345', thread_id='t', call_id='call9', event='call',
+            func_name='func', line_no=1, filename='filename.py',
+            trace_arg=None, local_vars={}, timestamp=1370436104.65,
+        )
+        with mock.patch.object(self.db, 'get_trace',
+                               wraps=self.db.get_trace) as get_trace:
+            pages = [
+                report._get_trace_page(t[2]['start'], t[2]['end'])
+                for t in tasks
+                if t[1] == 'trace'
+            ]
+        # All of the pages come from one pass over the trace.
+        self.assertEqual(1, get_trace.call_count)
+        self.assertEqual([5, 5, 5], [len(p) for p in pages])
+        self.assertEqual([t.id for t in expected],
+                         [t.id for p in pages for t in p])
+
+    def test_trace_pages_running_out_of_order(self):
+        expected = list(trace.collapse_trace(self.db.get_trace('12345')))
+        report = self._make_report()
+        report._get_tasks()
+        self.assertEqual([t.id for t in expected[10:15]],
+                         [t.id for t in report._get_trace_page(10, 15)])
+        self.assertEqual([t.id for t in expected[0:5]],
+                         [t.id for t in report._get_trace_page(0, 5)])
+
+    def test_render_trace_page(self):
+        self.db.end_run('12345', 1370436105.65, None, None, None)
+        report = self._make_report()
+        tasks = report._get_tasks()
+        self.assertEqual('trace-2.html', report.render_task(tasks[2]))
+        with open(os.path.join(self.output_dir, 'trace-2.html')) as f:
+            body = f.read()
+        self.assertIn('<span class="n">x1</span>', body)
+        self.assertIn('class="active"', body)
+
+    def test_render_file_page(self):
+        report = self._make_report()
+        task = ('file-%s.html' % self.signature, 'file', self.signature)
+        report.render_task(task)
+        self.assertIsNotNone(
+            self.db.get_styled_file(self.signature,
+                                    html.syntax._style_name(True)),
+        )
+
+    def test_render_call_graph_without_stats(self):
+        self.db.end_run('12345', 1370436105.65, None, None, None)
+        report = self._make_report()
+        report.render_task(('call_graph.html', 'call_graph', None))
+        self.assertFalse(
+            os.path.exists(os.path.join(self.output_dir, 'call_graph.png'))
+        )
+
+    def test_render_unknown(self):
+        report = self._make_report()
+        self.assertRaises(ValueError, report.render_task,
+                          ('x.html', 'unknown', None))
+
+    def test_parallel_needs_database_file(self):
+        self.db.end_run('12345', 1370436105.65, None, None, None)
+        report = self._make_report(jobs=2)
+        with mock.patch.object(report, 'render_task',
+                               side_effect=lambda t: t[0]) as render_task:
+            with mock.patch.object(report, '_copy_static_files',
+                                   return_value={}):
+                with mock.patch('multiprocessing.Pool') as pool:
+                    report.run()
+        self.assertFalse(pool.called)
+        self.assertEqual(8, render_task.call_count)
+
+    def test_parallel(self):
+        filename = os.path.join(self.output_dir, 'test.db')
+        self.db = db.DB(filename)
+        self.db.start_run('12345', '/no/such/dir', ['command'],
+                          1370436103.65)
+        self.db.end_run('12345', 1370436105.65, None, None, None)
+        report = self._make_report(jobs=2)
+        with mock.patch.object(report, '_copy_static_files',
+                               return_value={}):
+            with mock.patch('multiprocessing.Pool') as pool:
+                pool.return_value.imap_unordered.return_value = []
+                report.run()
+        args, kwargs = pool.call_args
+        self.assertEqual(2, args[0])
+        self.assertEqual(html._init_worker, kwargs['initializer'])
+        self.assertEqual(
+            ('12345', self.output_dir, filename, 'title', 5),
+            kwargs['initargs'],
+        )
+        self.assertTrue(pool.return_value.close.called)
+        self.assertTrue(pool.return_value.join.called)
+
+    def test_parallel_error_waits_for_workers(self):
+        report = self._make_report(jobs=2)
+
+        def results():
+            yield 'index.html'
+            raise RuntimeError('page failed')
+        with mock.patch('multiprocessing.Pool') as pool:
+            pool.return_value.imap_unordered.return_value = results()
+            rendered = []
+            self.assertRaises(
+                RuntimeError,
+                lambda: rendered.extend(report._render_parallel([])),
+            )
+        self.assertEqual(['index.html'], rendered)
+        self.assertTrue(pool.return_value.close.called)
+        self.assertTrue(pool.return_value.join.called)
+        self.assertFalse(pool.return_value.terminate.called)
+
+
+class IncrementalReportTest(testtools.TestCase):
+
+    def setUp(self):
+        super(IncrementalReportTest, self).setUp()
+        self.useFixture(fixtures.FakeLogger())
+        self.output_dir = self.useFixture(fixtures.TempDir()).path
+        self.db = db.DB(':memory:')
+        self.db.start_run('12345', '/no/such/dir', ['command'],
+                          1370436103.65)
+        for i in range(12):
+            self.db.trace(
+                run_id='12345',
+                thread_id='t',
+                call_id='call%d' % i,
+                event='call',
+                func_name='func',
+                line_no=1,
+                filename='filename.py',
+                trace_arg=None,
+                local_vars={},
+                timestamp=1370436104.65,
+            )
+        self.db.end_run('12345', 1370436105.65, None, None, None)
+
+    def _run(self, title='title', per_page=5):
+        report = html.HTMLReport(
+            run_id='12345',
+            output_dir=self.output_dir,
+            database=self.db,
+            title=title,
+            per_page=per_page,
+        )
+        rendered = []
+
+        def render_task(task):
+            rendered.append(task[0])
+            with open(os.path.join(self.output_dir, task[0]), 'w') as f:
+                f.write('page')
+            return task[0]
+
+        with mock.patch.object(report, 'render_task', render_task):
+            report.run()
+        return rendered
+
+    def test_first_run_renders_all(self):
+        rendered = self._run()
+        self.assertEqual(7, len(rendered))
+        self.assertTrue(os.path.exists(
+            os.path.join(self.output_dir, html.MANIFEST_NAME)
+        ))
+
+    def test_second_run_renders_nothing(self):
+        self._run()
+        self.assertEqual([], self._run())
+
+    def test_title_change_renders_all(self):
+        self._run()
+        self.assertEqual(7, len(self._run(title='other')))
+
+    def test_per_page_change(self):
+        self._run()
+        rendered = self._run(per_page=10)
+        self.assertEqual(['trace-1.html', 'trace-2.html'], rendered)
+        self.assertFalse(os.path.exists(
+            os.path.join(self.output_dir, 'trace-3.html')
+        ))
+
+    def test_missing_page_rendered(self):
+        self._run()
+        os.unlink(os.path.join(self.output_dir, 'stats.html'))
+        self.assertEqual(['stats.html'], self._run())
+
+    def test_failed_page_rendered_again(self):
+        report = html.HTMLReport('12345', self.output_dir, self.db,
+                                 'title', 5)
+
+        def render_task(task):
+            if task[0] != 'index.html':
+                raise RuntimeError('failed')
+            with open(os.path.join(self.output_dir, task[0]), 'w') as f:
+                f.write('page')
+            return task[0]
+
+        with mock.patch.object(report, 'render_task', render_task):
+            self.assertRaises(RuntimeError, report.run)
+        self.assertEqual(6, len(self._run()))
+
+    def test_running_run_always_rendered(self):
+        self.db.start_run('6789', '/no/such/dir', ['command'],
+                          1370436103.65)
+        report = html.HTMLReport('6789', self.output_dir, self.db,
+                                 'title', 5)
+        self.assertIsNone(report._get_page_hash(('index.html', 'index',
+                                                 None), 'hash'))
+
+    def test_static_files_copied_once(self):
+        self._run()
+        css = os.path.join(self.output_dir, 'css', 'run.css')
+        self.assertTrue(os.path.exists(css))
+        with mock.patch('shutil.copyfile') as copyfile:
+            self._run()
+        self.assertFalse(copyfile.called)
+
+    def test_changed_static_file_copied(self):
+        self._run()
+        css = os.path.join(self.output_dir, 'css', 'run.css')
+        os.unlink(css)
+        with mock.patch('shutil.copyfile') as copyfile:
+            self._run()
+        self.assertEqual(1, copyfile.call_count)
+        self.assertEqual(css, copyfile.call_args[0][1])
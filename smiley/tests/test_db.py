@@ -2,20 +2,35 @@
 
 import datetime
 import fixtures
+import mock
 import json
 import profile
 import pstats
+import sqlite3
 import tempfile
 import testtools
 
 import six
 
 from smiley import db
+from smiley import localsdiff
 from smiley import stats
+from smiley import valuecache
 
 
 class InitializationTest(testtools.TestCase):
 
+    @staticmethod
+    def _make_old_db(filename):
+        "Create the tables as they were before schema versions."
+        conn = sqlite3.connect(filename)
+        conn.execute(u'create table run (id text primary key)')
+        conn.execute(
+            u'create table trace (id integer primary key, run_id text,'
+            u' thread_id text, call_id text, filename text, line_no int)'
+        )
+        conn.commit()
+
     def test_initialize_first_time(self):
         with tempfile.NamedTemporaryFile() as f:
             conn = db.DB._open_db(f.name)
@@ -24,6 +39,112 @@ class InitializationTest(testtools.TestCase):
             results = cursor.fetchall()
             self.assertEqual(0, len(results))
 
+    def test_upgrade_adds_dropped_events(self):
+        with tempfile.NamedTemporaryFile() as f:
+            self._make_old_db(f.name)
+            conn = db.DB._open_db(f.name)
+            cursor = conn.cursor()
+            cursor.execute(u'PRAGMA table_info(run)')
+            names = [r['name'] for r in cursor.fetchall()]
+            self.assertIn('dropped_events', names)
+
+    def test_upgrade_adds_symbols(self):
+        with tempfile.NamedTemporaryFile() as f:
+            self._make_old_db(f.name)
+            conn = db.DB._open_db(f.name)
+            cursor = conn.cursor()
+            cursor.execute(u'PRAGMA table_info(run)')
+            names = [r['name'] for r in cursor.fetchall()]
+            self.assertIn('interned', names)
+            cursor.execute(u'select * from symbol')
+            self.assertEqual([], cursor.fetchall())
+
+    def test_initialize_sets_version(self):
+        with tempfile.NamedTemporaryFile() as f:
+            conn = db.DB._open_db(f.name)
+            self.assertEqual(len(db._MIGRATIONS),
+                             db._get_schema_version(conn))
+
+    def test_upgrade_adds_trace_indexes(self):
+        with tempfile.NamedTemporaryFile() as f:
+            self._make_old_db(f.name)
+            conn = db.DB._open_db(f.name)
+            cursor = conn.cursor()
+            cursor.execute(u'PRAGMA index_list(trace)')
+            names = [r['name'] for r in cursor.fetchall()]
+            self.assertIn('trace_run_id_thread_id_idx', names)
+            self.assertIn('trace_run_id_location_idx', names)
+            self.assertEqual(len(db._MIGRATIONS),
+                             db._get_schema_version(conn))
+
+    def test_upgrade_skips_applied_migrations(self):
+        with tempfile.NamedTemporaryFile() as f:
+            db.DB._open_db(f.name)
+            migrations = [mock.Mock() for m in db._MIGRATIONS]
+            migrations.append(mock.Mock(__doc__='new'))
+            with mock.patch.object(db, '_MIGRATIONS', migrations):
+                conn = db.DB._open_db(f.name)
+                self.assertEqual(len(migrations),
+                                 db._get_schema_version(conn))
+            for m in migrations[:-1]:
+                self.assertFalse(m.called)
+            self.assertTrue(migrations[-1].called)
+
+    def test_get_trace_with_thread_uses_index(self):
+        with tempfile.NamedTemporaryFile() as f:
+            conn = db.DB._open_db(f.name)
+            plan = conn.execute(
+                u"""
+                EXPLAIN QUERY PLAN
+                SELECT * FROM trace
+                WHERE run_id = 'a' AND thread_id = 'b'
+                ORDER BY id
+                """
+            ).fetchall()
+            details = ' '.join(r['detail'] for r in plan)
+            self.assertIn('trace_run_id_thread_id_idx', details)
+            self.assertNotIn('TEMP B-TREE', details)
+
+    def test_upgrade_replaces_location_counts(self):
+        with tempfile.NamedTemporaryFile() as f:
+            self._make_old_db(f.name)
+            conn = sqlite3.connect(f.name)
+            conn.execute(
+                u'create view location_counts as select * from trace'
+            )
+            conn.commit()
+            conn = db.DB._open_db(f.name)
+            cursor = conn.cursor()
+            cursor.execute(u"SELECT name FROM sqlite_master")
+            names = [r['name'] for r in cursor.fetchall()]
+            self.assertNotIn('location_counts', names)
+            self.assertIn('thread_summary', names)
+
+    def test_upgrade_adds_styled_file(self):
+        with tempfile.NamedTemporaryFile() as f:
+            self._make_old_db(f.name)
+            conn = db.DB._open_db(f.name)
+            cursor = conn.cursor()
+            cursor.execute(u'select * from styled_file')
+            self.assertEqual([], cursor.fetchall())
+
+    def test_upgrade_adds_value(self):
+        with tempfile.NamedTemporaryFile() as f:
+            self._make_old_db(f.name)
+            conn = db.DB._open_db(f.name)
+            cursor = conn.cursor()
+            cursor.execute(u'select * from value')
+            self.assertEqual([], cursor.fetchall())
+
+    def test_upgrade_adds_sampled(self):
+        with tempfile.NamedTemporaryFile() as f:
+            self._make_old_db(f.name)
+            conn = db.DB._open_db(f.name)
+            cursor = conn.cursor()
+            cursor.execute(u'PRAGMA table_info(run)')
+            names = [r['name'] for r in cursor.fetchall()]
+            self.assertIn('sampled', names)
+
     def test_initialize_second_time(self):
         with tempfile.NamedTemporaryFile() as f:
             db.DB._open_db(f.name)
@@ -112,6 +233,17 @@ class DBTest(testtools.TestCase):
         self.assertEqual(row['end_time'], None)
         self.assertEqual(row['error_message'], None)
         self.assertEqual(row['traceback'], None)
+        self.assertEqual(row['sampled'], 0)
+
+    def test_start_run_sampled(self):
+        self.db.start_run(
+            '12345',
+            '/no/such/dir',
+            'command line would go here',
+            1370436103.65,
+            sampled=True,
+        )
+        self.assertTrue(self.db.get_run('12345').sampled)
 
     def test_start_run_repeat_run_id(self):
         self.db.start_run(
@@ -152,6 +284,25 @@ class DBTest(testtools.TestCase):
         self.assertEqual(row['id'], '12345')
         self.assertEqual(row['start_time'], 1370436103.65)
         self.assertEqual(row['end_time'], 1370436104.65)
+        self.assertEqual(row['dropped_events'], 0)
+
+    def test_end_run_dropped_events(self):
+        self.db.start_run(
+            '12345',
+            '/no/such/dir',
+            'command line would go here',
+            1370436103.65,
+        )
+        self.db.end_run(
+            '12345',
+            1370436104.65,
+            message=None,
+            traceback=None,
+            stats=None,
+            dropped_events=42,
+        )
+        run = self.db.get_run('12345')
+        self.assertEqual(run.dropped_events, 42)
 
     def test_end_run_traceback(self):
         self.db.start_run(
@@ -243,6 +394,85 @@ class TraceTest(testtools.TestCase):
                          self.trace_arg)
 
 
+class TraceManyTest(testtools.TestCase):
+
+    def setUp(self):
+        super(TraceManyTest, self).setUp()
+        self.useFixture(fixtures.FakeLogger())
+        self.db_file = tempfile.NamedTemporaryFile()
+        self.addCleanup(self.db_file.close)
+        self.db = db.DB(self.db_file.name, commit_every=3)
+        self.db.start_run(
+            '12345',
+            '/no/such/dir',
+            'command line would go here',
+            1370436103.65,
+        )
+
+    def _make_events(self, *line_nos):
+        return [
+            ('12345', 't1', 'abcd', 'line', 'test_trace', line_no,
+             'test_db.py', None, {'line_no': line_no}, 1370436104.65)
+            for line_no in line_nos
+        ]
+
+    def _count_committed(self):
+        conn = db.DB._open_db(self.db_file.name)
+        c = conn.cursor()
+        c.execute('select count(*) from trace')
+        return c.fetchone()[0]
+
+    def test_insertion_order(self):
+        self.db.trace_many(self._make_events(99, 100, 101))
+        line_nos = [t.line_no for t in self.db.get_trace('12345')]
+        self.assertEqual(line_nos, [99, 100, 101])
+
+    def test_local_vars(self):
+        self.db.trace_many(self._make_events(99))
+        c = self.db.conn.cursor()
+        c.execute('select * from trace order by id')
+        row = c.fetchone()
+        self.assertEqual(json.loads(row['local_vars']), {'line_no': 99})
+
+    def test_commit_window_open(self):
+        self.db.trace_many(self._make_events(99, 100))
+        self.assertEqual(self._count_committed(), 0)
+
+    def test_commit_window_full(self):
+        self.db.trace_many(self._make_events(99, 100))
+        self.db.trace(*self._make_events(101)[0])
+        self.assertEqual(self._count_committed(), 3)
+
+    def test_commit_interval(self):
+        self.db._commit_interval = 0
+        self.db.trace_many(self._make_events(99))
+        self.assertEqual(self._count_committed(), 1)
+
+    def test_flush(self):
+        self.db.trace_many(self._make_events(99, 100))
+        self.db.flush()
+        self.assertEqual(self._count_committed(), 2)
+
+    def test_end_run_commits(self):
+        self.db.trace_many(self._make_events(99, 100))
+        self.db.end_run('12345', 1370436105.65, None, None, None)
+        self.assertEqual(self._count_committed(), 2)
+
+    def test_failed_batch_keeps_window(self):
+        self.db.trace_many(self._make_events(99, 100))
+        bad = self._make_events(101)
+        bad[0] = bad[0][:6] + ('other.py',) + bad[0][7:]
+        with mock.patch.object(db, '_INSERT_TRACE', u'INSERT INTO nothing'):
+            self.assertRaises(sqlite3.OperationalError,
+                              self.db.trace_many, bad)
+        self.db.trace_many(bad)
+        self.db.flush()
+        self.assertEqual(self._count_committed(), 3)
+        trace = list(self.db.get_trace('12345'))
+        self.assertEqual([99, 100, 101], [t.line_no for t in trace])
+        self.assertEqual('other.py', trace[-1].filename)
+
+
 class QueryTest(testtools.TestCase):
 
     def setUp(self):
@@ -335,6 +565,216 @@ class QueryTest(testtools.TestCase):
         self.assertEqual(line_nos, [99, 100])
 
 
+class IncrementalLocalsQueryTest(testtools.TestCase):
+
+    def setUp(self):
+        super(IncrementalLocalsQueryTest, self).setUp()
+        self.useFixture(fixtures.FakeLogger())
+        self.db = db.DB(':memory:')
+        self.db.start_run(
+            '12345',
+            '/no/such/dir',
+            ['command', 'line', 'would', 'go', 'here'],
+            1370436103.65,
+        )
+        events = [
+            ('call', {'a': 1}),
+            ('line', localsdiff.make_delta({'b': 2}, [])),
+            ('line', localsdiff.make_delta({'a': 3}, ['b'])),
+            ('return', localsdiff.make_delta({}, [])),
+        ]
+        for line_no, (event, local_vars) in enumerate(events):
+            self.db.trace(
+                run_id='12345',
+                thread_id='t1',
+                call_id='abcd',
+                event=event,
+                func_name='test_trace',
+                line_no=line_no,
+                filename='test_db.py',
+                trace_arg=None,
+                local_vars=local_vars,
+                timestamp=1370436104.65,
+            )
+
+    def test_get_trace_rebuilds_locals(self):
+        trace = list(self.db.get_trace('12345'))
+        self.assertEqual(
+            [{'a': 1}, {'a': 1, 'b': 2}, {'a': 3}, {'a': 3}],
+            [t.local_vars for t in trace],
+        )
+
+    def test_get_trace_after_id_rebuilds_locals(self):
+        trace = list(self.db.get_trace('12345', after_id=2))
+        self.assertEqual(
+            [{'a': 3}, {'a': 3}],
+            [t.local_vars for t in trace],
+        )
+
+    def test_get_trace_after_id_starts_at_full_locals(self):
+        events = [
+            ('call', {'x': 1}),
+            ('line', localsdiff.make_delta({'y': 2}, [])),
+            ('line', {'z': 3}),
+            ('line', localsdiff.make_delta({'w': 4}, [])),
+            ('line', localsdiff.make_delta({'v': 5}, [])),
+        ]
+        for event, local_vars in events:
+            self.db.trace('12345', 't1', 'efgh', event, 'f', 1, 'f.py',
+                          None, local_vars, 1370436104.65)
+        # Events before the latest full set of variables are not read.
+        self.db.conn.execute(
+            "UPDATE trace SET local_vars = 'not json' "
+            "WHERE call_id = 'efgh' AND event = 'call'"
+        )
+        trace = list(self.db.get_trace('12345', after_id=8))
+        self.assertEqual([{'z': 3, 'w': 4, 'v': 5}],
+                         [t.local_vars for t in trace])
+
+
+class LazyTraceTest(testtools.TestCase):
+
+    def setUp(self):
+        super(LazyTraceTest, self).setUp()
+        self.useFixture(fixtures.FakeLogger())
+        self.db = db.DB(':memory:')
+        self.db.start_run(
+            '12345',
+            '/no/such/dir',
+            ['command', 'line', 'would', 'go', 'here'],
+            1370436103.65,
+        )
+        for line_no in range(1, 3):
+            self.db.trace(
+                run_id='12345',
+                thread_id='t1',
+                call_id='abcd',
+                event='line',
+                func_name='test_trace',
+                line_no=line_no,
+                filename='test_db.py',
+                trace_arg=[line_no],
+                local_vars={'a': line_no},
+                timestamp=1370436104.65,
+            )
+
+    def test_not_decoded_until_used(self):
+        trace = list(self.db.get_trace('12345'))
+        self.assertIs(db._NOT_DECODED, trace[0]._local_vars)
+        self.assertIs(db._NOT_DECODED, trace[0]._trace_arg)
+        self.assertIs(db._NOT_DECODED, trace[0]._timestamp)
+        self.assertEqual({'a': 1}, trace[0].local_vars)
+        self.assertEqual([1], trace[0].trace_arg)
+        self.assertEqual(datetime.datetime.fromtimestamp(1370436104.65),
+                         trace[0].timestamp)
+
+    def test_replace_keeps_encoded_values(self):
+        t = next(self.db.get_trace('12345'))
+        t2 = t._replace(line_no=(1, 1))
+        self.assertIs(db._NOT_DECODED, t2._local_vars)
+        self.assertEqual((1, 1), t2.line_no)
+        self.assertEqual({'a': 1}, t2.local_vars)
+        self.assertEqual(1, t.line_no)
+
+    def test_namedtuple_api(self):
+        t = next(self.db.get_trace('12345'))
+        self.assertEqual(db.Trace._fields, tuple(t._asdict().keys()))
+        self.assertEqual(t, db.Trace(*t))
+        self.assertNotEqual(t, t._replace(line_no=99))
+
+    def test_columns(self):
+        trace = list(self.db.get_trace('12345',
+                                       columns=['filename', 'line_no']))
+        self.assertEqual(
+            [(1, 'test_db.py', 1, None, None),
+             (2, 'test_db.py', 2, None, None)],
+            [(t.id, t.filename, t.line_no, t.func_name, t.local_vars)
+             for t in trace],
+        )
+
+    def test_unknown_columns(self):
+        self.assertRaises(
+            ValueError,
+            self.db.get_trace, '12345', columns=['filename', 'bogus'],
+        )
+
+
+class StreamingQueryTest(testtools.TestCase):
+
+    def setUp(self):
+        super(StreamingQueryTest, self).setUp()
+        self.useFixture(fixtures.FakeLogger())
+        self.useFixture(fixtures.MonkeyPatch('smiley.db.FETCH_SIZE', 2))
+        self.db = db.DB(':memory:')
+        self.db.start_run(
+            '12345',
+            '/no/such/dir',
+            ['command', 'line', 'would', 'go', 'here'],
+            1370436103.65,
+        )
+        for line_no in range(1, 6):
+            self._trace(line_no)
+
+    def _trace(self, line_no):
+        self.db.trace(
+            run_id='12345',
+            thread_id='t1',
+            call_id='abcd',
+            event='line',
+            func_name='test_trace',
+            line_no=line_no,
+            filename='test_db.py',
+            trace_arg=None,
+            local_vars={},
+            timestamp=1370436104.65,
+        )
+
+    def test_get_trace_all_chunks(self):
+        trace = self.db.get_trace('12345')
+        self.assertEqual([1, 2, 3, 4, 5], [t.line_no for t in trace])
+
+    def test_get_trace_after_id(self):
+        trace = self.db.get_trace('12345', after_id=3)
+        self.assertEqual([4, 5], [t.line_no for t in trace])
+
+    def test_get_trace_limit(self):
+        trace = self.db.get_trace('12345', after_id=1, limit=3)
+        self.assertEqual([2, 3, 4], [t.line_no for t in trace])
+
+    def test_get_trace_pages(self):
+        line_nos = []
+        after_id = None
+        while True:
+            page = list(self.db.get_trace('12345', after_id=after_id,
+                                          limit=2))
+            if not page:
+                break
+            line_nos.extend(t.line_no for t in page)
+            after_id = page[-1].id
+        self.assertEqual([1, 2, 3, 4, 5], line_nos)
+
+    def test_write_while_reading(self):
+        trace = self.db.get_trace('12345')
+        first = next(trace)
+        self._trace(6)
+        self.db.flush()
+        self.assertEqual('12345', self.db.get_run('12345').id)
+        rest = list(trace)
+        self.assertEqual(1, first.line_no)
+        self.assertEqual([2, 3, 4, 5], [t.line_no for t in rest][:4])
+
+    def test_get_runs(self):
+        for i in range(3):
+            self.db.start_run(
+                str(i),
+                '/no/such/dir',
+                ['command'],
+                1370436104.65 + i,
+            )
+        runs = list(self.db.get_runs())
+        self.assertEqual(['12345', '0', '1', '2'], [r.id for r in runs])
+
+
 class QueryWithStatsTest(testtools.TestCase):
 
     def setUp(self):
@@ -489,6 +929,55 @@ class ThreadQueryTest(testtools.TestCase):
         self.assertEqual(by_id['t1'].num_events, 2)
         self.assertEqual(by_id['t2'].num_events, 2)
 
+    def test_get_thread_details_num_locations(self):
+        self.db.trace(
+            run_id='12345',
+            thread_id='t1',
+            call_id='abcd',
+            event='test',
+            func_name='test_trace',
+            line_no=100,
+            filename='test_db.py',
+            trace_arg=self.trace_arg,
+            local_vars=self.local_values,
+            timestamp=1370436104.65,
+        )
+        details = list(self.db.get_thread_details('12345'))
+        by_id = {t.id: t for t in details}
+        self.assertEqual(by_id['t1'].num_events, 3)
+        self.assertEqual(by_id['t1'].num_locations, 2)
+
+    def _summary_rows(self):
+        c = self.db.conn.cursor()
+        c.execute(u"SELECT * FROM thread_summary WHERE run_id = '12345'")
+        return c.fetchall()
+
+    def test_summary_not_saved_while_running(self):
+        list(self.db.get_thread_details('12345'))
+        self.assertEqual([], self._summary_rows())
+
+    def test_summary_saved_by_end_run(self):
+        self.db.end_run('12345', 1370436107.65, None, None, stats=None)
+        self.assertEqual(2, len(self._summary_rows()))
+        # Later queries read the saved values.
+        self.db.conn.execute(
+            u"UPDATE thread_summary SET num_events = 99"
+        )
+        details = list(self.db.get_thread_details('12345'))
+        self.assertEqual([99, 99], [t.num_events for t in details])
+
+    def test_summary_saved_for_old_run(self):
+        self.db.end_run('12345', 1370436107.65, None, None, stats=None)
+        self.db.conn.execute(u"DELETE FROM thread_summary")
+        details = list(self.db.get_thread_details('12345'))
+        self.assertEqual(set(['t1', 't2']), set(t.id for t in details))
+        self.assertEqual(2, len(self._summary_rows()))
+
+    def test_summary_deleted_with_run(self):
+        self.db.end_run('12345', 1370436107.65, None, None, stats=None)
+        self.db.delete_run('12345')
+        self.assertEqual([], self._summary_rows())
+
     def test_get_trace_no_thread(self):
         trace = list(self.db.get_trace('12345'))
         self.assertEqual(len(trace), 4)
@@ -500,6 +989,164 @@ class ThreadQueryTest(testtools.TestCase):
         self.assertEqual(ids, set(['t1']))
 
 
+class SymbolTest(testtools.TestCase):
+
+    def setUp(self):
+        super(SymbolTest, self).setUp()
+        self.useFixture(fixtures.FakeLogger())
+        self.db = db.DB(':memory:')
+        self.db.start_run(
+            '12345',
+            '/no/such/dir',
+            ['command', 'line', 'would', 'go', 'here'],
+            1370436103.65,
+        )
+        for thread_id, line_no in [('t1', 1), ('t2', 2), ('t1', 3)]:
+            self._trace('12345', thread_id, line_no)
+
+    def _trace(self, run_id, thread_id, line_no):
+        self.db.trace(
+            run_id=run_id,
+            thread_id=thread_id,
+            call_id='abcd',
+            event='line',
+            func_name='test_trace',
+            line_no=line_no,
+            filename='/a/long/path/to/test_db.py',
+            trace_arg=None,
+            local_vars={},
+            timestamp=1370436104.65,
+        )
+
+    def _raw_trace(self):
+        c = self.db.conn.cursor()
+        c.execute(u'SELECT thread_id, filename, func_name FROM trace')
+        return [tuple(r) for r in c.fetchall()]
+
+    def test_stored_as_ids(self):
+        self.assertEqual(
+            [('1', '3', '2'), ('4', '3', '2'), ('1', '3', '2')],
+            self._raw_trace(),
+        )
+
+    def test_get_trace_resolves(self):
+        trace = list(self.db.get_trace('12345'))
+        self.assertEqual(
+            [('t1', '/a/long/path/to/test_db.py', 'test_trace'),
+             ('t2', '/a/long/path/to/test_db.py', 'test_trace'),
+             ('t1', '/a/long/path/to/test_db.py', 'test_trace')],
+            [(t.thread_id, t.filename, t.func_name) for t in trace],
+        )
+
+    def test_get_trace_unknown_thread(self):
+        self.assertEqual([], list(self.db.get_trace('12345', 't3')))
+
+    def test_symbols_per_run(self):
+        self.db.start_run(
+            '6789',
+            '/no/such/dir',
+            ['command', 'line', 'would', 'go', 'here'],
+            1370436104.65,
+        )
+        self._trace('6789', 't2', 1)
+        self.assertEqual(('1', '3', '2'), self._raw_trace()[-1])
+        trace = list(self.db.get_trace('6789'))
+        self.assertEqual('t2', trace[0].thread_id)
+
+    def test_reopen_continues_ids(self):
+        self.db._symbols.clear()
+        self._trace('12345', 't3', 4)
+        self.assertEqual(('5', '3', '2'), self._raw_trace()[-1])
+
+    def test_old_run_not_interned(self):
+        self.db.conn.execute(
+            u"UPDATE run SET interned = 0 WHERE id = '12345'"
+        )
+        self.db._symbols.clear()
+        self._trace('12345', 't3', 4)
+        self.assertEqual(
+            ('t3', '/a/long/path/to/test_db.py', 'test_trace'),
+            self._raw_trace()[-1],
+        )
+
+    def test_delete_run(self):
+        self.db.delete_run('12345')
+        c = self.db.conn.cursor()
+        c.execute(u'SELECT * FROM symbol')
+        self.assertEqual([], c.fetchall())
+
+
+class ValueTest(testtools.TestCase):
+
+    def setUp(self):
+        super(ValueTest, self).setUp()
+        self.useFixture(fixtures.FakeLogger())
+        self.db = db.DB(':memory:')
+        self.db.start_run(
+            '12345',
+            '/no/such/dir',
+            ['command', 'line', 'would', 'go', 'here'],
+            1370436103.65,
+        )
+        events = [
+            ('call', {'a': valuecache.make_value(1, {'x': 1})}),
+            ('line', localsdiff.make_delta(
+                {'b': valuecache.make_ref(1)}, [])),
+            ('line', localsdiff.make_delta(
+                {'a': valuecache.make_value(2, {'x': 2})}, [])),
+            ('return', {'a': valuecache.make_ref(3)}),
+        ]
+        for line_no, (event, local_vars) in enumerate(events):
+            self.db.trace(
+                run_id='12345',
+                thread_id='t1',
+                call_id='abcd',
+                event=event,
+                func_name='test_trace',
+                line_no=line_no,
+                filename='test_db.py',
+                trace_arg=None,
+                local_vars=local_vars,
+                timestamp=1370436104.65,
+            )
+
+    def test_stored_once(self):
+        c = self.db.conn.cursor()
+        c.execute(u'SELECT id, body FROM value ORDER BY id')
+        self.assertEqual(
+            [(1, '{"x": 1}'), (2, '{"x": 2}')],
+            [tuple(r) for r in c.fetchall()],
+        )
+        c.execute(u'SELECT local_vars FROM trace ORDER BY id')
+        stored = [json.loads(r[0]) for r in c.fetchall()]
+        self.assertEqual({'a': valuecache.make_ref(1)}, stored[0])
+
+    def test_get_trace_resolves(self):
+        trace = list(self.db.get_trace('12345'))
+        self.assertEqual(
+            [{'a': {'x': 1}},
+             {'a': {'x': 1}, 'b': {'x': 1}},
+             {'a': {'x': 2}, 'b': {'x': 1}},
+             {'a': valuecache.missing(3)}],
+            [t.local_vars for t in trace],
+        )
+
+    def test_get_trace_after_id_resolves(self):
+        trace = list(self.db.get_trace('12345', after_id=2))
+        self.assertEqual(
+            {'a': {'x': 2}, 'b': {'x': 1}},
+            trace[0].local_vars,
+        )
+
+    def test_delete_run(self):
+        list(self.db.get_trace('12345'))
+        self.db.delete_run('12345')
+        c = self.db.conn.cursor()
+        c.execute(u'SELECT * FROM value')
+        self.assertEqual([], c.fetchall())
+        self.assertNotIn('12345', self.db._values)
+
+
 class FileCacheTest(testtools.TestCase):
 
     def setUp(self):
@@ -672,3 +1319,17 @@ class FileCacheTest(testtools.TestCase):
         self.assertEqual(2, len(files))
         names = [f.name for f in files]
         self.assertEqual(['test-file.txt', 'test-file2.txt'], names)
+
+    def test_styled_file_missing(self):
+        self.assertIsNone(self.db.get_styled_file('sig', 'style'))
+
+    def test_save_styled_file(self):
+        self.db.save_styled_file('sig', 'style-a', u'<a>')
+        self.db.save_styled_file('sig', 'style-b', u'<b>')
+        self.assertEqual(u'<a>', self.db.get_styled_file('sig', 'style-a'))
+        self.assertEqual(u'<b>', self.db.get_styled_file('sig', 'style-b'))
+
+    def test_save_styled_file_replaces(self):
+        self.db.save_styled_file('sig', 'style', u'<old>')
+        self.db.save_styled_file('sig', 'style', u'<new>')
+        self.assertEqual(u'<new>', self.db.get_styled_file('sig', 'style'))
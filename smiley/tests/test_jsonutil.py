@@ -1,6 +1,9 @@
+import json
+import logging
 import traceback
 
 import fixtures
+import mock
 import testtools
 
 import six
@@ -92,3 +95,192 @@ class JSONTest(testtools.TestCase):
             expected = "<class 'int'>"
         actual = jsonutil._json_special_types(int)
         self.assertEqual(expected, actual)
+
+
+class Node(object):
+    def __init__(self, value):
+        self.value = value
+        self.children = []
+
+
+class EncoderTest(testtools.TestCase):
+
+    def setUp(self):
+        super(EncoderTest, self).setUp()
+        self.useFixture(fixtures.FakeLogger())
+
+    def test_basic_types_match_json(self):
+        data = {
+            'str': u'text é',
+            'int': 1,
+            'float': 1.5,
+            'none': None,
+            'bool': True,
+            'list': [1, [2, 3], {'a': 'b'}],
+            'tuple': (1, 2),
+        }
+        self.assertEqual(json.loads(json.dumps(data)),
+                         json.loads(jsonutil.dumps(data)))
+
+    def test_object(self):
+        node = Node(1)
+        node.children.append(Node(2))
+        actual = json.loads(jsonutil.dumps(node))
+        self.assertEqual(1, actual['value'])
+        self.assertEqual('Node', actual['__class__'])
+        self.assertEqual(2, actual['children'][0]['value'])
+
+    def test_circular_list(self):
+        data = [1]
+        data.append(data)
+        actual = jsonutil.simplify(data)
+        self.assertEqual([1, '<circular reference to list>'], actual)
+
+    def test_circular_object(self):
+        node = Node(1)
+        node.children.append(node)
+        actual = jsonutil.simplify({'node': node, 'other': 'value'})
+        self.assertEqual('value', actual['other'])
+        self.assertEqual(['<circular reference to Node>'],
+                         actual['node']['children'])
+
+    def test_shared_value_is_not_circular(self):
+        shared = [1, 2]
+        actual = jsonutil.simplify({'a': shared, 'b': shared})
+        self.assertEqual({'a': [1, 2], 'b': [1, 2]}, actual)
+
+    def test_circular_types(self):
+        actual = jsonutil.simplify({'log': logging.getLogger('x')})
+        self.assertIn('Logger', actual['log'])
+
+    def test_non_string_keys(self):
+        actual = json.loads(jsonutil.dumps({(1, 2): 'a', 3: 'b'}))
+        self.assertEqual({'(1, 2)': 'a', '3': 'b'}, actual)
+
+    def test_bad_repr(self):
+        class BadRepr(object):
+            __slots__ = ()
+
+            def __repr__(self):
+                raise RuntimeError('no repr')
+        self.assertEqual('<unrepresentable BadRepr>',
+                         jsonutil.simplify(BadRepr()))
+
+    def test_handler_cached(self):
+        jsonutil.simplify(Node(1))
+        self.assertEqual(jsonutil._Walk.convert_object,
+                         jsonutil._Walk._handlers[Node])
+        with mock.patch.object(jsonutil._Walk, '_find_handler') as find:
+            jsonutil.simplify(Node(1))
+        self.assertFalse(find.called)
+
+    def test_max_depth(self):
+        encoder = jsonutil.Encoder(max_depth=2)
+        actual = encoder.simplify({'a': {'b': {'c': 1}}, 'd': 2})
+        self.assertEqual(
+            {'a': {'b': '<truncated: dict of 1 items nested too deeply>'},
+             'd': 2},
+            actual,
+        )
+
+    def test_max_depth_object(self):
+        encoder = jsonutil.Encoder(max_depth=1)
+        node = Node(1)
+        node.children.append(Node(2))
+        actual = encoder.simplify(node)
+        self.assertEqual(1, actual['value'])
+        self.assertEqual('<truncated: list of 1 items nested too deeply>',
+                         actual['children'])
+
+    def test_max_items_list(self):
+        encoder = jsonutil.Encoder(max_items=2)
+        self.assertEqual([0, 1, '<truncated: 3 more items>'],
+                         encoder.simplify(list(range(5))))
+
+    def test_max_items_dict(self):
+        encoder = jsonutil.Encoder(max_items=1)
+        actual = encoder.simplify({'a': 1, 'b': 2, 'c': 3})
+        self.assertEqual(2, len(actual))
+        self.assertEqual('<truncated: 2 more items>',
+                         actual[jsonutil.TRUNCATED_KEY])
+
+    def test_max_items_kept(self):
+        encoder = jsonutil.Encoder(max_items=3)
+        data = {'a': [1, 2, 3], 'b': 'text'}
+        self.assertEqual(data, encoder.simplify(data))
+
+    def test_max_string_length(self):
+        encoder = jsonutil.Encoder(max_string_length=3)
+        actual = encoder.simplify({'a': 'abcdef', 'b': 'abc'})
+        self.assertEqual(
+            {'a': 'abc<truncated: 3 more characters>', 'b': 'abc'},
+            actual,
+        )
+
+    def test_max_string_length_repr(self):
+        encoder = jsonutil.Encoder(max_string_length=5)
+        actual = encoder.simplify(logging.getLogger('x'))
+        self.assertTrue(actual.startswith('<Logg'))
+        self.assertIn(jsonutil.TRUNCATED_PREFIX, actual)
+
+    def test_max_bytes(self):
+        encoder = jsonutil.Encoder(max_bytes=100)
+        actual = encoder.simplify(['x' * 60, 'y' * 60, 'z' * 60])
+        self.assertEqual(
+            ['x' * 60, 'y' * 36 + '<truncated: 24 more characters>',
+             '<truncated: str of 60 characters over the size limit>'],
+            actual,
+        )
+
+    def test_max_bytes_long_string(self):
+        encoder = jsonutil.Encoder(max_bytes=200)
+        actual = encoder.simplify({'a': 'x' * 500})
+        self.assertEqual(
+            'x' * 193 + '<truncated: 307 more characters>',
+            actual['a'],
+        )
+
+    def test_max_bytes_numbers(self):
+        encoder = jsonutil.Encoder(max_bytes=100)
+        actual = encoder.simplify([list(range(100)), [1]])
+        self.assertEqual(list(range(100)), actual[0])
+        self.assertIn('over the size limit', actual[1])
+
+    def test_simplify_all_shares_limit(self):
+        encoder = jsonutil.Encoder(max_bytes=100)
+        first, second = encoder.simplify_all(['x' * 200, 'y'])
+        self.assertEqual('x' * 98 + '<truncated: 102 more characters>',
+                         first)
+        self.assertIn('over the size limit', second)
+
+    def test_wrapper_not_counted(self):
+        encoder = jsonutil.Encoder(max_depth=2)
+        wrapped = jsonutil.Wrapper(
+            {'a': 1}, lambda value, complete: {'wrapped': value},
+        )
+        self.assertEqual({'x': {'wrapped': {'a': 1}}},
+                         encoder.simplify({'x': wrapped}))
+
+    def test_wrapper_over_size_limit(self):
+        encoder = jsonutil.Encoder(max_bytes=10)
+        wrapped = jsonutil.Wrapper(
+            'y' * 20, lambda value, complete: complete,
+        )
+        self.assertEqual([[0, 1], False],
+                         encoder.simplify([[0, 1], wrapped]))
+
+    def test_has_limits(self):
+        self.assertFalse(jsonutil.Encoder().has_limits)
+        self.assertTrue(jsonutil.Encoder(max_items=1).has_limits)
+
+    def test_traceback(self):
+        try:
+            raise RuntimeError('here')
+        except RuntimeError:
+            import sys
+            actual = jsonutil.simplify(sys.exc_info()[-1])
+        self.assertEqual(1, len(actual))
+        filename, line_no, func_name, text = actual[0]
+        self.assertEqual(__file__.rstrip('c'), filename)
+        self.assertEqual('test_traceback', func_name)
+        self.assertEqual("raise RuntimeError('here')", text)
@@ -6,6 +6,7 @@ import testtools
 import zmq
 
 from smiley import listener
+from smiley import wire
 
 
 class ListenerTest(testtools.TestCase):
@@ -46,3 +47,82 @@ class ListenerTest(testtools.TestCase):
         l = listener.Listener('endpoint')
         val = next(l.poll_once())
         self.assertEqual(val, ['message type name', msg])
+
+    @mock.patch('zmq.Context.socket')
+    @mock.patch('zmq.Poller.poll')
+    def test_switch_codec(self, poll, socket):
+        if wire.msgpack is None:
+            self.skipTest('msgpack is not installed')
+        codec = wire.get_codec('msgpack')
+        poll.return_value = [(socket, zmq.POLLIN)]
+        start = {'run_id': '12345', 'codec': 'msgpack'}
+        msg = {'key': 'value'}
+        socket.return_value.recv_multipart.side_effect = [
+            (b'start_run', json.dumps(start).encode('utf-8')),
+            (b'line', codec.encode(msg)),
+        ]
+        l = listener.Listener('endpoint')
+        self.assertEqual(['start_run', start], next(l.poll_once()))
+        self.assertEqual(['line', msg], next(l.poll_once()))
+
+    @mock.patch('zmq.Context.socket')
+    @mock.patch('zmq.Poller.poll')
+    def test_start_run_without_codec(self, poll, socket):
+        poll.return_value = [(socket, zmq.POLLIN)]
+        l = listener.Listener('endpoint')
+        l.codec = None
+        socket.return_value.recv_multipart.return_value = (
+            b'start_run', json.dumps({'run_id': '12345'}).encode('utf-8'),
+        )
+        next(l.poll_once())
+        self.assertIs(wire.JSON, l.codec)
+
+    @mock.patch('zmq.Context.socket')
+    @mock.patch('zmq.Poller.poll')
+    def test_resolve_symbols(self, poll, socket):
+        poll.return_value = [(socket, zmq.POLLIN)]
+        first = {'thread_id': 1, 'filename': 2, 'func_name': 3,
+                 'line_no': 1,
+                 'symbols': [[1, 't1'], [2, 'f.py'], [3, 'f']]}
+        second = {'thread_id': 1, 'filename': 2, 'func_name': 3,
+                  'line_no': 2}
+        start = {'run_id': '12345', 'interned': True}
+        socket.return_value.recv_multipart.side_effect = [
+            (b'start_run', json.dumps(start).encode('utf-8')),
+            (b'line', json.dumps(first).encode('utf-8')),
+            (b'line', json.dumps(second).encode('utf-8')),
+        ]
+        l = listener.Listener('endpoint')
+        next(l.poll_once())
+        expected = {'thread_id': 't1', 'filename': 'f.py',
+                    'func_name': 'f'}
+        for line_no in [1, 2]:
+            expected['line_no'] = line_no
+            self.assertEqual(['line', expected], next(l.poll_once()))
+
+    @mock.patch('zmq.Context.socket')
+    @mock.patch('zmq.Poller.poll')
+    def test_symbols_not_announced(self, poll, socket):
+        poll.return_value = [(socket, zmq.POLLIN)]
+        msg = {'thread_id': 1, 'filename': 'f.py', 'func_name': 'f',
+               'line_no': 1}
+        socket.return_value.recv_multipart.return_value = (
+            b'line', json.dumps(msg).encode('utf-8'),
+        )
+        l = listener.Listener('endpoint')
+        self.assertEqual(['line', msg], next(l.poll_once()))
+
+    @mock.patch('zmq.Context.socket')
+    @mock.patch('zmq.Poller.poll')
+    def test_unpack_batch(self, poll, socket):
+        poll.return_value = [(socket, zmq.POLLIN)]
+        socket.return_value.recv_multipart.return_value = [
+            b'batch',
+            b'line', json.dumps({'line_no': 1}).encode('utf-8'),
+            b'return', json.dumps({'line_no': 2}).encode('utf-8'),
+        ]
+        l = listener.Listener('endpoint')
+        self.assertEqual(
+            [['line', {'line_no': 1}], ['return', {'line_no': 2}]],
+            list(l.poll_once()),
+        )
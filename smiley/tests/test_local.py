@@ -1,6 +1,10 @@
+import tempfile
 import unittest
 
 import mock
+from six.moves import queue
+
+from smiley import db
 from smiley import local
 
 
@@ -11,6 +15,10 @@ class LocalTest(unittest.TestCase):
         self.pub = local.LocalPublisher(':memory:')
         # Shutdown the thread started inside the publisher
         self.pub._stop()
+        # and do not let start_run() replace it.
+        patcher = mock.patch.object(self.pub, '_start_thread')
+        patcher.start()
+        self.addCleanup(patcher.stop)
 
     def test_start_run(self):
         # Mock out the queue because end_run() expects to be able to
@@ -26,7 +34,7 @@ class LocalTest(unittest.TestCase):
             expected = ('start',
                         ('12345', mock.ANY,
                          'command line would go here',
-                         1370436103.65),
+                         1370436103.65, False),
                         )
             q.put.assert_called_once_with(expected)
 
@@ -45,7 +53,7 @@ class LocalTest(unittest.TestCase):
             expected = [
                 mock.call(('end',
                            ('12345', 1370436103.65, 'error message here',
-                            None, None))),
+                            None, None, 0))),
                 mock.call(None),
             ]
             self.assertEqual(expected, q.put.call_args_list)
@@ -127,3 +135,183 @@ class LocalTest(unittest.TestCase):
         the_db = mock.Mock()
         self.pub._dispatch_one(the_db, ('file', ('args',)))
         the_db.cache_file_for_run.assert_called_once_with('args')
+
+    def _process_queued(self, *items):
+        q = queue.Queue()
+        for item in items:
+            q.put(item)
+        q.put(None)
+        with mock.patch('smiley.db.DB') as db_factory:
+            self.pub._process_data(':memory:', q, 1000, None)
+        return db_factory.return_value
+
+    def test_process_data_batches(self):
+        the_db = self._process_queued(
+            ('start', ('start-args',)),
+            ('trace', ('trace-1',)),
+            ('trace', ('trace-2',)),
+            ('file', ('file-1',)),
+            ('trace', ('trace-3',)),
+            ('end', ('end-args',)),
+        )
+        expected = [
+            mock.call.start_run('start-args'),
+            mock.call.trace_many([('trace-1',), ('trace-2',)]),
+            mock.call.cache_files_for_run([('file-1',)]),
+            mock.call.trace_many([('trace-3',)]),
+            mock.call.end_run('end-args'),
+            mock.call.flush(),
+        ]
+        self.assertEqual(expected, the_db.mock_calls)
+
+    def test_process_data_bulk_error(self):
+        q = queue.Queue()
+        q.put(('trace', ('trace-1',)))
+        q.put(('trace', ('trace-2',)))
+        q.put(None)
+        with mock.patch('smiley.db.DB') as db_factory:
+            the_db = db_factory.return_value
+            the_db.trace_many.side_effect = RuntimeError('bulk failed')
+            self.pub._process_data(':memory:', q, 1000, None)
+        expected = [mock.call('trace-1'), mock.call('trace-2')]
+        self.assertEqual(expected, the_db.trace.call_args_list)
+
+    def test_process_data_bulk_error_keeps_good_events(self):
+        db_file = tempfile.NamedTemporaryFile()
+        self.addCleanup(db_file.close)
+        q = queue.Queue()
+        q.put(('start', ('12345', '/no/such/dir', 'command', 1.0)))
+        for line_no in (1, 2):
+            q.put(('trace', ('12345', 't1', 'abcd', 'line', 'func',
+                             line_no, 'file.py', None, {}, 2.0)))
+        q.put(('trace', ('not', 'enough', 'values')))
+        q.put(None)
+        self.pub._process_data(db_file.name, q, 1000, None)
+        the_db = db.DB(db_file.name)
+        self.assertEqual(
+            [1, 2],
+            [t.line_no for t in the_db.get_trace('12345')],
+        )
+
+    def test_process_data_histograms(self):
+        self._process_queued(
+            ('trace', ('trace-1',)),
+            ('trace', ('trace-2',)),
+        )
+        # All three items, including the sentinel, come out of the
+        # queue as one batch.
+        self.assertEqual({4: 1}, dict(self.pub.batch_sizes))
+        self.assertEqual({4: 1}, dict(self.pub.queue_depths))
+
+
+class ReuseTest(unittest.TestCase):
+
+    def test_two_runs(self):
+        db_file = tempfile.NamedTemporaryFile()
+        self.addCleanup(db_file.close)
+        pub = local.LocalPublisher(db_file.name)
+        for run_id in ('run-1', 'run-2'):
+            pub.start_run(run_id, '/no/such/dir', 'command', 1.0)
+            pub.trace(run_id, 't1', 'abcd', 'line', 'func', 1, None,
+                      None, {}, 2.0)
+            pub.end_run(run_id, 3.0, None, None, None)
+        the_db = db.DB(db_file.name)
+        for run_id in ('run-1', 'run-2'):
+            self.assertEqual(1, len(list(the_db.get_trace(run_id))))
+
+
+class OverflowTest(unittest.TestCase):
+
+    def _make_publisher(self, policy):
+        pub = local.LocalPublisher(
+            ':memory:',
+            max_queue_size=1,
+            overflow_policy=policy,
+            overflow_sample_rate=2,
+        )
+        pub._stop()
+        pub._cached_files.add('file.py')
+        return pub
+
+    def _trace(self, pub, event):
+        return pub.trace(
+            run_id='12345',
+            thread_id='t1',
+            call_id='c1',
+            event=event,
+            func_name='func',
+            line_no=1,
+            filename='file.py',
+            trace_arg={},
+            local_vars={},
+            timestamp=1370436103.65,
+        )
+
+    def test_unknown_policy(self):
+        self.assertRaises(
+            ValueError,
+            local.LocalPublisher, ':memory:', overflow_policy='no-such',
+        )
+
+    def test_block(self):
+        pub = self._make_publisher('block')
+        with mock.patch.object(pub, '_q') as q:
+            self._trace(pub, 'line')
+            self.assertEqual(1, q.put.call_count)
+            self.assertFalse(q.put_nowait.called)
+
+    def test_drop_lines(self):
+        pub = self._make_publisher('drop-lines')
+        self._trace(pub, 'line')
+        self._trace(pub, 'line')
+        self._trace(pub, 'line')
+        self.assertEqual(1, pub._q.qsize())
+        self.assertEqual(2, pub._dropped_events)
+
+    def test_drop_lines_reports_dropped(self):
+        pub = self._make_publisher('drop-lines')
+        self.assertTrue(self._trace(pub, 'line'))
+        self.assertFalse(self._trace(pub, 'line'))
+
+    def test_drop_lines_keeps_calls(self):
+        pub = self._make_publisher('drop-lines')
+        with mock.patch.object(pub, '_q') as q:
+            q.put_nowait.side_effect = queue.Full
+            self._trace(pub, 'call')
+            self._trace(pub, 'return')
+            self.assertEqual(2, q.put.call_count)
+        self.assertEqual(0, pub._dropped_events)
+
+    def test_sample(self):
+        pub = self._make_publisher('sample')
+        with mock.patch.object(pub, '_q') as q:
+            q.put_nowait.side_effect = queue.Full
+            for i in range(4):
+                self._trace(pub, 'line')
+            self.assertEqual(2, q.put.call_count)
+        self.assertEqual(2, pub._dropped_events)
+
+    def test_end_run_saves_dropped_events(self):
+        pub = self._make_publisher('drop-lines')
+        pub._dropped_events = 5
+        with mock.patch.object(pub, '_q') as q:
+            pub.end_run('12345', 1370436103.65, None, None, None)
+            q.put.assert_any_call(
+                ('end', ('12345', 1370436103.65, None, None, None, 5))
+            )
+
+    def test_start_run_resets_dropped_events(self):
+        pub = self._make_publisher('drop-lines')
+        pub._dropped_events = 5
+        with mock.patch.object(pub, '_q'):
+            pub.start_run('12345', '/no/such/dir', [], 1370436103.65)
+        self.assertEqual(0, pub._dropped_events)
+
+
+class HistogramTest(unittest.TestCase):
+
+    def test_bucket(self):
+        self.assertEqual(
+            [1, 1, 2, 4, 4, 8, 1024],
+            [local._histogram_bucket(n) for n in (0, 1, 2, 3, 4, 5, 1000)],
+        )
@@ -0,0 +1,135 @@
+import json
+
+import testtools
+
+from smiley import localsdiff
+
+
+class DifferTest(testtools.TestCase):
+
+    def setUp(self):
+        super(DifferTest, self).setUp()
+        self.differ = localsdiff.Differ(json.dumps)
+
+    def test_first_event_full(self):
+        local_vars = {'a': 1, 'b': [1, 2]}
+        self.assertEqual(local_vars, self.differ.diff('c1', local_vars))
+
+    def test_unchanged(self):
+        self.differ.diff('c1', {'a': 1, 'b': [1, 2]})
+        self.assertEqual(
+            localsdiff.make_delta({}, []),
+            self.differ.diff('c1', {'a': 1, 'b': [1, 2]}),
+        )
+
+    def test_added_changed_removed(self):
+        self.differ.diff('c1', {'a': 1, 'b': 2})
+        self.assertEqual(
+            localsdiff.make_delta({'b': 3, 'c': 4}, ['a']),
+            self.differ.diff('c1', {'b': 3, 'c': 4}),
+        )
+
+    def test_mutated_value(self):
+        value = [1, 2]
+        self.differ.diff('c1', {'a': value})
+        value.append(3)
+        self.assertEqual(
+            localsdiff.make_delta({'a': [1, 2, 3]}, []),
+            self.differ.diff('c1', {'a': value}),
+        )
+
+    def test_changed_type(self):
+        self.differ.diff('c1', {'a': 1})
+        self.assertEqual(
+            localsdiff.make_delta({'a': True}, []),
+            self.differ.diff('c1', {'a': True}),
+        )
+
+    def test_no_signature_always_sent(self):
+        differ = localsdiff.Differ(lambda value: None)
+        differ.diff('c1', {'a': [1]})
+        self.assertEqual(
+            localsdiff.make_delta({'a': [1]}, []),
+            differ.diff('c1', {'a': [1]}),
+        )
+
+    def test_full_every(self):
+        differ = localsdiff.Differ(json.dumps, full_every=3)
+        sent = [differ.diff('c1', {'a': 1}) for i in range(5)]
+        self.assertEqual(
+            [{'a': 1}, localsdiff.make_delta({}, []),
+             localsdiff.make_delta({}, []), {'a': 1},
+             localsdiff.make_delta({}, [])],
+            sent,
+        )
+
+    def test_separate_calls(self):
+        self.differ.diff('c1', {'a': 1})
+        self.assertEqual({'a': 1}, self.differ.diff('c2', {'a': 1}))
+
+    def test_forget(self):
+        self.differ.diff('c1', {'a': 1})
+        self.differ.forget('c1')
+        self.assertEqual({'a': 1}, self.differ.diff('c1', {'a': 1}))
+
+
+class RebuilderTest(testtools.TestCase):
+
+    def test_full_values_unchanged(self):
+        r = localsdiff.Rebuilder()
+        self.assertEqual({'a': 1}, r.rebuild('c1', 'line', {'a': 1}))
+
+    def test_apply_deltas(self):
+        r = localsdiff.Rebuilder()
+        r.rebuild('c1', 'call', {'a': 1, 'b': 2})
+        r.rebuild('c1', 'line', localsdiff.make_delta({'c': 3}, ['a']))
+        self.assertEqual(
+            {'b': 4, 'c': 3},
+            r.rebuild('c1', 'line', localsdiff.make_delta({'b': 4}, [])),
+        )
+
+    def test_return_forgets_call(self):
+        r = localsdiff.Rebuilder()
+        r.rebuild('c1', 'call', {'a': 1})
+        r.rebuild('c1', 'return', localsdiff.make_delta({}, []))
+        self.assertEqual(
+            {'b': 2},
+            r.rebuild('c1', 'line', localsdiff.make_delta({'b': 2}, [])),
+        )
+
+    def test_remember_is_lazy(self):
+        reads = []
+
+        class Source(object):
+            @property
+            def local_vars(self):
+                reads.append(1)
+                return {'a': 1}
+
+        r = localsdiff.Rebuilder()
+        r.remember('c1', 'call', Source())
+        self.assertEqual([], reads)
+        self.assertEqual(
+            {'a': 1, 'b': 2},
+            r.rebuild('c1', 'line', localsdiff.make_delta({'b': 2}, [])),
+        )
+
+    def test_is_encoded_delta(self):
+        self.assertTrue(localsdiff.is_encoded_delta(
+            json.dumps(localsdiff.make_delta({'a': 1}, []))))
+        self.assertFalse(localsdiff.is_encoded_delta(json.dumps({'a': 1})))
+        self.assertFalse(localsdiff.is_encoded_delta(None))
+
+    def test_round_trip(self):
+        differ = localsdiff.Differ(json.dumps)
+        rebuilder = localsdiff.Rebuilder()
+        events = [
+            ('call', {'a': 1}),
+            ('line', {'a': 1, 'b': [1]}),
+            ('line', {'b': [1, 2]}),
+            ('return', {'b': [1, 2], 'c': None}),
+        ]
+        for event, local_vars in events:
+            sent = differ.diff('c1', local_vars)
+            self.assertEqual(local_vars,
+                             rebuilder.rebuild('c1', event, sent))
@@ -1,4 +1,6 @@
 import json
+import threading
+import time
 
 import fixtures
 import mock
@@ -6,6 +8,7 @@ import testtools
 import zmq
 
 from smiley import publisher
+from smiley import wire
 
 
 class PublisherTest(testtools.TestCase):
@@ -14,6 +17,10 @@ class PublisherTest(testtools.TestCase):
         super(PublisherTest, self).setUp()
         self.useFixture(fixtures.FakeLogger())
 
+    def _require_msgpack(self):
+        if wire.msgpack is None:
+            self.skipTest('msgpack is not installed')
+
     @mock.patch('zmq.Context')
     def test_socket_setup(self, context_factory):
         publisher.Publisher('endpoint', 999)
@@ -36,3 +43,202 @@ class PublisherTest(testtools.TestCase):
             [u'message type name'.encode('utf-8'),
              json.dumps(msg).encode('utf-8')]
         )
+
+    @mock.patch('zmq.Context.socket')
+    def test_start_run_announces_codec(self, socket):
+        self._require_msgpack()
+        p = publisher.Publisher('endpoint', 999, codec='msgpack')
+        p.start_run('12345', '/no/such/dir', ['command'], 1370436103.65)
+        s = socket.return_value
+        msg_type, payload = s.send_multipart.call_args[0][0]
+        self.assertEqual(b'start_run', msg_type)
+        self.assertEqual(
+            'msgpack',
+            json.loads(payload.decode('utf-8'))['codec'],
+        )
+
+    @mock.patch('zmq.Context.socket')
+    def test_start_run_sampled(self, socket):
+        p = publisher.Publisher('endpoint', 999)
+        p.start_run('12345', '/no/such/dir', ['command'], 1370436103.65,
+                    sampled=True)
+        s = socket.return_value
+        msg_type, payload = s.send_multipart.call_args[0][0]
+        self.assertTrue(json.loads(payload.decode('utf-8'))['sampled'])
+
+    @mock.patch('zmq.Context.socket')
+    def test_trace_uses_codec(self, socket):
+        self._require_msgpack()
+        p = publisher.Publisher('endpoint', 999, codec='msgpack')
+        p.trace('12345', 't1', 'abcd', 'line', 'f', 1, 'f.py',
+                None, {'a': 1}, 1370436103.65)
+        s = socket.return_value
+        msg_type, payload = s.send_multipart.call_args[0][0]
+        self.assertEqual(b'line', msg_type)
+        decoded = wire.get_codec('msgpack').decode(payload)
+        self.assertEqual({'a': 1}, decoded['local_vars'])
+
+    def test_unknown_codec(self):
+        self.assertRaises(
+            ValueError,
+            publisher.Publisher, 'endpoint', 999, codec='no-such-codec',
+        )
+
+    @mock.patch('zmq.Context.socket')
+    def test_start_run_announces_symbols(self, socket):
+        p = publisher.Publisher('endpoint', 999)
+        p.start_run('12345', '/no/such/dir', ['command'], 1370436103.65)
+        s = socket.return_value
+        msg_type, payload = s.send_multipart.call_args[0][0]
+        self.assertFalse(json.loads(payload.decode('utf-8'))['interned'])
+
+    @mock.patch('zmq.Context.socket')
+    def test_json_sends_strings(self, socket):
+        p = publisher.Publisher('endpoint', 999)
+        p.trace('12345', 't1', 'abcd', 'line', 'f', 1, 'f.py',
+                None, {}, 1370436103.65)
+        s = socket.return_value
+        sent = json.loads(s.send_multipart.call_args[0][0][1])
+        self.assertNotIn('symbols', sent)
+        self.assertEqual(
+            ('t1', 'f.py', 'f'),
+            (sent['thread_id'], sent['filename'], sent['func_name']),
+        )
+
+    @mock.patch('zmq.Context.socket')
+    def test_trace_interns_symbols(self, socket):
+        self._require_msgpack()
+        codec = wire.get_codec('msgpack')
+        p = publisher.Publisher('endpoint', 999, codec='msgpack')
+        s = socket.return_value
+        sent = []
+        for func_name in ['f', 'g']:
+            p.trace('12345', 't1', 'abcd', 'line', func_name, 1, 'f.py',
+                    None, {}, 1370436103.65)
+            sent.append(codec.decode(s.send_multipart.call_args[0][0][1]))
+        self.assertEqual(
+            [[1, 't1'], [2, 'f.py'], [3, 'f']],
+            sent[0]['symbols'],
+        )
+        self.assertEqual([[4, 'g']], sent[1]['symbols'])
+        self.assertEqual(
+            (1, 2, 4),
+            (sent[1]['thread_id'], sent[1]['filename'],
+             sent[1]['func_name']),
+        )
+
+    @mock.patch('zmq.Context.socket')
+    def test_start_run_resets_symbols(self, socket):
+        self._require_msgpack()
+        p = publisher.Publisher('endpoint', 999, codec='msgpack')
+        p.trace('12345', 't1', 'abcd', 'line', 'f', 1, 'f.py',
+                None, {}, 1370436103.65)
+        p.start_run('6789', '/no/such/dir', ['command'], 1370436103.65)
+        p.trace('6789', 't1', 'abcd', 'line', 'f', 1, 'f.py',
+                None, {}, 1370436103.65)
+        s = socket.return_value
+        data = wire.get_codec('msgpack').decode(
+            s.send_multipart.call_args[0][0][1])
+        self.assertEqual(
+            [[1, 't1'], [2, 'f.py'], [3, 'f']],
+            data['symbols'],
+        )
+
+
+class BatchTest(testtools.TestCase):
+
+    def setUp(self):
+        super(BatchTest, self).setUp()
+        self.useFixture(fixtures.FakeLogger())
+        patcher = mock.patch('zmq.Context.socket')
+        self.socket = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _trace(self, p, line_no, func_name='f'):
+        p.trace('12345', 't1', 'abcd', 'line', func_name, line_no, 'f.py',
+                None, {}, 1370436103.65)
+
+    def _sent(self):
+        s = self.socket.return_value
+        return [c[0][0] for c in s.send_multipart.call_args_list]
+
+    def test_batch_size(self):
+        p = publisher.Publisher('endpoint', batch_size=3)
+        for line_no in range(1, 5):
+            self._trace(p, line_no)
+        sent = self._sent()
+        self.assertEqual(1, len(sent))
+        self.assertEqual(b'batch', sent[0][0])
+        self.assertEqual(
+            [1, 2, 3],
+            [json.loads(f)['line_no'] for f in sent[0][2::2]],
+        )
+
+    def test_batch_bytes(self):
+        p = publisher.Publisher('endpoint', batch_size=100, batch_bytes=1)
+        self._trace(p, 1)
+        self._trace(p, 2)
+        self.assertEqual(2, len(self._sent()))
+
+    def test_batch_interval(self):
+        p = publisher.Publisher('endpoint', batch_size=100,
+                                batch_interval=0)
+        self._trace(p, 1)
+        self._trace(p, 2)
+        self.assertEqual(2, len(self._sent()))
+
+    def test_new_symbol_sends_batch(self):
+        if wire.msgpack is None:
+            self.skipTest('msgpack is not installed')
+        codec = wire.get_codec('msgpack')
+        p = publisher.Publisher('endpoint', codec='msgpack', batch_size=100)
+        # The first event defines symbols, so it is sent at once.
+        self._trace(p, 1)
+        self._trace(p, 2)
+        self._trace(p, 3, func_name='g')
+        sent = self._sent()
+        self.assertEqual(2, len(sent))
+        self.assertEqual(
+            [2, 3],
+            [codec.decode(f)['line_no'] for f in sent[1][2::2]],
+        )
+
+    def test_end_run_flushes(self):
+        p = publisher.Publisher('endpoint', batch_size=100)
+        self._trace(p, 1)
+        self._trace(p, 2)
+        p.end_run('12345', 1370436104.65, None, None, None)
+        sent = self._sent()
+        self.assertEqual([b'batch', b'end_run'], [m[0] for m in sent])
+
+    def test_flush_idle_batches(self):
+        p = publisher.Publisher('endpoint', batch_size=100,
+                                batch_interval=0.01)
+        p.start_run('12345', '/no/such/dir', ['command'], 1370436103.65)
+        self.addCleanup(p._stop_flusher)
+        self._trace(p, 1)
+        for i in range(500):
+            if len(self._sent()) > 1:
+                break
+            time.sleep(0.01)
+        self.assertEqual([b'start_run', b'batch'],
+                         [m[0] for m in self._sent()])
+
+    def test_end_run_stops_flusher(self):
+        p = publisher.Publisher('endpoint', batch_size=100)
+        p.start_run('12345', '/no/such/dir', ['command'], 1370436103.65)
+        flusher = p._flusher
+        self.assertTrue(flusher.is_alive())
+        p.end_run('12345', 1370436104.65, None, None, None)
+        self.assertFalse(flusher.is_alive())
+        self.assertIsNone(p._flusher)
+
+    def test_flush_other_threads(self):
+        p = publisher.Publisher('endpoint', batch_size=100)
+        self._trace(p, 1)
+        t = threading.Thread(target=self._trace, args=(p, 2))
+        t.start()
+        t.join()
+        self.assertEqual(0, len(self._sent()))
+        p.flush()
+        self.assertEqual(2, len(self._sent()))
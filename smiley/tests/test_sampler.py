@@ -0,0 +1,99 @@
+import threading
+
+import mock
+import testtools
+
+from smiley import sampler
+
+
+_SAMPLE_SOURCE = '''
+def wait(event):
+    event.wait()
+
+
+def outer(event):
+    wait(event)
+'''
+
+
+class StackSamplerTest(testtools.TestCase):
+
+    def setUp(self):
+        super(StackSamplerTest, self).setUp()
+        self.tracer = mock.Mock()
+        self.tracer.run_id = '12345'
+        self.tracer._lookup_file.side_effect = lambda filename: (
+            filename, filename != '/no/such/sample.py',
+        )
+        self.tracer._match_functions = False
+        self.sampler = sampler.StackSampler(self.tracer, 60)
+        code = compile(_SAMPLE_SOURCE, '/no/such/sample.py', 'exec')
+        self.namespace = {}
+        exec(code, self.namespace)
+        self.event = threading.Event()
+        self.thread = threading.Thread(
+            target=self.namespace['outer'],
+            args=(self.event,),
+            name='worker',
+        )
+        self.thread.start()
+        self.addCleanup(self.thread.join)
+        self.addCleanup(self.event.set)
+
+    def _events(self):
+        events = [(c[1]['event'], c[1]['func_name'], c[1]['line_no'])
+                  for c in self.tracer.publisher.trace.call_args_list
+                  if c[1]['thread_id'] == 'worker']
+        self.tracer.publisher.trace.reset_mock()
+        return events
+
+    def test_new_frames(self):
+        self.sampler.sample()
+        self.assertEqual(
+            [('call', 'outer', 6), ('line', 'outer', 7),
+             ('call', 'wait', 2), ('line', 'wait', 3)],
+            self._events(),
+        )
+
+    def test_ignored_functions(self):
+        self.tracer._match_functions = True
+        self.tracer._classify_code.side_effect = lambda code, g: (
+            code.co_name == 'wait', False,
+        )
+        self.sampler.sample()
+        self.assertEqual(
+            [('call', 'outer', 6), ('line', 'outer', 7)],
+            self._events(),
+        )
+
+    def test_same_frames(self):
+        self.sampler.sample()
+        self._events()
+        self.sampler.sample()
+        self.assertEqual([('line', 'wait', 3)], self._events())
+
+    def test_thread_ended(self):
+        self.sampler.sample()
+        call_ids = [c[1]['call_id']
+                    for c in self.tracer.publisher.trace.call_args_list
+                    if c[1]['event'] == 'call']
+        self._events()
+        self.event.set()
+        self.thread.join()
+        self.sampler.sample()
+        returns = [(c[1]['event'], c[1]['call_id'])
+                   for c in self.tracer.publisher.trace.call_args_list]
+        self.assertEqual(
+            [('return', call_ids[1]), ('return', call_ids[0])],
+            returns,
+        )
+
+    def test_stop_ends_calls(self):
+        self.sampler.sample()
+        self._events()
+        self.sampler.start()
+        self.sampler.stop()
+        self.assertEqual(
+            [('return', 'wait', 3), ('return', 'outer', 7)],
+            self._events(),
+        )
@@ -2,17 +2,28 @@ import atexit
 import logging
 import os
 import site
+import tempfile
 
 import coverage
 import mock
 import testtools
 
+from smiley import db
+from smiley import local
+from smiley import localsdiff
 from smiley import tracer
+from smiley import valuecache
 
 
 LOG = logging.getLogger(__name__)
 
 
+class Thing(object):
+
+    def __init__(self):
+        self.name = 'thing'
+
+
 class TracerTest(testtools.TestCase):
 
     def test_interesting_locals(self):
@@ -30,6 +41,163 @@ class TracerTest(testtools.TestCase):
         interesting = t._get_interesting_locals(f)
         self.assertEqual(interesting, {'simple_name': 1})
 
+    def test_incremental_locals(self):
+        p = mock.Mock()
+        t = tracer.Tracer(p)
+        f = self._make_frame('/no/such/file.py')
+        f.f_locals = {'a': 1}
+        t.trace_calls(f, 'call', None)
+        f.f_locals = {'a': 1, 'b': 2}
+        t.trace_lines(f, 'line', None)
+        sent = [c[1]['local_vars'] for c in p.trace.call_args_list]
+        self.assertEqual(
+            [{'a': 1}, localsdiff.make_delta({'b': 2}, [])],
+            sent,
+        )
+
+    def test_dropped_line_sends_full_locals(self):
+        kept = []
+
+        def trace(**kwargs):
+            # Drop the first line event, as the publisher does when
+            # its queue is full.
+            if kwargs['event'] == 'line' and kwargs['line_no'] == 2:
+                return False
+            kept.append(kwargs)
+        p = mock.Mock()
+        p.trace.side_effect = trace
+        t = tracer.Tracer(p)
+        f = self._make_frame('/no/such/file.py')
+        f.f_locals = {'a': 1}
+        t.trace_calls(f, 'call', None)
+        for line_no, f.f_locals in [(2, {'a': 1, 'b': 2}),
+                                    (3, {'a': 1, 'b': 2, 'c': 3})]:
+            f.f_lineno = line_no
+            t.trace_lines(f, 'line', None)
+        rebuilder = localsdiff.Rebuilder()
+        rebuilt = [rebuilder.rebuild(k['call_id'], k['event'],
+                                     k['local_vars'])
+                   for k in kept]
+        self.assertEqual([{'a': 1}, {'a': 1, 'b': 2, 'c': 3}], rebuilt)
+
+    def test_full_locals(self):
+        p = mock.Mock()
+        t = tracer.Tracer(p, incremental_locals=False)
+        f = self._make_frame('/no/such/file.py')
+        f.f_locals = {'a': 1}
+        t.trace_calls(f, 'call', None)
+        t.trace_lines(f, 'line', None)
+        sent = [c[1]['local_vars'] for c in p.trace.call_args_list]
+        self.assertEqual([{'a': 1}, {'a': 1}], sent)
+
+    def test_truncate_locals(self):
+        p = mock.Mock()
+        t = tracer.Tracer(p, max_items=2, max_string_length=3)
+        f = self._make_frame('/no/such/file.py')
+        f.f_locals = {'a': list(range(5)), 's': 'abcdef'}
+        t.trace_calls(f, 'call', None)
+        sent = p.trace.call_args[1]['local_vars']
+        self.assertEqual([0, 1, '<truncated: 3 more items>'], sent['a'])
+        self.assertEqual('abc<truncated: 3 more characters>', sent['s'])
+
+    def test_truncate_arg(self):
+        p = mock.Mock()
+        t = tracer.Tracer(p, max_items=1)
+        f = self._make_frame('/no/such/file.py')
+        f.f_locals = {}
+        t.trace_calls(f, 'call', None)
+        t.trace_lines(f, 'return', [1, 2])
+        sent = p.trace.call_args[1]['trace_arg']
+        self.assertEqual([1, '<truncated: 1 more items>'], sent)
+
+    def test_no_limits(self):
+        p = mock.Mock()
+        t = tracer.Tracer(p)
+        value = object()
+        f = self._make_frame('/no/such/file.py')
+        f.f_locals = {'a': value}
+        t.trace_calls(f, 'call', None)
+        # Without limits the values are sent as they are.
+        self.assertIs(value, p.trace.call_args[1]['local_vars']['a'])
+
+    def _record_thing(self, **limits):
+        "Trace two events holding the same object, and read them back."
+        the_db = db.DB(':memory:')
+        t = tracer.Tracer(the_db, **limits)
+        t.run_id = 'run'
+        the_db.start_run('run', '/no/such/dir', ['command'], 1.0)
+        thing = Thing()
+        thing.items = ['a' * 50, {'b': 'c'}]
+        f = self._make_frame('/no/such/file.py')
+        f.f_locals = {'a': thing, 'other': 'x' * 50}
+        t.trace_calls(f, 'call', None)
+        t.trace_lines(f, 'line', None)
+        return [e.local_vars['a'] for e in the_db.get_trace('run')]
+
+    def test_value_refs_with_limits(self):
+        for limits in [{'max_depth': 1},
+                       {'max_depth': 2},
+                       {'max_items': 1},
+                       {'max_string_length': 3},
+                       {'max_event_bytes': 10},
+                       {'max_event_bytes': 100}]:
+            first, second = self._record_thing(**limits)
+            self.assertEqual(first, second, limits)
+            self.assertNotIn('not recorded', repr(second), limits)
+
+    def test_value_refs_depth_not_counted(self):
+        first, second = self._record_thing(max_depth=2)
+        self.assertEqual('thing', first['name'])
+
+    def test_value_refs_over_size_limit_sent_again(self):
+        the_db = mock.Mock()
+        t = tracer.Tracer(the_db, max_event_bytes=10)
+        f = self._make_frame('/no/such/file.py')
+        f.f_locals = {'a': Thing()}
+        t.trace_calls(f, 'call', None)
+        t.trace_lines(f, 'line', None)
+        sent = [c[1]['local_vars'] for c in the_db.trace.call_args_list]
+        # The body cut short in the first event is not referred to by
+        # the second one.
+        second = localsdiff.apply_delta(sent[0], sent[1])['a']
+        self.assertEqual(2, valuecache.get_value_id(second))
+        self.assertIn('body', second[valuecache.VALUE_KEY])
+
+    def test_dropped_value_sent_again(self):
+        p = mock.Mock()
+        # Drop the first event.
+        p.trace.side_effect = [False, None]
+        t = tracer.Tracer(p)
+        f = self._make_frame('/no/such/file.py')
+        f.f_locals = {'a': Thing()}
+        t.trace_calls(f, 'call', None)
+        t.trace_lines(f, 'line', None)
+        sent = p.trace.call_args[1]['local_vars']['a']
+        self.assertIn('body', sent[valuecache.VALUE_KEY])
+
+    def test_value_refs(self):
+        p = mock.Mock()
+        t = tracer.Tracer(p, incremental_locals=False)
+        f = self._make_frame('/no/such/file.py')
+        f.f_locals = {'a': Thing()}
+        t.trace_calls(f, 'call', None)
+        t.trace_lines(f, 'line', None)
+        sent = [c[1]['local_vars']['a'] for c in p.trace.call_args_list]
+        self.assertEqual(
+            {'name': 'thing', '__class__': 'Thing', '__module__': __name__},
+            sent[0][valuecache.VALUE_KEY]['body'],
+        )
+        self.assertEqual(valuecache.make_ref(1), sent[1])
+
+    def test_no_value_refs(self):
+        p = mock.Mock()
+        t = tracer.Tracer(p, incremental_locals=False, value_refs=False)
+        value = Thing()
+        f = self._make_frame('/no/such/file.py')
+        f.f_locals = {'a': value}
+        t.trace_calls(f, 'call', None)
+        self.assertIs(value, p.trace.call_args[1]['local_vars']['a'])
+
     def test_ignore_stdlib_maybe_c(self):
         # The atexit module is implemented in C in python 3.3, so it
         # has a different filename and path than under 2.7. However,
@@ -80,3 +248,457 @@ class TracerTest(testtools.TestCase):
     def test_include_site_packages(self):
         t = tracer.Tracer(None, include_site_packages=True)
         self.assertFalse(t._should_ignore_file(mock.__file__))
+
+    def test_file_decision_cached(self):
+        t = tracer.Tracer(None)
+        with mock.patch.object(t, '_classify_file') as classify:
+            classify.return_value = True
+            t._should_ignore_file('/no/such/file.py')
+            t._should_ignore_file('/no/such/file.py')
+        classify.assert_called_once_with('/no/such/file.py')
+
+    def test_lookup_file(self):
+        t = tracer.Tracer(None)
+        filename, ignore = t._lookup_file(tracer.__file__)
+        self.assertEqual(os.path.abspath(tracer.__file__), filename)
+        self.assertTrue(ignore)
+        self.assertIn(tracer.__file__, t._file_cache)
+
+    def test_configure_clears_cache(self):
+        t = tracer.Tracer(None)
+        self.assertTrue(t._lookup_file(tracer.__file__)[1])
+        t.configure(include_packages=['smiley'])
+        self.assertFalse(t._lookup_file(tracer.__file__)[1])
+
+    def _make_frame(self, filename):
+        f = mock.Mock()
+        f.f_code.co_filename = filename
+        f.f_code.co_name = 'func'
+        f.f_lineno = 1
+        f.f_locals = {}
+        return f
+
+    def test_trace_calls_ignored(self):
+        p = mock.Mock()
+        t = tracer.Tracer(p)
+        f = self._make_frame(tracer.__file__)
+        self.assertIsNone(t.trace_calls(f, 'call', None))
+        self.assertFalse(p.trace.called)
+
+    def test_trace_calls_included(self):
+        p = mock.Mock()
+        t = tracer.Tracer(p)
+        f = self._make_frame('/no/such/file.py')
+        self.assertEqual(t.trace_lines, t.trace_calls(f, 'call', None))
+        call_id = p.trace.call_args[1]['call_id']
+        self.assertTrue(call_id)
+        self.assertEqual(call_id, t.uuid_gen.top())
+
+    def test_trace_lines(self):
+        p = mock.Mock()
+        t = tracer.Tracer(p)
+        f = self._make_frame('/no/such/file.py')
+        t.trace_calls(f, 'call', None)
+        call_id = t.uuid_gen.top()
+        self.assertEqual(t.trace_lines, t.trace_lines(f, 'line', None))
+        self.assertEqual(t.trace_lines, t.trace_lines(f, 'return', None))
+        events = [(c[1]['event'], c[1]['call_id'])
+                  for c in p.trace.call_args_list]
+        self.assertEqual(
+            [('call', call_id), ('line', call_id), ('return', call_id)],
+            events,
+        )
+        self.assertIsNone(t.uuid_gen.top())
+
+
+_SAMPLE_SOURCE = '''
+def sample(n):
+    total = 0
+    for i in range(n):
+        total += i
+    return total
+
+
+def fail():
+    raise RuntimeError('failed')
+
+
+def outer(n):
+    return sample(n)
+
+
+def gen(n):
+    for i in range(n):
+        yield i
+
+
+class Thing(object):
+
+    def method(self):
+        return sample(1)
+
+
+def throw_into(n):
+    g = gen(n)
+    next(g)
+    try:
+        g.throw(ValueError('thrown'))
+    except ValueError:
+        pass
+    g = gen(n)
+    next(g)
+    g.close()
+    return n
+'''
+
+
+class BackendTest(testtools.TestCase):
+
+    backend = 'settrace'
+
+    def setUp(self):
+        super(BackendTest, self).setUp()
+        if self.backend == 'monitoring' and not tracer.HAVE_MONITORING:
+            self.skipTest('sys.monitoring is not available')
+        self.publisher = mock.Mock()
+        self.tracer = tracer.Tracer(
+            self.publisher,
+            include_site_packages=False,
+            backend=self.backend,
+        )
+        code = compile(_SAMPLE_SOURCE, '/no/such/sample.py', 'exec')
+        self.namespace = {'__name__': 'sample'}
+        exec(code, self.namespace)
+
+    def _events(self):
+        return [(c[1]['event'], c[1]['line_no'])
+                for c in self.publisher.trace.call_args_list]
+
+    def test_context_type(self):
+        context = self.tracer._make_context()
+        self.assertEqual(
+            self.backend == 'monitoring',
+            isinstance(context, tracer.MonitoringTracerContext),
+        )
+
+    def test_call_line_return(self):
+        with self.tracer._make_context():
+            self.namespace['sample'](1)
+        self.assertEqual(
+            [('call', 2), ('line', 3), ('line', 4), ('line', 5),
+             ('line', 4), ('line', 6), ('return', 6)],
+            self._events(),
+        )
+        return_call = self.publisher.trace.call_args_list[-1]
+        self.assertEqual(0, return_call[1]['trace_arg'])
+
+    def _call_fail(self):
+        try:
+            self.namespace['fail']()
+        except RuntimeError:
+            pass
+        else:
+            self.fail('expected RuntimeError')
+
+    def test_exception(self):
+        with self.tracer._make_context():
+            self._call_fail()
+        self.assertEqual(
+            [('call', 9), ('line', 10), ('exception', 10), ('return', 10)],
+            self._events(),
+        )
+        exc_call = self.publisher.trace.call_args_list[2]
+        self.assertIs(RuntimeError, exc_call[1]['trace_arg'][0])
+
+    def test_call_ids_balanced(self):
+        with self.tracer._make_context():
+            self.namespace['sample'](2)
+            self._call_fail()
+        self.assertIsNone(self.tracer.uuid_gen.top())
+
+    def _calls_and_returns(self):
+        return [(c[1]['event'], c[1]['func_name'], c[1]['call_id'])
+                for c in self.publisher.trace.call_args_list
+                if c[1]['event'] in ('call', 'return')]
+
+    def test_generator_throw_and_close(self):
+        with self.tracer._make_context():
+            self.namespace['throw_into'](2)
+        self.assertIsNone(self.tracer.uuid_gen.top())
+        events = self._calls_and_returns()
+        self.assertEqual(
+            [('call', 'throw_into'),
+             ('call', 'gen'), ('return', 'gen'),
+             ('call', 'gen'), ('return', 'gen'),
+             ('call', 'gen'), ('return', 'gen'),
+             ('call', 'gen'), ('return', 'gen'),
+             ('return', 'throw_into')],
+            [e[:2] for e in events],
+        )
+        # The outer call keeps its id after the generators return.
+        self.assertEqual(events[0][2], events[-1][2])
+        self.assertTrue(all(e[2] for e in events))
+
+    def test_exclude_functions(self):
+        t = tracer.Tracer(
+            self.publisher,
+            include_site_packages=False,
+            backend=self.backend,
+            exclude_functions=['sample.sample'],
+        )
+        with t._make_context():
+            self.namespace['outer'](1)
+        self.assertEqual(
+            ['outer'],
+            [c[1]['func_name'] for c in self.publisher.trace.call_args_list
+             if c[1]['event'] == 'call'],
+        )
+
+
+class MonitoringBackendTest(BackendTest):
+
+    backend = 'monitoring'
+
+    def test_ignored_code_disabled(self):
+        with self.tracer._make_context() as context:
+            os.path.join('a', 'b')
+            self.assertNotIn(os.path.join.__code__, context._traced_code)
+        self.assertEqual([], self._events())
+
+
+class FunctionFilterTest(testtools.TestCase):
+
+    def setUp(self):
+        super(FunctionFilterTest, self).setUp()
+        self.publisher = mock.Mock()
+        code = compile(_SAMPLE_SOURCE, '/no/such/sample.py', 'exec')
+        self.namespace = {'__name__': 'sample'}
+        exec(code, self.namespace)
+
+    def _trace(self, calls, **kwargs):
+        t = tracer.Tracer(
+            self.publisher,
+            include_site_packages=False,
+            backend='settrace',
+            **kwargs
+        )
+        with t._make_context():
+            for name in calls:
+                self.namespace[name](1)
+        self.assertIsNone(t.uuid_gen.top())
+        return [c[1]['func_name']
+                for c in self.publisher.trace.call_args_list
+                if c[1]['event'] == 'call']
+
+    def test_include_function(self):
+        self.assertEqual(
+            ['outer'],
+            self._trace(['outer'], include_functions=['sample.outer']),
+        )
+
+    def test_include_module(self):
+        self.assertEqual(
+            ['outer', 'sample'],
+            self._trace(['outer'], include_functions=['sample']),
+        )
+
+    def test_include_other_module(self):
+        self.assertEqual(
+            [],
+            self._trace(['outer'], include_functions=['other.*']),
+        )
+
+    def test_exclude_pattern(self):
+        self.assertEqual(
+            ['outer'],
+            self._trace(['outer'], exclude_functions=['sample.s*']),
+        )
+
+    def test_qualified_name(self):
+        if not hasattr(self.test_qualified_name.__code__, 'co_qualname'):
+            self.skipTest('co_qualname requires python 3.11 or later')
+        t = tracer.Tracer(
+            self.publisher,
+            include_site_packages=False,
+            backend='settrace',
+            include_functions=['sample.Thing.*'],
+        )
+        with t._make_context():
+            self.namespace['Thing']().method()
+        self.assertEqual(
+            ['method'],
+            [c[1]['func_name']
+             for c in self.publisher.trace.call_args_list
+             if c[1]['event'] == 'call'],
+        )
+
+    def test_trigger(self):
+        self.assertEqual(
+            ['outer', 'sample'],
+            self._trace(['sample', 'outer', 'sample'],
+                        triggers=['sample.outer']),
+        )
+
+    def test_trigger_with_exclude(self):
+        self.assertEqual(
+            ['outer'],
+            self._trace(['outer'], triggers=['sample.outer'],
+                        exclude_functions=['sample.sample']),
+        )
+
+    def test_trigger_not_included(self):
+        # The trigger is traced even if it does not match the
+        # functions to include.
+        self.assertEqual(
+            ['outer', 'sample'],
+            self._trace(['outer'], triggers=['sample.outer'],
+                        include_functions=['sample.sample']),
+        )
+
+    def test_sampled_triggers(self):
+        self.assertEqual(
+            ['outer', 'sample'],
+            self._trace(['outer', 'outer', 'outer'],
+                        triggers=['sample.outer'], sample_calls=2),
+        )
+
+    def test_configure_clears_cache(self):
+        t = tracer.Tracer(self.publisher, exclude_functions=['sample.*'])
+        t._classify_code(self.namespace['sample'].__code__, self.namespace)
+        t.configure()
+        self.assertEqual({}, t._code_cache)
+
+
+class SampleCallsTest(testtools.TestCase):
+
+    def setUp(self):
+        super(SampleCallsTest, self).setUp()
+        self.publisher = mock.Mock()
+        self.tracer = tracer.Tracer(
+            self.publisher,
+            include_site_packages=False,
+            backend='settrace',
+            sample_calls=2,
+        )
+        code = compile(_SAMPLE_SOURCE, '/no/such/sample.py', 'exec')
+        self.namespace = {'__name__': 'sample'}
+        exec(code, self.namespace)
+
+    def _calls(self):
+        return [c[1]['func_name']
+                for c in self.publisher.trace.call_args_list
+                if c[1]['event'] == 'call']
+
+    def test_one_in_n(self):
+        with self.tracer._make_context():
+            for i in range(4):
+                self.namespace['sample'](1)
+        self.assertEqual(['sample', 'sample'], self._calls())
+
+    def test_nested_calls_traced(self):
+        with self.tracer._make_context():
+            self.namespace['sample'](1)
+            self.namespace['outer'](1)
+        self.assertEqual(['outer', 'sample'], self._calls())
+        self.assertIsNone(self.tracer.uuid_gen.top())
+
+    def test_only_top_level_calls_counted(self):
+        with self.tracer._make_context():
+            self.namespace['outer'](1)
+            self.namespace['outer'](1)
+        # The call to sample() made by the first outer() is skipped
+        # with it, instead of being sampled on its own.
+        self.assertEqual(['outer', 'sample'], self._calls())
+
+    def test_generator_resumed(self):
+        with self.tracer._make_context():
+            for i in self.namespace['gen'](4):
+                pass
+        events = [c[1]['event']
+                  for c in self.publisher.trace.call_args_list]
+        self.assertEqual(events.count('call'), events.count('return'))
+        self.assertIsNone(self.tracer.uuid_gen.top())
+
+    def test_no_profile(self):
+        context = self.tracer._make_context()
+        self.assertIsNone(context.get_stats_data())
+
+
+class AttachTest(testtools.TestCase):
+
+    def setUp(self):
+        super(AttachTest, self).setUp()
+        self.publisher = mock.Mock()
+
+    def test_attach_detach(self):
+        t = tracer.Tracer(self.publisher, sample_interval=60)
+        t.attach(['service'])
+        self.assertIsInstance(t._context, tracer.NullTracerContext)
+        run_id = t.run_id
+        self.publisher.start_run.assert_called_once_with(
+            run_id, os.getcwd(), ['service'], mock.ANY, sampled=True,
+        )
+        t.detach()
+        self.publisher.end_run.assert_called_once_with(
+            run_id, end_time=mock.ANY, message=None, traceback=None,
+            stats=None,
+        )
+        self.assertIsNone(t.run_id)
+        self.assertIsNone(t._sampler)
+
+    def test_attach_twice(self):
+        db_file = tempfile.NamedTemporaryFile()
+        self.addCleanup(db_file.close)
+        t = tracer.Tracer(local.LocalPublisher(db_file.name),
+                          sample_interval=60)
+        run_ids = []
+        for i in range(2):
+            t.attach(['service'])
+            run_ids.append(t.run_id)
+            t.detach()
+        runs = db.DB(db_file.name).get_runs()
+        self.assertEqual(run_ids, [r.id for r in runs])
+        self.assertTrue(all(r.end_time for r in runs))
+
+    def test_not_sampled(self):
+        t = tracer.Tracer(self.publisher)
+        self.assertFalse(t.sampled)
+        self.assertIsInstance(t._make_context(), tracer.TracerContext)
+        self.assertIsNotNone(t._make_context().profile)
+
+
+class BackendSelectionTest(testtools.TestCase):
+
+    def test_unknown_backend(self):
+        self.assertRaises(ValueError, tracer.Tracer, None, backend='no-such')
+
+    def test_auto(self):
+        t = tracer.Tracer(None)
+        if tracer.HAVE_MONITORING:
+            self.assertEqual('monitoring', t.backend)
+        else:
+            self.assertEqual('settrace', t.backend)
+
+    def test_sample_calls_uses_settrace(self):
+        t = tracer.Tracer(None, sample_calls=10)
+        self.assertEqual('settrace', t.backend)
+
+    def test_triggers_use_settrace(self):
+        t = tracer.Tracer(None, triggers=['app.handler'])
+        self.assertEqual('settrace', t.backend)
+
+    def test_triggers_monitoring(self):
+        if not tracer.HAVE_MONITORING:
+            self.skipTest('sys.monitoring is not available')
+        t = tracer.Tracer(None, backend='monitoring')
+        self.assertRaises(ValueError, t.configure, triggers=['app.handler'])
+
+    def test_sample_calls_monitoring(self):
+        self.assertRaises(ValueError, tracer.Tracer, None,
+                          backend='monitoring', sample_calls=10)
+
+    def test_monitoring_unavailable(self):
+        if tracer.HAVE_MONITORING:
+            self.skipTest('sys.monitoring is available')
+        self.assertRaises(ValueError, tracer.Tracer, None,
+                          backend='monitoring')
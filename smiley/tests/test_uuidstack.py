@@ -1,3 +1,5 @@
+import threading
+
 import testtools
 
 from smiley import uuidstack
@@ -28,3 +30,14 @@ class UUIDStackTest(testtools.TestCase):
         t2 = self.stack.pop()
         self.assertEqual(t1, t2)
         self.assertEqual(self.stack._stack, [])
+
+    def test_pop_empty(self):
+        self.assertIsNone(self.stack.pop())
+
+    def test_per_thread(self):
+        self.stack.push()
+        seen = []
+        t = threading.Thread(target=lambda: seen.append(self.stack.top()))
+        t.start()
+        t.join()
+        self.assertEqual([None], seen)
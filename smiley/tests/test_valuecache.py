@@ -0,0 +1,175 @@
+import testtools
+
+from smiley import jsonutil
+from smiley import localsdiff
+from smiley import valuecache
+
+
+class Thing(object):
+
+    def __init__(self):
+        self.name = 'thing'
+        self.items = [1, 2]
+
+
+class ValueCacheTest(testtools.TestCase):
+
+    def setUp(self):
+        super(ValueCacheTest, self).setUp()
+        self.cache = valuecache.ValueCache()
+
+    def test_first_time_full(self):
+        thing = Thing()
+        token = self.cache.encode({'t': thing})['t']
+        self.assertEqual(
+            valuecache.make_value(1, jsonutil.simplify(thing)),
+            token,
+        )
+
+    def test_unchanged_ref(self):
+        thing = Thing()
+        self.cache.encode({'t': thing})
+        self.assertEqual(
+            {'t': valuecache.make_ref(1)},
+            self.cache.encode({'t': thing}),
+        )
+
+    def test_changed_attribute(self):
+        thing = Thing()
+        self.cache.encode({'t': thing})
+        thing.name = 'other'
+        token = self.cache.encode({'t': thing})['t']
+        self.assertEqual(2, valuecache.get_value_id(token))
+        self.assertEqual('other', token[valuecache.VALUE_KEY]['body']['name'])
+
+    def test_nested_mutation(self):
+        thing = Thing()
+        self.cache.encode({'t': thing})
+        thing.items.append(3)
+        token = self.cache.encode({'t': thing})['t']
+        self.assertEqual([1, 2, 3],
+                         token[valuecache.VALUE_KEY]['body']['items'])
+
+    def test_scalar_type_changed(self):
+        thing = Thing()
+        thing.x = 1
+        self.cache.encode({'t': thing})
+        thing.x = True
+        token = self.cache.encode({'t': thing})['t']
+        self.assertEqual(2, valuecache.get_value_id(token))
+
+    def test_list_item_type_changed(self):
+        thing = Thing()
+        self.cache.encode({'t': thing})
+        thing.items = [1.0, 2]
+        token = self.cache.encode({'t': thing})['t']
+        self.assertEqual(2, valuecache.get_value_id(token))
+
+    def test_forget(self):
+        thing = Thing()
+        local_vars = self.cache.encode({'t': thing})
+        self.cache.forget(local_vars)
+        token = self.cache.encode({'t': thing})['t']
+        self.assertIn('body', token[valuecache.VALUE_KEY])
+
+    def test_forget_refs_ignored(self):
+        thing = Thing()
+        self.cache.encode({'t': thing})
+        self.cache.forget(self.cache.encode({'t': thing}))
+        self.assertEqual(
+            {'t': valuecache.make_ref(1)},
+            self.cache.encode({'t': thing}),
+        )
+
+    def test_plain_values_unchanged(self):
+        local_vars = {'a': 1, 'b': [1, 2], 'c': {'d': 'e'}}
+        self.assertIs(local_vars, self.cache.encode(local_vars))
+
+    def test_oldest_forgotten(self):
+        cache = valuecache.ValueCache(max_size=1)
+        first = Thing()
+        cache.encode({'t': first})
+        cache.encode({'t': Thing()})
+        token = cache.encode({'t': first})['t']
+        self.assertIn('body', token[valuecache.VALUE_KEY])
+
+    def test_new_run(self):
+        thing = Thing()
+        self.cache.encode({'t': thing})
+        cache = self.cache.new_run()
+        token = cache.encode({'t': thing})['t']
+        self.assertEqual(1, valuecache.get_value_id(token))
+        self.assertIn('body', token[valuecache.VALUE_KEY])
+
+
+class ExtractResolveTest(testtools.TestCase):
+
+    def test_round_trip(self):
+        saved = {}
+        local_vars = {
+            'a': 1,
+            'b': valuecache.make_value(1, {'x': 2}),
+            'c': valuecache.make_ref(1),
+        }
+        stored = valuecache.extract(local_vars, saved.__setitem__)
+        self.assertEqual({1: {'x': 2}}, saved)
+        self.assertEqual(
+            {'a': 1,
+             'b': valuecache.make_ref(1),
+             'c': valuecache.make_ref(1)},
+            stored,
+        )
+        self.assertEqual(
+            {'a': 1, 'b': {'x': 2}, 'c': {'x': 2}},
+            valuecache.resolve(stored, saved.get),
+        )
+
+    def test_delta(self):
+        saved = {}
+        local_vars = localsdiff.make_delta(
+            {'b': valuecache.make_value(3, [1])}, ['a'],
+        )
+        stored = valuecache.extract(local_vars, saved.__setitem__)
+        self.assertEqual(
+            localsdiff.make_delta({'b': valuecache.make_ref(3)}, ['a']),
+            stored,
+        )
+        self.assertEqual(
+            localsdiff.make_delta({'b': [1]}, ['a']),
+            valuecache.resolve(stored, saved.get),
+        )
+
+    def test_no_values(self):
+        local_vars = {'a': 1}
+        self.assertIs(local_vars,
+                      valuecache.extract(local_vars, lambda *a: None))
+        self.assertIs(local_vars, valuecache.resolve(local_vars, None))
+
+    def test_value_table(self):
+        table = valuecache.ValueTable()
+        self.assertEqual(
+            {'b': 'body'},
+            table.resolve({'b': valuecache.make_value(1, 'body')}),
+        )
+        self.assertEqual(
+            {'b': 'body', 'c': valuecache.missing(2)},
+            table.resolve({'b': valuecache.make_ref(1),
+                           'c': valuecache.make_ref(2)}),
+        )
+
+    def test_signature_nested_change(self):
+        value = {'a': [1, {'b': 2}]}
+        before = valuecache.signature(value)
+        value['a'][1]['b'] = 3
+        self.assertNotEqual(before, valuecache.signature(value))
+
+    def test_signature_too_large(self):
+        self.assertIsNone(valuecache.signature(
+            list(range(valuecache.SIGNATURE_NODES + 1))
+        ))
+
+    def test_signature_matches_ref(self):
+        self.assertEqual(
+            valuecache.signature(valuecache.make_value(1, 'body')),
+            valuecache.signature(valuecache.make_ref(1)),
+        )
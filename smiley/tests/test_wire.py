@@ -0,0 +1,72 @@
+import testtools
+
+from smiley import wire
+
+
+class Circular(object):
+
+    def __init__(self):
+        self.me = self
+
+
+class CodecTests(object):
+
+    def test_round_trip(self):
+        data = {
+            'func_name': 'f',
+            'line_no': 42,
+            'timestamp': 1370436104.65,
+            'arg': None,
+            'local_vars': {'a': [1, 'two', 3.0], 'b': {'c': True}},
+        }
+        self.assertEqual(data, self.codec.decode(self.codec.encode(data)))
+
+    def test_tuple_becomes_list(self):
+        data = {'a': (1, 2)}
+        self.assertEqual(
+            {'a': [1, 2]},
+            self.codec.decode(self.codec.encode(data)),
+        )
+
+    def test_object(self):
+        class Point(object):
+            def __init__(self):
+                self.x = 1
+        decoded = self.codec.decode(self.codec.encode({'p': Point()}))
+        self.assertEqual(1, decoded['p']['x'])
+        self.assertEqual('Point', decoded['p']['__class__'])
+
+    def test_circular(self):
+        decoded = self.codec.decode(self.codec.encode({'c': Circular()}))
+        self.assertEqual('Circular', decoded['c']['__class__'])
+        self.assertIsInstance(decoded['c']['me'], type(u''))
+
+
+class JSONCodecTest(CodecTests, testtools.TestCase):
+
+    codec = wire.JSON
+
+    def test_payload(self):
+        self.assertEqual(b'{"a": 1}', self.codec.encode({'a': 1}))
+
+
+class MsgpackCodecTest(CodecTests, testtools.TestCase):
+
+    def setUp(self):
+        super(MsgpackCodecTest, self).setUp()
+        if wire.msgpack is None:
+            self.skipTest('msgpack is not installed')
+        self.codec = wire.get_codec('msgpack')
+
+    def test_int_keys(self):
+        data = {'a': {1: 'one'}}
+        self.assertEqual(data, self.codec.decode(self.codec.encode(data)))
+
+
+class GetCodecTest(testtools.TestCase):
+
+    def test_json(self):
+        self.assertIs(wire.JSON, wire.get_codec('json'))
+
+    def test_unknown(self):
+        self.assertRaises(ValueError, wire.get_codec, 'no-such-codec')
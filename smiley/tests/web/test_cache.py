@@ -0,0 +1,100 @@
+import fixtures
+import mock
+import testtools
+
+from smiley import db
+from smiley.web import cache
+from smiley.web.controllers import run_context
+
+
+class EstimateSizeTest(testtools.TestCase):
+
+    def test_contents_counted(self):
+        small = cache.estimate_size({'a': [1]})
+        big = cache.estimate_size({'a': list(range(1000))})
+        self.assertGreater(big, small)
+
+    def test_cycle(self):
+        data = []
+        data.append(data)
+        self.assertGreater(cache.estimate_size(data), 0)
+
+    def test_slots(self):
+        t = db.Trace(
+            id=1, run_id='1', thread_id='t1', call_id='1', event='line',
+            filename='filename.py', line_no=1, func_name='func',
+            trace_arg=None, local_vars={'a': 'x' * 10000}, timestamp=1,
+        )
+        self.assertGreater(cache.estimate_size(t), 10000)
+
+
+class LRUCacheTest(testtools.TestCase):
+
+    def setUp(self):
+        super(LRUCacheTest, self).setUp()
+        self.useFixture(fixtures.FakeLogger())
+        self.cache = cache.LRUCache(100)
+
+    def test_get_missing(self):
+        self.assertIsNone(self.cache.get(('a',)))
+
+    def test_set_and_get(self):
+        self.cache.set(('a',), 'value', size=10)
+        self.assertEqual('value', self.cache.get(('a',)))
+        self.assertEqual(10, self.cache.size)
+
+    def test_replace(self):
+        self.cache.set(('a',), 'value', size=10)
+        self.cache.set(('a',), 'other', size=20)
+        self.assertEqual('other', self.cache.get(('a',)))
+        self.assertEqual(20, self.cache.size)
+
+    def test_evict_least_recently_used(self):
+        self.cache.set(('a',), 'a', size=40)
+        self.cache.set(('b',), 'b', size=40)
+        self.cache.get(('a',))
+        self.cache.set(('c',), 'c', size=40)
+        self.assertIn(('a',), self.cache)
+        self.assertNotIn(('b',), self.cache)
+        self.assertIn(('c',), self.cache)
+        self.assertEqual(80, self.cache.size)
+
+    def test_too_big(self):
+        self.cache.set(('a',), 'a', size=40)
+        self.cache.set(('b',), 'b', size=101)
+        self.assertNotIn(('b',), self.cache)
+        self.assertIn(('a',), self.cache)
+
+    def test_get_or_compute(self):
+        compute = mock.Mock(return_value='value')
+        self.assertEqual('value', self.cache.get_or_compute(('a',), compute))
+        self.assertEqual('value', self.cache.get_or_compute(('a',), compute))
+        self.assertEqual(1, compute.call_count)
+
+    def test_invalidate(self):
+        self.cache.set(('db', 'run1', 'trace', None), 'a', size=10)
+        self.cache.set(('db', 'run1', 'trace', 't1'), 'b', size=10)
+        self.cache.set(('db', 'run2', 'trace', None), 'c', size=10)
+        self.cache.invalidate('db', 'run1')
+        self.assertEqual(1, len(self.cache))
+        self.assertIn(('db', 'run2', 'trace', None), self.cache)
+        self.assertEqual(10, self.cache.size)
+
+
+class RunContextTest(testtools.TestCase):
+
+    def setUp(self):
+        super(RunContextTest, self).setUp()
+        self.useFixture(fixtures.FakeLogger())
+        self.db = db.DB(':memory:')
+        self.db.start_run('12345', '/no/such/dir', ['command'], 1370436103.65)
+        self.cache = cache.LRUCache(1024 * 1024)
+
+    def test_running_not_cached(self):
+        run_context.get_context(self.db, '12345', None, self.cache)
+        self.assertEqual(0, len(self.cache))
+
+    def test_ended_cached(self):
+        self.db.end_run('12345', 1370436104.65, None, None, None)
+        run_context.get_context(self.db, '12345', None, self.cache)
+        self.assertIn((':memory:', '12345', 'thread_details'), self.cache)
@@ -1,11 +1,13 @@
 import atexit
 import cProfile
-import imp
+import fnmatch
 import inspect
+import itertools
 import logging
 import os
 import pstats
 import random
+import re
 import site
 import socket
 import sys
@@ -19,34 +21,228 @@ from coverage.misc import ExceptionDuringRun
 import six
 
 import smiley
+from smiley import jsonutil
+from smiley import localsdiff
+from smiley import sampler
 from smiley.stats import stats_to_blob
 from smiley import uuidstack
+from smiley import valuecache
+
+try:
+    from importlib.util import find_spec
+except ImportError:
+    # python 2
+    import imp
+    find_spec = None
 
 LOG = logging.getLogger(__name__)
 
+# sys.monitoring (PEP 669) was added in python 3.12.
+HAVE_MONITORING = hasattr(sys, 'monitoring')
+
+BACKENDS = ('auto', 'settrace', 'monitoring')
+
+
+def _find_module(name):
+    """Return the filename of a module, or directory of a package.
+    """
+    if find_spec is None:
+        f, filename, description = imp.find_module(name)
+        if f:
+            f.close()
+        return filename
+    spec = find_spec(name)
+    if spec is None:
+        raise ImportError('No module named %s' % name)
+    if spec.submodule_search_locations:
+        return list(spec.submodule_search_locations)[0]
+    return spec.origin
+
+
+def _compile_patterns(patterns):
+    """Return a regex matching any of the shell-style patterns, or None.
+    """
+    if not patterns:
+        return None
+    return re.compile('|'.join(
+        '(?:%s)' % fnmatch.translate(p) for p in patterns
+    ))
+
 
 class TracerContext(object):
+    """Install the tracer using sys.settrace() and threading.settrace().
+
+    If all_threads is true, threads that are already running are
+    traced too, where the interpreter supports it (python 3.12 and
+    later). Otherwise only the current thread and threads started
+    later are traced. If profile is false, no profiling stats are
+    collected.
+    """
 
-    def __init__(self, tracer):
+    def __init__(self, tracer, profile=True, all_threads=False):
         self.tracer = tracer
-        self.profile = cProfile.Profile()
+        self.profile = cProfile.Profile() if profile else None
+        self.all_threads = (all_threads and
+                            hasattr(threading, 'settrace_all_threads'))
 
     def __enter__(self):
-        self.profile.enable()
-        sys.settrace(self.tracer.trace_calls)
-        threading.settrace(self.tracer.trace_calls)
+        if self.profile is not None:
+            self.profile.enable()
+        self._install()
         return self
 
     def __exit__(self, *args):
-        sys.settrace(None)
-        threading.settrace(None)
-        self.profile.disable()
+        self._uninstall()
+        if self.profile is not None:
+            self.profile.disable()
+
+    def _install(self):
+        if self.all_threads:
+            threading.settrace_all_threads(self.tracer.trace_calls)
+        else:
+            sys.settrace(self.tracer.trace_calls)
+            threading.settrace(self.tracer.trace_calls)
+
+    def _uninstall(self):
+        if self.all_threads:
+            threading.settrace_all_threads(None)
+        else:
+            sys.settrace(None)
+            threading.settrace(None)
 
     def get_stats_data(self):
+        if self.profile is None:
+            return None
         stats = pstats.Stats(self.profile)
         return stats_to_blob(stats)
 
 
+class NullTracerContext(TracerContext):
+    """Do not install any hooks, for runs that only sample stacks.
+    """
+
+    def _install(self):
+        pass
+
+    def _uninstall(self):
+        pass
+
+
+class MonitoringTracerContext(TracerContext):
+    """Install the tracer using sys.monitoring (PEP 669).
+
+    Only PY_START, and the exception events that cannot be enabled
+    for a single code object, are monitored everywhere. The first
+    time a code object starts, the callback either enables the other
+    events for that code object or returns DISABLE so the interpreter
+    stops reporting it. Ignored code costs nothing after its first call.
+    Monitoring applies to all threads, so there is no separate hook
+    for new threads.
+    """
+
+    TOOL_NAME = 'smiley'
+
+    def __init__(self, tracer, profile=True, all_threads=False):
+        super(MonitoringTracerContext, self).__init__(tracer, profile)
+        self._monitoring = sys.monitoring
+        self._events = self._monitoring.events
+        self._tool_id = self._monitoring.DEBUGGER_ID
+        self._traced_code = set()
+        self._callbacks = {
+            self._events.PY_START: self._py_start,
+            self._events.PY_RESUME: self._py_resume,
+            self._events.PY_THROW: self._py_throw,
+            self._events.PY_RETURN: self._py_return,
+            self._events.PY_YIELD: self._py_return,
+            self._events.PY_UNWIND: self._py_unwind,
+            self._events.LINE: self._line,
+            self._events.RAISE: self._raise,
+        }
+
+    def _install(self):
+        self._monitoring.use_tool_id(self._tool_id, self.TOOL_NAME)
+        for event, callback in self._callbacks.items():
+            self._monitoring.register_callback(self._tool_id, event, callback)
+        self._monitoring.set_events(
+            self._tool_id,
+            self._events.PY_START | self._events.PY_UNWIND |
+            self._events.PY_THROW | self._events.RAISE,
+        )
+
+    def _uninstall(self):
+        self._monitoring.set_events(self._tool_id, self._events.NO_EVENTS)
+        for code in self._traced_code:
+            self._monitoring.set_local_events(
+                self._tool_id, code, self._events.NO_EVENTS,
+            )
+        self._traced_code.clear()
+        for event in self._callbacks:
+            self._monitoring.register_callback(self._tool_id, event, None)
+        self._monitoring.free_tool_id(self._tool_id)
+        # Re-enable the locations we turned off with DISABLE.
+        self._monitoring.restart_events()
+
+    # The callbacks run inside the monitored frame, so the frame one
+    # level up from the callback is the one generating the event.
+
+    def _py_start(self, code, instruction_offset):
+        filename, ignore = self.tracer._lookup_file(code.co_filename)
+        if not ignore and self.tracer._match_functions:
+            ignore = self.tracer._classify_code(
+                code, sys._getframe(1).f_globals,
+            )[0]
+        if ignore:
+            return self._monitoring.DISABLE
+        if code not in self._traced_code:
+            self._monitoring.set_local_events(
+                self._tool_id, code,
+                self._events.PY_RESUME | self._events.PY_RETURN |
+                self._events.PY_YIELD | self._events.LINE,
+            )
+            self._traced_code.add(code)
+        self.tracer._record_call(sys._getframe(1), filename, None)
+
+    def _py_resume(self, code, instruction_offset):
+        # Resuming a generator looks like a new call to settrace.
+        filename = self.tracer._lookup_file(code.co_filename)[0]
+        self.tracer._record_call(sys._getframe(1), filename, None)
+
+    def _py_throw(self, code, instruction_offset, exception):
+        # throw() and close() resume a generator too, but PY_THROW
+        # can only be monitored everywhere, like PY_UNWIND.
+        if code not in self._traced_code:
+            return
+        filename = self.tracer._lookup_file(code.co_filename)[0]
+        self.tracer._record_call(sys._getframe(1), filename, None)
+
+    def _py_return(self, code, instruction_offset, retval):
+        filename = self.tracer._lookup_file(code.co_filename)[0]
+        self.tracer._record_event(sys._getframe(1), filename,
+                                  'return', retval)
+
+    def _py_unwind(self, code, instruction_offset, exception):
+        # Leaving a frame because of an exception is reported to
+        # settrace as a return with no value.
+        if code not in self._traced_code:
+            return
+        filename = self.tracer._lookup_file(code.co_filename)[0]
+        self.tracer._record_event(sys._getframe(1), filename,
+                                  'return', None)
+
+    def _line(self, code, line_number):
+        filename = self.tracer._lookup_file(code.co_filename)[0]
+        self.tracer._record_event(sys._getframe(1), filename, 'line', None)
+
+    def _raise(self, code, instruction_offset, exception):
+        if code not in self._traced_code:
+            return
+        filename = self.tracer._lookup_file(code.co_filename)[0]
+        self.tracer._record_event(
+            sys._getframe(1), filename, 'exception',
+            (type(exception), exception, exception.__traceback__),
+        )
+
+
 class Tracer(object):
 
     def _canonical_path(self, path):
@@ -60,12 +256,131 @@ class Tracer(object):
     def __init__(self, publisher,
                  include_stdlib=False,
                  include_site_packages=True,
-                 include_packages=[]):
+                 include_packages=[],
+                 backend='auto',
+                 incremental_locals=True,
+                 value_refs=True,
+                 max_depth=None,
+                 max_items=None,
+                 max_string_length=None,
+                 max_event_bytes=None,
+                 sample_calls=0,
+                 sample_interval=None,
+                 include_functions=[],
+                 exclude_functions=[],
+                 triggers=[]):
         self.publisher = publisher
-        # FIXME: Use a thread-local
         self.run_id = None
-        self.canonical_filenames = {}
         self.uuid_gen = uuidstack.UUIDStack()
+        # Unless told otherwise, only send the local variables that
+        # changed since the previous event in the same call.
+        if incremental_locals:
+            self._locals_differ = localsdiff.Differ(valuecache.signature)
+        else:
+            self._locals_differ = None
+        # Limits on the size of the values sent with each event, or
+        # None to send them whole.
+        encoder = jsonutil.Encoder(
+            max_depth=max_depth,
+            max_items=max_items,
+            max_string_length=max_string_length,
+            max_bytes=max_event_bytes,
+        )
+        self._encoder = encoder if encoder.has_limits else None
+        # Unless told otherwise, send objects that have not changed
+        # since they were last sent as references.
+        if value_refs:
+            self._value_cache = valuecache.ValueCache(encoder)
+        else:
+            self._value_cache = None
+        # Trace only one out of every sample_calls top-level calls,
+        # along with everything they call.
+        self.sample_calls = sample_calls if sample_calls > 1 else 0
+        self._call_counter = itertools.count(1)
+        # The call on each thread that started the part of the program
+        # being traced, when only some calls are traced.
+        self._root_local = threading.local()
+        # Seconds between samples of the stacks of all threads, or
+        # None to not sample them.
+        self.sample_interval = sample_interval or None
+        self.sampled = bool(self.sample_calls or self.sample_interval)
+        self._sampler = None
+        self._context = None
+        # Threads may still be inside the hooks when the run ends, so
+        # events are only published while holding this lock, and
+        # dropped once the run is over.
+        self._publish_lock = threading.Lock()
+        self._detached = False
+        if backend not in BACKENDS:
+            raise ValueError('unknown tracing backend %r' % backend)
+        if backend == 'monitoring' and not HAVE_MONITORING:
+            raise ValueError(
+                'the monitoring backend requires python 3.12 or later'
+            )
+        if backend == 'monitoring' and self.sample_calls:
+            # Events are turned on for code objects, not frames, so
+            # the other calls to a sampled function would be
+            # reported, too.
+            raise ValueError(
+                'sampling calls requires the settrace backend'
+            )
+        if backend == 'auto':
+            if HAVE_MONITORING and not (self.sample_calls or triggers):
+                backend = 'monitoring'
+            else:
+                backend = 'settrace'
+        self.backend = backend
+        self.configure(
+            include_stdlib=include_stdlib,
+            include_site_packages=include_site_packages,
+            include_packages=include_packages,
+            include_functions=include_functions,
+            exclude_functions=exclude_functions,
+            triggers=triggers,
+        )
+
+    def configure(self, include_stdlib=False, include_site_packages=True,
+                  include_packages=[], include_functions=[],
+                  exclude_functions=[], triggers=[]):
+        """Set which files and functions are traced.
+
+        The function patterns are shell-style patterns matched against
+        the module name and the qualified name of each function, such
+        as "app.views" or "app.views.Handler.*". If include_functions
+        is not empty only matching functions are traced, and
+        functions matching exclude_functions are never traced.
+
+        If triggers is not empty nothing is traced until a matching
+        function is called, and tracing stops again when it returns.
+        The trigger functions themselves are always traced, if their
+        files are.
+
+        Clears the cached decisions about files and functions that
+        have already been seen, so this may be called again to change
+        the settings.
+        """
+        if triggers and self.backend == 'monitoring':
+            # Like sampling, triggers start tracing for one frame.
+            raise ValueError('triggers require the settrace backend')
+        # Map the co_filename of code objects to the canonical version
+        # of the name and whether that file should be ignored. Code
+        # objects from the same file share a co_filename, and the
+        # hash of a string is cached, so this is cheaper than keying
+        # on the code object itself.
+        self._file_cache = {}
+        # The ignore decision for a canonical filename.
+        self._ignore_cache = {}
+        # Map code objects to whether they are ignored because of the
+        # function patterns, and whether they are triggers.
+        self._code_cache = {}
+        self._include_functions = _compile_patterns(include_functions)
+        self._exclude_functions = _compile_patterns(exclude_functions)
+        self._triggers = _compile_patterns(triggers)
+        self._match_functions = bool(
+            include_functions or exclude_functions or triggers
+        )
+        # Only some calls are traced, along with the calls they make.
+        self._root_calls = bool(self.sample_calls or triggers)
 
         # Build the list of paths to ignore or include, based on
         # similar logic from coverage's control.py, by Ned Batchelder,
@@ -114,9 +429,7 @@ class Tracer(object):
         self._include_packages = set()
         for name in include_packages:
             try:
-                f, filename, description = imp.find_module(name)
-                if f:
-                    f.close()
+                filename = _find_module(name)
             except ImportError as e:
                 LOG.info('Could not find %r to include it: %s',
                          name, e)
@@ -143,6 +456,12 @@ class Tracer(object):
         else:
             self._sitepkgdir = None
 
+        # Tuples of prefixes can be checked with a single call to
+        # str.startswith().
+        self._include_prefixes = tuple(self._include_packages)
+        self._ignore_prefixes = tuple(self._ignore_dirs)
+        self._stdlib_prefixes = tuple(self._stdlibdirs)
+
     def _get_interesting_locals(self, frame):
         return {
             n: v
@@ -158,9 +477,18 @@ class Tracer(object):
         }
 
     def _should_ignore_file(self, filename):
+        try:
+            return self._ignore_cache[filename]
+        except KeyError:
+            ignore = self._ignore_cache[filename] = self._classify_file(
+                filename,
+            )
+            return ignore
+
+    def _classify_file(self, filename):
         # FIXME: Need to add the ability to explicitly not ignore some
         # things in the stdlib to trace into dependencies.
-        # LOG.debug('_should_ignore_file(%s)', filename)
+        # LOG.debug('_classify_file(%s)', filename)
         if not filename:
             return True
         if filename.endswith('>'):
@@ -173,108 +501,297 @@ class Tracer(object):
         # anyway, and just ignore it.
         if 'pkg_resources' in filename:
             return True
-        for d in self._include_packages:
-            # LOG.debug('checking include package %s', d)
-            if filename.startswith(d):
-                # LOG.debug('including package %s', filename)
-                return False
-        for d in self._ignore_dirs:
-            # LOG.debug('checking ignore directory %s', d)
-            if filename.startswith(d):
-                # LOG.debug('ignoring package %s', filename)
-                return True
-        if self._sitepkgdir:
-            # LOG.debug('checking site-packages %s', self._sitepkgdir)
-            if filename.startswith(self._sitepkgdir):
-                # LOG.debug('including %s', filename)
-                return False
-        for d in self._stdlibdirs:
-            # LOG.debug('checking stdlib %s', d)
-            if filename.startswith(d):
-                # LOG.debug('ignoring stdlib %s', filename)
-                return True
+        if filename.startswith(self._include_prefixes):
+            # LOG.debug('including package %s', filename)
+            return False
+        if filename.startswith(self._ignore_prefixes):
+            # LOG.debug('ignoring package %s', filename)
+            return True
+        if self._sitepkgdir and filename.startswith(self._sitepkgdir):
+            # LOG.debug('including %s', filename)
+            return False
+        if filename.startswith(self._stdlib_prefixes):
+            # LOG.debug('ignoring stdlib %s', filename)
+            return True
         # LOG.debug('defaulting to including %s', filename)
         return False
 
-    def _send_notice(self, thread_id, frame, event, arg, call_id):
-        co = frame.f_code
-        func_name = co.co_name
-        line_no = frame.f_lineno
-        # Expand the filename path to include the full directory so we
-        # can decide whether to ignore it or not, and so the remote
-        # side knows *exactly* which file we are looking at.
-        filename = os.path.abspath(co.co_filename)
-        interesting_locals = self._get_interesting_locals(frame)
-        self.publisher.trace(
-            run_id=self.run_id,
-            thread_id=thread_id,
-            call_id=call_id,
-            event=event,
-            func_name=func_name,
-            line_no=line_no,
-            filename=filename,
-            trace_arg=arg,
-            local_vars=interesting_locals,
-            timestamp=time.time(),
+    def _lookup_file(self, co_filename):
+        """Return the canonical filename and whether to ignore it.
+        """
+        try:
+            return self._file_cache[co_filename]
+        except KeyError:
+            pass
+        if co_filename is None:
+            filename = None
+        else:
+            filename = os.path.abspath(co_filename)
+        result = (filename, self._should_ignore_file(filename))
+        self._file_cache[co_filename] = result
+        return result
+
+    def _classify_code(self, code, f_globals):
+        """Return whether to ignore code, and whether it is a trigger.
+        """
+        try:
+            return self._code_cache[code]
+        except KeyError:
+            pass
+        module = f_globals.get('__name__') or ''
+        # co_qualname was added in python 3.11.
+        qualname = getattr(code, 'co_qualname', code.co_name)
+        names = (module, '%s.%s' % (module, qualname))
+
+        def matches(regex):
+            return regex is not None and any(regex.match(n) for n in names)
+
+        ignore = (
+            (self._include_functions is not None and
+             not matches(self._include_functions)) or
+            matches(self._exclude_functions)
         )
+        result = (ignore, matches(self._triggers))
+        self._code_cache[code] = result
+        return result
 
-    def trace_calls(self, frame, event, arg):
-        co = frame.f_code
-        filename = co.co_filename
-        if filename is not None:
-            canonical = self.canonical_filenames.get(filename)
-            if canonical is not None:
-                filename = canonical
-            else:
-                full = os.path.abspath(filename)
-                self.canonical_filenames[filename] = full
-                filename = full
-        if self._should_ignore_file(filename):
+    def _send_notice(self, thread_id, frame, filename, event, arg, call_id):
+        if self._detached:
             return
-        if event == 'call':
-            call_id = self.uuid_gen.push()
-        elif event == 'return':
+        func_name = frame.f_code.co_name
+        line_no = frame.f_lineno
+        interesting_locals = self._get_interesting_locals(frame)
+        if self._value_cache is not None:
+            # With limits, the bodies of new values are left for the
+            # encoder, so they are truncated without their wrappers
+            # and share the size limit of the event.
+            interesting_locals = self._value_cache.encode(
+                interesting_locals, simplify=self._encoder is None,
+            )
+        if self._encoder is not None:
+            # Truncate large values before they are compared or
+            # encoded again.
+            arg, interesting_locals = self._encoder.simplify_all(
+                [arg, interesting_locals],
+            )
+        if self._locals_differ is not None:
+            interesting_locals = self._locals_differ.diff(
+                call_id, interesting_locals,
+            )
+            if event == 'return':
+                self._locals_differ.forget(call_id)
+        with self._publish_lock:
+            if self._detached:
+                return
+            recorded = self.publisher.trace(
+                run_id=self.run_id,
+                thread_id=thread_id,
+                call_id=call_id,
+                event=event,
+                func_name=func_name,
+                line_no=line_no,
+                filename=filename,
+                trace_arg=arg,
+                local_vars=interesting_locals,
+                timestamp=time.time(),
+            )
+        if recorded is False:
+            # The publisher dropped the event, so the next one in the
+            # call cannot be sent as changes from it, and values first
+            # sent with it must be sent again.
+            if self._locals_differ is not None:
+                self._locals_differ.forget(call_id)
+            if self._value_cache is not None:
+                self._value_cache.forget(interesting_locals)
+
+    def _record_call(self, frame, filename, arg):
+        call_id = self.uuid_gen.push()
+        thread_id = threading.current_thread().name
+        self._send_notice(thread_id, frame, filename, 'call', arg, call_id)
+
+    def _record_event(self, frame, filename, event, arg):
+        if event == 'return':
             call_id = self.uuid_gen.pop()
         else:
             call_id = self.uuid_gen.top()
-        thread_id = threading.currentThread().name
-        self._send_notice(thread_id, frame, event, arg, call_id)
-        return self.trace_calls
+        thread_id = threading.current_thread().name
+        self._send_notice(thread_id, frame, filename, event, arg, call_id)
 
-    def run(self, command_line):
+    def trace_calls(self, frame, event, arg):
+        """Global trace function, called when a new frame starts.
+
+        Decides once per frame whether the code is interesting.
+        Returning None for ignored frames means the interpreter never
+        reports their line, return, or exception events at all.
+        """
+        # Expand the filename path to include the full directory so we
+        # can decide whether to ignore it or not, and so the remote
+        # side knows *exactly* which file we are looking at.
+        filename, ignore = self._lookup_file(frame.f_code.co_filename)
+        if ignore or self._detached:
+            return None
+        if ((self._match_functions or self._root_calls) and
+                not self._select_call(frame)):
+            # Returning None does not remove the local trace function
+            # set when a generator was traced before it yielded.
+            frame.f_trace = None
+            return None
+        self._record_call(frame, filename, arg)
+        return self.trace_lines
+
+    def trace_lines(self, frame, event, arg):
+        """Local trace function, only used for frames being traced.
+        """
+        filename = self._lookup_file(frame.f_code.co_filename)[0]
+        self._record_event(frame, filename, event, arg)
+        if (self._root_calls and event == 'return' and
+                frame is getattr(self._root_local, 'root', None)):
+            # The triggered or sampled call is over.
+            self._root_local.root = None
+        return self.trace_lines
+
+    def _select_call(self, frame):
+        """Return whether to trace a new frame from an interesting file.
+
+        When triggers or call sampling are used, the selected call is
+        remembered as the root, and the calls made while it is
+        running on the same thread are traced unless their functions
+        are ignored. Call sampling only counts top-level calls, which
+        are not made from another call that could have been a root,
+        so a call that is not chosen is skipped along with everything
+        it calls.
+        """
+        if self._match_functions:
+            ignore, trigger = self._classify_code(frame.f_code,
+                                                  frame.f_globals)
+        else:
+            ignore = trigger = False
+        if not self._root_calls:
+            return not ignore
+        if getattr(self._root_local, 'root', None) is not None:
+            return not ignore
+        if self._triggers is not None:
+            if not trigger:
+                return False
+        elif ignore:
+            return False
+        if self.sample_calls:
+            if self._has_root_caller(frame):
+                return False
+            if next(self._call_counter) % self.sample_calls:
+                return False
+        self._root_local.root = frame
+        return True
+
+    def _could_be_root(self, frame):
+        "Return whether a frame could have been chosen as a root."
+        if self._lookup_file(frame.f_code.co_filename)[1]:
+            return False
+        if self._match_functions:
+            ignore, trigger = self._classify_code(frame.f_code,
+                                                  frame.f_globals)
+        else:
+            ignore = trigger = False
+        if self._triggers is not None:
+            return trigger
+        return not ignore
+
+    def _has_root_caller(self, frame):
+        "Return whether a frame was called, at any depth, by a root."
+        caller = frame.f_back
+        while caller is not None:
+            if self._could_be_root(caller):
+                return True
+            caller = caller.f_back
+        return False
+
+    def _make_context(self, all_threads=False):
+        if self.sample_interval and not self._root_calls:
+            return NullTracerContext(self, profile=False)
+        # Profiling every call would undo the savings of sampling, or
+        # of tracing only after a trigger.
+        profile = not (self.sampled or self._root_calls)
+        if self.backend == 'monitoring':
+            return MonitoringTracerContext(self, profile, all_threads)
+        return TracerContext(self, profile, all_threads)
+
+    def _start(self, description, all_threads):
         self.run_id = str(uuid.uuid4())
-        context = TracerContext(self)
+        # Forget calls left open when an earlier run was detached.
+        self.uuid_gen = uuidstack.UUIDStack()
+        if self._value_cache is not None:
+            # Value ids are only unique within a run.
+            self._value_cache = self._value_cache.new_run()
+        self._root_local = threading.local()
+        self._detached = False
+        self._context = self._make_context(all_threads)
+        self._context.__enter__()
+        self.publisher.start_run(
+            self.run_id,
+            os.getcwd(),
+            description,
+            time.time(),
+            sampled=self.sampled,
+        )
+        if self.sample_interval:
+            self._sampler = sampler.StackSampler(self, self.sample_interval)
+            self._sampler.start()
+
+    def _stop_tracing(self):
+        if self._sampler is not None:
+            self._sampler.stop()
+            self._sampler = None
+        context, self._context = self._context, None
+        context.__exit__(None, None, None)
+        with self._publish_lock:
+            self._detached = True
+        return context
+
+    def attach(self, description=None):
+        """Start a new run in a program that is already running.
+
+        Use this to trace a long-running service without starting it
+        under smiley. The description of the run defaults to
+        sys.argv. Sampling stacks without sampling calls adds no
+        hooks to the program, so it is the cheapest way to watch a
+        busy service. Call detach() to end the run.
+        """
+        if description is None:
+            description = sys.argv
+        self._start(description, all_threads=True)
+
+    def detach(self, message=None, traceback=None):
+        """Stop tracing and end the run started by attach().
+        """
+        context = self._stop_tracing()
+        self.publisher.end_run(
+            self.run_id,
+            end_time=time.time(),
+            message=message,
+            traceback=traceback,
+            stats=context.get_stats_data(),
+        )
+        self.run_id = None
+
+    def run(self, command_line):
+        self._start(command_line, all_threads=False)
         try:
-            with context:
-                self.publisher.start_run(
-                    self.run_id,
-                    os.getcwd(),
-                    command_line,
-                    time.time(),
-                )
-                run_python_file(
-                    command_line[0],
-                    command_line,
-                )
+            run_python_file(
+                command_line[0],
+                command_line,
+            )
         except ExceptionDuringRun as err:
             # Unpack the wrapped exception
             err_type, orig_err, traceback = err.args
             try:
-                self.publisher.end_run(
-                    self.run_id,
-                    end_time=time.time(),
+                self.detach(
                     message=six.text_type(orig_err),
                     traceback=traceback,
-                    stats=context.get_stats_data(),
                 )
             finally:
                 del traceback  # remove circular reference for GC
+        except BaseException:
+            self._stop_tracing()
+            raise
         else:
-            self.publisher.end_run(
-                self.run_id,
-                time.time(),
-                message=None,
-                traceback=None,
-                stats=context.get_stats_data(),
-            )
-            self.run_id = None
+            self.detach()
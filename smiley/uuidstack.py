@@ -1,9 +1,12 @@
 """Manage a "stack" of UUID values for unique entries into a function.
 
-The owner of the stack manages when calls enter and exit.
+The owner of the stack manages when calls enter and exit. Each
+thread has its own stack, since calls in different threads do not
+nest inside each other.
 
 """
 
+import threading
 import uuid
 
 import six
@@ -12,7 +15,15 @@ import six
 class UUIDStack(object):
 
     def __init__(self):
-        self._stack = []
+        self._local = threading.local()
+
+    @property
+    def _stack(self):
+        try:
+            return self._local.stack
+        except AttributeError:
+            stack = self._local.stack = []
+            return stack
 
     def top(self):
         if not self._stack:
@@ -20,7 +31,11 @@ class UUIDStack(object):
         return self._stack[-1]
 
     def push(self):
-        self._stack.append(six.text_type(uuid.uuid4()))
+        new_id = six.text_type(uuid.uuid4())
+        self._stack.append(new_id)
+        return new_id
 
     def pop(self):
+        if not self._stack:
+            return None
         return self._stack.pop()
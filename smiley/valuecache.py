@@ -0,0 +1,360 @@
+"""Send objects that have not changed as references to earlier copies.
+
+The first time the tracer sees an object as the value of a local
+variable it sends the whole value, wrapped in a dictionary with the
+single key VALUE_KEY along with an id for the value. When the same
+object is seen again with the same contents, only the id is sent.
+
+The contents are compared using a fingerprint built from the values
+the encoder would send, which is much cheaper to make than the
+encoded value itself.
+
+The database saves each value once, and replaces the references with
+the saved values when events are read. The monitor keeps the values
+in memory in a ValueTable.
+"""
+
+import collections
+import datetime
+import decimal
+import functools
+import itertools
+import threading
+import uuid
+
+import six
+
+from smiley import jsonutil
+from smiley import localsdiff
+
+VALUE_KEY = '__smiley_value__'
+
+# Number of objects the tracer remembers.
+DEFAULT_CACHE_SIZE = 10000
+
+# Containers and items to visit while making the signature of one
+# variable.
+SIGNATURE_NODES = 1000
+
+# Values that are compared directly in fingerprints.
+_SCALAR_TYPES = frozenset(
+    (type(None), bool, float, six.binary_type) +
+    six.string_types + six.integer_types
+)
+
+# Other types whose values cannot change, and so can be compared
+# directly.
+_IMMUTABLE_TYPES = (
+    complex, datetime.date, datetime.time, datetime.timedelta,
+    decimal.Decimal, uuid.UUID,
+)
+
+
+def make_value(value_id, body):
+    return {VALUE_KEY: {'id': value_id, 'body': body}}
+
+
+def make_ref(value_id):
+    return {VALUE_KEY: {'id': value_id}}
+
+
+def get_value_id(value):
+    "Return the value id of a value or reference, or None."
+    if isinstance(value, dict) and len(value) == 1 and VALUE_KEY in value:
+        return value[VALUE_KEY]['id']
+    return None
+
+
+def signature(value):
+    """Return a value to compare with localsdiff.Differ.
+
+    A value and the references to it have the same signature. Other
+    values are compared by a fingerprint of their contents, or None
+    if they are too large to compare cheaply.
+    """
+    value_id = get_value_id(value)
+    if value_id is not None:
+        return (VALUE_KEY, value_id)
+    maker = _Fingerprint(float('inf'), None, SIGNATURE_NODES)
+    try:
+        return maker.make(value, 0)
+    except _NoFingerprint:
+        return None
+
+
+def _variables(local_vars):
+    "Return the dict of variables in local_vars, which may be a delta."
+    if localsdiff.is_delta(local_vars):
+        return local_vars[localsdiff.DELTA_KEY]['changed']
+    if isinstance(local_vars, dict):
+        return local_vars
+    return {}
+
+
+def _replace_variables(local_vars, variables):
+    if localsdiff.is_delta(local_vars):
+        return localsdiff.make_delta(
+            variables, local_vars[localsdiff.DELTA_KEY]['removed'],
+        )
+    return variables
+
+
+def extract(local_vars, save):
+    """Replace values in local_vars with references.
+
+    save(value_id, body) is called for each value. Returns local_vars,
+    or a copy if any values were replaced.
+    """
+    variables = _variables(local_vars)
+    replaced = None
+    for name, value in variables.items():
+        value_id = get_value_id(value)
+        if value_id is None or 'body' not in value[VALUE_KEY]:
+            continue
+        save(value_id, value[VALUE_KEY]['body'])
+        if replaced is None:
+            replaced = dict(variables)
+        replaced[name] = make_ref(value_id)
+    if replaced is None:
+        return local_vars
+    return _replace_variables(local_vars, replaced)
+
+
+def resolve(local_vars, lookup):
+    """Replace values and references in local_vars with their bodies.
+
+    lookup(value_id) returns the body of a reference. Returns
+    local_vars, or a copy if anything was replaced.
+    """
+    variables = _variables(local_vars)
+    replaced = None
+    for name, value in variables.items():
+        value_id = get_value_id(value)
+        if value_id is None:
+            continue
+        if replaced is None:
+            replaced = dict(variables)
+        if 'body' in value[VALUE_KEY]:
+            replaced[name] = value[VALUE_KEY]['body']
+        else:
+            replaced[name] = lookup(value_id)
+    if replaced is None:
+        return local_vars
+    return _replace_variables(local_vars, replaced)
+
+
+def missing(value_id):
+    "The text shown for a value that was not recorded."
+    return '<value %s not recorded>' % value_id
+
+
+class ValueTable(object):
+    """Resolve references using the values seen in earlier events.
+    """
+
+    def __init__(self):
+        self._bodies = {}
+
+    def _lookup(self, value_id):
+        try:
+            return self._bodies[value_id]
+        except KeyError:
+            return missing(value_id)
+
+    def resolve(self, local_vars):
+        local_vars = extract(local_vars, self._bodies.__setitem__)
+        return resolve(local_vars, self._lookup)
+
+
+class _NoFingerprint(Exception):
+    pass
+
+
+class _Fingerprint(object):
+    """Build a value that compares equal for objects with equal contents.
+    """
+
+    def __init__(self, max_depth, max_items, max_nodes):
+        self.max_depth = max_depth
+        self.max_items = max_items
+        self.nodes = max_nodes
+        # ids of the containers being visited, to find cycles.
+        self.active = set()
+
+    def _visit(self, count):
+        self.nodes -= count
+        if self.nodes < 0:
+            raise _NoFingerprint()
+
+    def make(self, value, depth):
+        cls = type(value)
+        if cls in _SCALAR_TYPES or isinstance(value, _IMMUTABLE_TYPES):
+            # Include the type, because 1, 1.0, and True are equal but
+            # are sent differently.
+            return (cls, value)
+        if isinstance(value, type):
+            # Classes are sent as their repr(), which does not change.
+            return value
+        self._visit(1)
+        if depth >= self.max_depth:
+            # The encoder only sends the type and size.
+            try:
+                return (cls, len(value))
+            except Exception:
+                return (cls,)
+        key = id(value)
+        if key in self.active:
+            return (cls, 'cycle')
+        self.active.add(key)
+        try:
+            if issubclass(cls, (list, tuple)):
+                items = value
+                if (self.max_items is not None and
+                        len(value) > self.max_items):
+                    items = value[:self.max_items]
+                self._visit(len(items))
+                if _SCALAR_TYPES.issuperset(map(type, items)):
+                    return (cls, len(value),
+                            tuple((type(v), v) for v in items))
+                return (cls, len(value),
+                        tuple(self.make(v, depth + 1) for v in items))
+            if issubclass(cls, dict):
+                self._visit(len(value))
+                items = itertools.islice(value.items(), self.max_items)
+                return (cls, len(value),
+                        tuple(((type(k), k), self.make(v, depth + 1))
+                              for k, v in items))
+            if jsonutil.is_object(value):
+                try:
+                    attrs = vars(value)
+                except TypeError:
+                    raise _NoFingerprint()
+                # The attributes are at the same depth as the object.
+                return (cls, self.make_dict(attrs, depth))
+            raise _NoFingerprint()
+        finally:
+            self.active.discard(key)
+
+    def make_dict(self, value, depth):
+        self._visit(len(value))
+        items = itertools.islice(value.items(), self.max_items)
+        return (len(value),
+                tuple((k, self.make(v, depth + 1)) for k, v in items))
+
+
+class ValueCache(object):
+    """Remember the objects sent by the tracer during one run.
+
+    encoder is the jsonutil.Encoder used to convert objects when they
+    are sent, and its limits are used to decide which parts of an
+    object to compare. Objects too large to compare cheaply, or
+    holding types that can't be compared, are always sent whole.
+    """
+
+    # Nodes to visit while making one fingerprint.
+    MAX_NODES = 10000
+
+    def __init__(self, encoder=None, max_size=DEFAULT_CACHE_SIZE):
+        self._encoder = encoder or jsonutil.Encoder()
+        self._max_depth = self._encoder.max_depth
+        if self._max_depth is None:
+            self._max_depth = float('inf')
+        self._max_items = self._encoder.max_items
+        self._max_size = max_size
+        # id(object) -> (fingerprint, value id), oldest first.
+        self._entries = collections.OrderedDict()
+        # value id -> id(object), for the same entries.
+        self._keys = {}
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+
+    def new_run(self):
+        "Return an empty cache with the same settings."
+        return ValueCache(self._encoder, self._max_size)
+
+    def _fingerprint(self, value):
+        maker = _Fingerprint(self._max_depth, self._max_items,
+                             self.MAX_NODES)
+        try:
+            return maker.make(value, 0)
+        except _NoFingerprint:
+            return None
+
+    def _encode_value(self, value, simplify):
+        fingerprint = self._fingerprint(value)
+        if fingerprint is None:
+            return value
+        key = id(value)
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                if entry[0] == fingerprint:
+                    self._entries[key] = entry
+                    ref = make_ref(entry[1])
+                    if not simplify:
+                        # Keep the encoder from truncating the
+                        # reference itself.
+                        return jsonutil.Wrapper(
+                            None, lambda converted, complete: ref,
+                        )
+                    return ref
+                del self._keys[entry[1]]
+            value_id = next(self._ids)
+            self._entries[key] = (fingerprint, value_id)
+            self._keys[value_id] = key
+            if len(self._entries) > self._max_size:
+                old_id = self._entries.popitem(last=False)[1][1]
+                del self._keys[old_id]
+        if not simplify:
+            return jsonutil.Wrapper(
+                value, functools.partial(self._make_value, value_id),
+            )
+        return make_value(value_id, self._encoder.simplify(value))
+
+    def _make_value(self, value_id, body, complete):
+        if not complete:
+            # The body may have been cut short to fit the size of the
+            # event, so send the object again next time.
+            self._forget_ids([value_id])
+        return make_value(value_id, body)
+
+    def _forget_ids(self, value_ids):
+        with self._lock:
+            for value_id in value_ids:
+                key = self._keys.pop(value_id, None)
+                if key is not None:
+                    del self._entries[key]
+
+    def forget(self, local_vars):
+        """Send the values first sent in local_vars in full again.
+
+        Use this when the event holding local_vars was not recorded,
+        so later references to the values would not find them.
+        """
+        self._forget_ids(
+            value[VALUE_KEY]['id']
+            for value in _variables(local_vars).values()
+            if get_value_id(value) is not None and 'body' in value[VALUE_KEY]
+        )
+
+    def encode(self, local_vars, simplify=True):
+        """Return local_vars with objects replaced by values or references.
+
+        If simplify is false, the values and references are returned
+        as jsonutil.Wrapper objects instead, so the caller's encoder
+        converts the bodies along with the rest of an event, under the
+        same limits.
+        """
+        replaced = None
+        for name, value in local_vars.items():
+            if not jsonutil.is_object(value):
+                continue
+            token = self._encode_value(value, simplify)
+            if token is value:
+                continue
+            if replaced is None:
+                replaced = dict(local_vars)
+            replaced[name] = token
+        if replaced is None:
+            return local_vars
+        return replaced
@@ -3,6 +3,9 @@ from smiley.web import model
 from smiley.web import hooks
 
 
+DEFAULT_CACHE_SIZE = 64 * 1024 * 1024
+
+
 def setup_app(config):
 
     model.init_model()
@@ -20,5 +23,7 @@ def setup_app(config):
             True),
         hooks=[
             hooks.DBHook(config.smiley.database_name),
+            hooks.CacheHook(getattr(config.smiley, 'cache_size',
+                                    DEFAULT_CACHE_SIZE)),
         ],
     )
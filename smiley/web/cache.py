@@ -0,0 +1,106 @@
+"""Cache values computed for the web views between requests.
+"""
+
+import collections
+import logging
+import sys
+import threading
+
+LOG = logging.getLogger(__name__)
+
+
+def estimate_size(value, _seen=None):
+    """Return the approximate number of bytes used by value.
+
+    Follows the contents of containers and the attributes of objects,
+    counting each object only once.
+    """
+    if _seen is None:
+        _seen = set()
+    if id(value) in _seen:
+        return 0
+    _seen.add(id(value))
+    size = sys.getsizeof(value)
+    if isinstance(value, dict):
+        for k, v in value.items():
+            size += estimate_size(k, _seen) + estimate_size(v, _seen)
+    elif isinstance(value, (list, tuple, set, frozenset)):
+        for v in value:
+            size += estimate_size(v, _seen)
+    else:
+        for name in getattr(type(value), '__slots__', ()):
+            size += estimate_size(getattr(value, name, None), _seen)
+        if hasattr(value, '__dict__'):
+            size += estimate_size(vars(value), _seen)
+    return size
+
+
+class LRUCache(object):
+    """Keep the most recently used values, up to a total size.
+
+    Keys are tuples, so all of the values for the same prefix can be
+    removed together by invalidate(). The cache is shared by all
+    requests, so it can be used from several threads.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value, size = self._entries.pop(key)
+            except KeyError:
+                return default
+            # Move to the most recently used end.
+            self._entries[key] = (value, size)
+            return value
+
+    def set(self, key, value, size=None):
+        if size is None:
+            size = estimate_size(value)
+        with self._lock:
+            self._remove(key)
+            if size > self.max_bytes:
+                LOG.debug('not caching %r, %d bytes is too big', key, size)
+                return
+            while self._entries and self.size + size > self.max_bytes:
+                old_key = next(iter(self._entries))
+                LOG.debug('evicting %r', old_key)
+                self._remove(old_key)
+            self._entries[key] = (value, size)
+            self.size += size
+
+    def get_or_compute(self, key, compute):
+        """Return the cached value for key, or compute and cache it.
+        """
+        missing = object()
+        value = self.get(key, missing)
+        if value is missing:
+            LOG.debug('computing %r', key)
+            value = compute()
+            self.set(key, value)
+        return value
+
+    def _remove(self, key):
+        try:
+            value, size = self._entries.pop(key)
+        except KeyError:
+            return
+        self.size -= size
+
+    def invalidate(self, *prefix):
+        "Remove all of the values with keys starting with prefix."
+        n = len(prefix)
+        with self._lock:
+            for key in [k for k in self._entries if k[:n] == prefix]:
+                self._remove(key)
@@ -5,7 +5,7 @@ from smiley import web
 _web_pkg_dir = os.path.dirname(web.__file__)
 
 
-def get_config_dict(database_name, host, port):
+def get_config_dict(database_name, host, port, cache_size=64 * 1024 * 1024):
     return {
 
         # Server Specific Configurations
@@ -29,6 +29,7 @@ def get_config_dict(database_name, host, port):
 
         'smiley': {
             'database_name': database_name,
+            'cache_size': cache_size,
         },
 
         'beaker': {
@@ -12,4 +12,5 @@ class DeleteController(object):
         """Delete a run and redirect to the list of runs"""
         if run_id:
             request.db.delete_run(run_id)
+            request.cache.invalidate(request.db.name, run_id)
         redirect("/runs")
@@ -12,9 +12,12 @@ class FileController(RestController):
     @nav.active_section('runs', 'files')
     def get_one(self, run_id, file_id):
         filename, body = request.db.get_cached_file_by_id(run_id, file_id)
-        styled_body = syntax.apply_style(filename, body)
+        styled_body = syntax.get_styled_file(
+            request.db, file_id, filename, body,
+        )
 
-        context = run_context.get_context(request.db, run_id, None)
+        context = run_context.get_context(request.db, run_id, None,
+                                          request.cache)
         context.update({
             'filename': filename,
             'body': body,
@@ -26,7 +29,8 @@ class FileController(RestController):
     @nav.active_section('runs', 'files')
     def get_all(self, run_id):
         # TODO: Add option to only show error runs
-        context = run_context.get_context(request.db, run_id, None)
+        context = run_context.get_context(request.db, run_id, None,
+                                          request.cache)
         context.update({
             'files': request.db.get_files_for_run(run_id),
         })
@@ -1,9 +1,18 @@
 
 
-def get_context(db, run_id, thread_id):
+def get_context(db, run_id, thread_id, cache=None):
+    run = db.get_run(run_id)
+    if cache is not None and run.end_time is not None:
+        # The threads of a run only change until it ends.
+        thread_details = cache.get_or_compute(
+            (db.name, run_id, 'thread_details'),
+            lambda: list(db.get_thread_details(run_id)),
+        )
+    else:
+        thread_details = list(db.get_thread_details(run_id))
     return {
         'run_id': run_id,
-        'run': db.get_run(run_id),
+        'run': run,
         'thread_id': thread_id,
-        'thread_details': list(db.get_thread_details(run_id)),
+        'thread_details': thread_details,
     }
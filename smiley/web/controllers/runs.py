@@ -27,9 +27,6 @@ class RunController(RestController):
     stats = stats.StatsController()
     threads = thread_controller.ThreadController()
 
-    _cached_ids = (None, None)
-    _cached_trace = None
-
     @expose(generic=True, template='runs.html')
     @nav.active_section('runs')
     def get_all(self):
@@ -64,23 +61,38 @@ class RunController(RestController):
         # in the session.
         thread_id = thread_id or None
 
-        if (run_id, thread_id) == self._cached_ids and self._cached_trace:
-            LOG.debug('using cached trace for %s', run_id)
-            trace_data = self._cached_trace
-        else:
-            LOG.debug('computing trace for %s', run_id)
-            trace_data = list(
-                trace.collapse_trace(request.db.get_trace(run_id, thread_id))
+        try:
+            num_items = trace.collapsed_trace_size(
+                request.db, run_id, thread_id,
+            )
+        except db.NoSuchRun as e:
+            # No such run.
+            abort(404, six.text_type(e))
+
+        trace_data = None
+        if num_items is None:
+            # The run has not ended, so the collapsed trace is not
+            # indexed and we have to build all of it.
+            trace_data = request.cache.get_or_compute(
+                (request.db.name, run_id, 'trace', thread_id),
+                lambda: list(trace.collapse_trace(
+                    request.db.get_trace(run_id, thread_id)
+                )),
             )
-            self._cached_ids = (run_id, thread_id)
-            self._cached_trace = trace_data
+            num_items = len(trace_data)
         syntax_line_cache = syntax.StyledLineCache(request.db, run_id)
 
         page_vals = pagination.get_pagination_values(
-            page, per_page, len(trace_data),
+            page, per_page, num_items,
         )
         start = page_vals['start']
         end = page_vals['end']
+        if trace_data is None:
+            page_trace = trace.collapsed_trace_range(
+                request.db, run_id, thread_id, start, end,
+            )
+        else:
+            page_trace = trace_data[start:end]
 
         def getlines(filename, nums):
             start, end = nums
@@ -88,12 +100,13 @@ class RunController(RestController):
                                               include_comments=True)
 
         try:
-            context = run_context.get_context(request.db, run_id, thread_id)
+            context = run_context.get_context(request.db, run_id, thread_id,
+                                              request.cache)
         except db.NoSuchRun as e:
             # No such run.
             abort(404, six.text_type(e))
         context.update({
-            'trace': trace_data[start:end],
+            'trace': page_trace,
             'getlines': getlines,
             'getfileid': functools.partial(request.db.get_file_signature,
                                            run_id=run_id),
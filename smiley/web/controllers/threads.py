@@ -10,4 +10,5 @@ class ThreadController(RestController):
     @expose(generic=True, template='threads.html')
     @nav.active_section('runs', 'threads')
     def get_all(self, run_id):
-        return run_context.get_context(request.db, run_id, None)
+        return run_context.get_context(request.db, run_id, None,
+                                       request.cache)
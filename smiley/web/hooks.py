@@ -1,6 +1,7 @@
 from pecan import hooks
 
 from smiley import db
+from smiley.web import cache
 
 
 class DBHook(hooks.PecanHook):
@@ -17,3 +18,19 @@ class DBHook(hooks.PecanHook):
 
     def before(self, state):
         state.request.db = self._db
+
+
+class CacheHook(hooks.PecanHook):
+    """Set up the cache for request.
+
+    Attach a cache object to the request, shared by all requests, for
+    values that are expensive to compute.
+
+    """
+
+    def __init__(self, max_bytes):
+        super(CacheHook, self).__init__()
+        self._cache = cache.LRUCache(max_bytes)
+
+    def before(self, state):
+        state.request.cache = self._cache
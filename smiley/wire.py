@@ -0,0 +1,87 @@
+"""Encode and decode the messages sent from Publisher to Listener.
+
+The 'start_run' message is always encoded with JSON and includes the
+name of the codec used for the rest of the messages in the run, so a
+listener can switch formats without any other configuration. Listeners
+that do not know about codecs see a 'json' run exactly as before.
+
+With the msgpack codec, trace messages send the thread name, filename,
+and function name as small integer ids. The first message to use a
+string includes it in a 'symbols' list of [id, string] pairs, and the
+listener replaces the ids with the strings again before passing the
+message on. The 'start_run' message says whether the run uses symbols
+in its 'interned' field, and JSON runs always send plain strings so
+older listeners can read them. A listener that starts in the middle
+of an interned run cannot resolve the ids defined before it started.
+
+A publisher may also send several trace messages together as a single
+'batch' message, with the type and payload of each trace message as
+a pair of frames after the 'batch' frame.
+"""
+
+import json
+import logging
+
+from smiley import jsonutil
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+LOG = logging.getLogger(__name__)
+
+# Message type for several trace messages sent together.
+BATCH = 'batch'
+
+# Trace message fields sent as symbol ids.
+SYMBOL_FIELDS = ('thread_id', 'filename', 'func_name')
+
+
+class JSONCodec(object):
+    """Text messages, readable by any version of the listener.
+    """
+
+    name = 'json'
+    interns_symbols = False
+
+    def encode(self, data):
+        return jsonutil.dumps(data).encode('utf-8')
+
+    def decode(self, payload):
+        return json.loads(payload.decode('utf-8'))
+
+
+class MsgpackCodec(object):
+    """Compact binary messages, requires the msgpack package.
+    """
+
+    name = 'msgpack'
+    interns_symbols = True
+
+    def encode(self, data):
+        return msgpack.packb(jsonutil.simplify(data), use_bin_type=True)
+
+    def decode(self, payload):
+        return msgpack.unpackb(payload, raw=False, strict_map_key=False)
+
+
+JSON = JSONCodec()
+
+CODECS = {JSON.name: JSON}
+if msgpack is not None:
+    CODECS[MsgpackCodec.name] = MsgpackCodec()
+
+
+def get_codec(name):
+    """Return the codec with the given name.
+
+    Raises ValueError if the codec is unknown or its dependencies are
+    not installed.
+    """
+    try:
+        return CODECS[name]
+    except KeyError:
+        if name == MsgpackCodec.name:
+            raise ValueError('The msgpack codec requires the msgpack package')
+        raise ValueError('Unknown codec %r' % (name,))